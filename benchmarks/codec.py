@@ -0,0 +1,64 @@
+# JSON codec microbenchmark: stdlib json against the backend evio.codec picked, orjson or msgspec when installed.
+# Run from the repository root: python -m benchmarks.codec
+import json
+from random import Random
+from timeit import repeat
+
+from evio.api import MATCH_INFO_RESPONSE_DECODER, convert_match_info_response
+from evio.codec import BACKEND, dumps, loads
+
+NUMBER = 20000
+REPEAT = 5
+
+
+def player(rng: Random, account: int) -> dict:
+    return {
+        'account': str(account),
+        'stats': {
+            'char': 'x', 'kills': rng.randint(0, 30), 'deaths': rng.randint(0, 30), 'score': rng.randint(0, 5000),
+            'round_wins': 0, 'guest_kills': 0, 'bot_kills': 0, 'registered_kills': 5, 'clan_kills': 0,
+            'bot_deaths': 0, 'boss_kills': 0, 'revives': 0, 'flags': 0, 'assists': rng.randint(0, 10)
+        }
+    }
+
+
+def get_match_response(rng: Random) -> bytes:
+    # 10-player get_match response, config as set from the lobby config modal
+    return json.dumps({'match': {
+        'matchId': 'abc', 'status': 'complete',
+        'teams': [
+            {'players': [player(rng, 1000 + i) for i in range(5)], 'placement': 1},
+            {'players': [player(rng, 1005 + i) for i in range(5)], 'placement': 2}
+        ],
+        'duration': 600, 'gravity': 1.0, 'timeVelocity': 1.5, 'damageMultiplier': 1.0, 'killsToWin': 50,
+        'gameMode': 'team_deathmatch', 'map': '724', 'region': 'amsterdam'
+    }}).encode()
+
+
+def main():
+    raw = get_match_response(Random(0))
+    obj = json.loads(raw)
+
+    # Every backend has to give the same result as the stdlib
+    expected = convert_match_info_response(json.loads(raw))
+    assert MATCH_INFO_RESPONSE_DECODER.decode(raw) == expected
+    assert loads(raw) == obj
+    assert json.loads(dumps(obj)) == obj
+
+    cases = {
+        'decode match (stdlib)': lambda: convert_match_info_response(json.loads(raw)),
+        f'decode match ({BACKEND})': lambda: MATCH_INFO_RESPONSE_DECODER.decode(raw),
+        'loads (stdlib)': lambda: json.loads(raw),
+        f'loads ({BACKEND})': lambda: loads(raw),
+        'dumps (stdlib)': lambda: json.dumps(obj, separators=(',', ':')),
+        f'dumps ({BACKEND})': lambda: dumps(obj),
+    }
+    typed = 'msgspec' if MATCH_INFO_RESPONSE_DECODER.decoder is not None else 'convert'
+    print(f'Backend: {BACKEND}, typed decoder: {typed}')
+    for name, fn in cases.items():
+        seconds = min(repeat(fn, number=NUMBER, repeat=REPEAT)) / NUMBER
+        print(f'{name:<24} {seconds * 1e6:6.2f}us')
+
+
+if __name__ == '__main__':
+    main()
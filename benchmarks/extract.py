@@ -0,0 +1,65 @@
+# UID and page number extraction from clan member pages: regex over the decoded page against ChunkExtractor fed in
+# SCAN_CHUNK_SIZE chunks, as the pages are streamed. Lookups by name on the rankings page only need the first UID, so
+# bytes read are compared too.
+# Run from the repository root: python -m benchmarks.extract
+import re
+from pathlib import Path
+from timeit import repeat
+
+from evio.api import RE_PAGE_NUM, RE_UID
+from evio.extract import SCAN_CHUNK_SIZE, ChunkExtractor
+
+FIXTURES = sorted((Path(__file__).parent.parent / 'tests' / 'fixtures').glob('clan_members_*.html'))
+RANKINGS = Path(__file__).parent.parent / 'tests' / 'fixtures' / 'rankings_by_name.html'
+NUMBER = 200
+REPEAT = 5
+# Patterns before streaming, matched on the decoded page
+OLD_UID = r'href="/user/(\d+)"'
+OLD_PAGE_NUM = r'href="\?page=(\d+)"'
+
+
+def whole_page(page: bytes) -> tuple[list[int], list[int]]:
+    text = page.decode('utf-8')
+    return [int(uid) for uid in re.findall(OLD_UID, text)], [int(num) for num in re.findall(OLD_PAGE_NUM, text)]
+
+
+def chunked(page: bytes) -> tuple[list[int], list[int]]:
+    extractor = ChunkExtractor({'uid': RE_UID, 'page': RE_PAGE_NUM})
+    for i in range(0, len(page), SCAN_CHUNK_SIZE):
+        extractor.feed(page[i:i + SCAN_CHUNK_SIZE])
+    return [int(uid) for uid in extractor.results['uid']], [int(num) for num in extractor.results['page']]
+
+
+def whole_page_first_uid(page: bytes) -> tuple[int, int]:
+    # Whole body read, as res.text() did
+    text = page.decode('utf-8')
+    return int(re.findall(OLD_UID, text)[0]), len(page)
+
+
+def chunked_first_uid(page: bytes) -> tuple[int, int]:
+    extractor = ChunkExtractor({'uid': RE_UID}, {'uid': 1})
+    for i in range(0, len(page), SCAN_CHUNK_SIZE):
+        if extractor.feed(page[i:i + SCAN_CHUNK_SIZE]):
+            return int(extractor.results['uid'][0]), min(i + SCAN_CHUNK_SIZE, len(page))
+    return int(extractor.results['uid'][0]), len(page)
+
+
+def measure(fn, page: bytes) -> float:
+    return min(repeat(lambda: fn(page), number=NUMBER, repeat=REPEAT)) / NUMBER
+
+
+def main():
+    for path in FIXTURES:
+        page = path.read_bytes()
+        assert chunked(page) == whole_page(page)
+        print(f'{path.name:<28} {len(page):>6} bytes  whole page {measure(whole_page, page) * 1e6:6.1f}us  chunked {measure(chunked, page) * 1e6:6.1f}us')
+
+    page = RANKINGS.read_bytes()
+    (old_uid, old_read), (new_uid, new_read) = whole_page_first_uid(page), chunked_first_uid(page)
+    assert old_uid == new_uid
+    print(f'{RANKINGS.name:<28} first UID  whole page {old_read:>6} bytes {measure(whole_page_first_uid, page) * 1e6:6.1f}us  '
+          f'stop early {new_read:>6} bytes {measure(chunked_first_uid, page) * 1e6:6.1f}us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Matchmaking search over 10k open lobbies: LobbyIndex against the linear scan it replaced.
+# Run from the repository root: python -m benchmarks.lobby_index
+from random import Random
+from timeit import repeat
+
+from evio.db import MAPS_POOL, GameMode, League, LeagueInfo, MatchmakingRegionEnum
+from evio.mm.index import LobbyIndex
+from evio.mm.lobby import MatchmakingLobby
+from evio.mm.players import PlayerIndex
+from evio.mm.rating import MMR_DIFF_THRESHOLD
+
+LOBBIES = 10000
+QUERIES = 2000
+POOL_SIZE = 5 # Maps in a player's pool
+LEAGUE_DATA = LeagueInfo(name=League.Duo.name, team_size=2, match_config={})
+REPEAT = 5
+
+
+def linear_find(lobbies: dict[str, MatchmakingLobby], league: League, mode: GameMode, region: MatchmakingRegionEnum, map_pool: list[int], member_mmr: int) -> tuple[str, int] | None:
+    # Search before LobbyIndex, without logging and the shuffle of lobby keys
+    for key, lobby in lobbies.items():
+        if lobby.map['nid'] not in map_pool or lobby.region is not region or lobby.league is not league or lobby.mode is not mode:
+            continue
+        for i, team in enumerate(lobby.teams[:2]):
+            if not lobby.is_team_joinable(i):
+                continue
+            if team['avg_mmr'] > 0 and abs(member_mmr - team['avg_mmr']) > MMR_DIFF_THRESHOLD:
+                continue
+            enemy_avg_mmr = lobby.teams[int(not i)]['avg_mmr']
+            if enemy_avg_mmr > 0 and abs(member_mmr - enemy_avg_mmr) > MMR_DIFF_THRESHOLD:
+                continue
+            return key, i
+    return None
+
+
+def create_lobbies(rng: Random) -> dict[str, MatchmakingLobby]:
+    # Duo lobbies across every region and map, half of them with a second player
+    players = PlayerIndex()
+    lobbies: dict[str, MatchmakingLobby] = {}
+    for i in range(LOBBIES):
+        lobby = MatchmakingLobby(None, None, {'nid': rng.choice(MAPS_POOL)}, League.Duo, LEAGUE_DATA, GameMode.Competitive, '', None, players)
+        lobby.region = rng.choice(list(MatchmakingRegionEnum))
+        lobby.join(0, {'user_id': i, 'name': f'player{i}', 'mmr': rng.randint(500, 4000)}, i)
+        if rng.random() < 0.5:
+            lobby.join(1, {'user_id': LOBBIES + i, 'name': f'player{LOBBIES + i}', 'mmr': rng.randint(500, 4000)}, LOBBIES + i)
+        lobbies[lobby.key] = lobby
+    return lobbies
+
+
+def main():
+    rng = Random(1)
+    lobbies = create_lobbies(rng)
+    index = LobbyIndex()
+    for key, lobby in lobbies.items():
+        index.update(key, lobby)
+    regions = list(MatchmakingRegionEnum)
+    hits = [(rng.choice(regions), rng.sample(MAPS_POOL, POOL_SIZE), rng.randint(500, 4000)) for _ in range(QUERIES)]
+    # Nobody is within the threshold, so every lobby of the pool is checked
+    misses = [(rng.choice(regions), MAPS_POOL, 9000) for _ in range(QUERIES)]
+
+    for region, map_pool, mmr in hits + misses:
+        found = index.find(League.Duo, GameMode.Competitive, region, map_pool, mmr)
+        assert (found is None) == (linear_find(lobbies, League.Duo, GameMode.Competitive, region, map_pool, mmr) is None)
+        if found is not None:
+            lobby = lobbies[found[0]]
+            assert index.is_mmr_acceptable(mmr, lobby.teams[found[1]]['avg_mmr']) and index.is_mmr_acceptable(mmr, lobby.teams[int(not found[1])]['avg_mmr'])
+
+    print(f'{LOBBIES} open Duo lobbies, {len(regions)} regions, {len(MAPS_POOL)} maps')
+    for name, queries in (('hit', hits), ('miss', misses)):
+        indexed = min(repeat(lambda: [index.find(League.Duo, GameMode.Competitive, *query) for query in queries], number=1, repeat=REPEAT)) / len(queries)
+        linear = min(repeat(lambda: [linear_find(lobbies, League.Duo, GameMode.Competitive, *query) for query in queries], number=1, repeat=REPEAT)) / len(queries)
+        print(f'{name:<4}  index {indexed * 1e6:8.1f}us  linear scan {linear * 1e6:8.1f}us')
+
+
+if __name__ == '__main__':
+    main()
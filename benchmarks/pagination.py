@@ -0,0 +1,79 @@
+# Leaderboard and match history pagination on 1M stats rows: OFFSET against keyset queries, and the in-memory leaderboard.
+# Run from the repository root: python -m benchmarks.pagination
+from random import Random
+from time import perf_counter
+
+from evio.db import HISTORY_PAGE_SIZE, LEADERBOARD_PAGE_SIZE, TABLE_PREFIX, EvioDB, League, connect
+from evio.leaderboard import Leaderboards
+
+PLAYERS = 1_000_000 // len(League) # Every player has a stats row in every league
+MATCHES = 100_000 # All played by one player
+LEAGUE = League.Duo.value
+RUNS = 5
+
+FIELDS = 's.user_id, p.name, s.mmr, s.kills, s.deaths, s.assists, s.won, s.draw, s.lost'
+# Queries before keyset pagination
+LEADERBOARD_OFFSET = f'SELECT ROW_NUMBER() OVER (ORDER BY s.mmr DESC) AS pos, {FIELDS} FROM {TABLE_PREFIX}_competitive_stats AS s LEFT JOIN {TABLE_PREFIX}_players AS p ON p.user_id = s.user_id WHERE s.league_id = ? AND p.deleted_at IS NULL LIMIT {LEADERBOARD_PAGE_SIZE} OFFSET ?'
+HISTORY_OFFSET = f'SELECT mh.match_id FROM {TABLE_PREFIX}_players_history AS ph JOIN {TABLE_PREFIX}_matches_history AS mh ON mh.match_id = ph.match_id WHERE ph.user_id = ? ORDER BY mh.created_at DESC, mh.match_id DESC LIMIT {HISTORY_PAGE_SIZE} OFFSET ?'
+# Keyset leaderboard query. Leaderboards are read from memory now, so the schema doesn't have its index anymore.
+LEADERBOARD_INDEX = f'CREATE INDEX competitive_stats_league_mmr_idx ON {TABLE_PREFIX}_competitive_stats(league_id, mmr DESC, user_id)'
+LEADERBOARD_KEYSET = f'SELECT {FIELDS} FROM {TABLE_PREFIX}_competitive_stats AS s JOIN {TABLE_PREFIX}_players AS p ON p.user_id = s.user_id WHERE s.league_id = ? AND p.deleted_at IS NULL AND s.mmr <= ? AND (s.mmr < ? OR s.user_id > ?) ORDER BY s.mmr DESC, s.user_id ASC LIMIT {LEADERBOARD_PAGE_SIZE}'
+
+
+def measure(fn, *args) -> tuple[float, list]:
+    # Best of RUNS, in milliseconds
+    best = float('inf')
+    for _ in range(RUNS):
+        started = perf_counter()
+        result = fn(*args)
+        best = min(best, perf_counter() - started)
+    return best * 1000, result
+
+
+def fill(db: EvioDB, rng: Random):
+    db.db.execute('BEGIN')
+    db.db.executemany(f'INSERT INTO {TABLE_PREFIX}_players(user_id, name) VALUES (?,?)', ((i, f'player{i}') for i in range(PLAYERS)))
+    db.db.executemany(
+        f'INSERT INTO {TABLE_PREFIX}_competitive_stats(user_id, league_id, mmr) VALUES (?,?,?)',
+        ((i, league.value, rng.randint(0, 4000)) for i in range(PLAYERS) for league in League)
+    )
+    db.db.executemany(
+        f'INSERT INTO {TABLE_PREFIX}_matches_history(match_id, league_id, mode_id, status, map, region, created_at) VALUES (?,?,0,2,724,0,?)',
+        ((f'{i:08}', LEAGUE, i) for i in range(MATCHES))
+    )
+    db.db.executemany(f'INSERT INTO {TABLE_PREFIX}_players_history(user_id, match_id, created_at) VALUES (0,?,?)', ((f'{i:08}', i) for i in range(MATCHES)))
+    db.db.commit()
+
+
+def main():
+    db = EvioDB(connect(':memory:'))
+    fill(db, Random(0))
+    leaderboards = Leaderboards(LEADERBOARD_PAGE_SIZE)
+    leaderboards.load(db.get_leaderboard_rows())
+    leaderboard = leaderboards[LEAGUE]
+    db.db.execute(LEADERBOARD_INDEX)
+    print(f'{PLAYERS * len(League)} stats rows, {MATCHES} matches in one history')
+
+    for page in (0, 100, 10000):
+        offset, rows = measure(lambda: db.db.execute(LEADERBOARD_OFFSET, (LEAGUE, page * LEADERBOARD_PAGE_SIZE)).fetchall())
+        cursor = leaderboard.page(page - 1)[-1] if page else {'mmr': 1 << 62, 'user_id': -1}
+        keyset, keyset_rows = measure(lambda: db.db.execute(LEADERBOARD_KEYSET, (LEAGUE, cursor['mmr'], cursor['mmr'], cursor['user_id'])).fetchall())
+        memory, memory_rows = measure(leaderboard.page, page)
+        # Players with the same MMR aren't in a fixed order with OFFSET
+        assert [row['mmr'] for row in rows] == [row['mmr'] for row in keyset_rows] == [row['mmr'] for row in memory_rows]
+        assert [row['user_id'] for row in keyset_rows] == [row['user_id'] for row in memory_rows]
+        print(f'leaderboard page {page:>5}: offset {offset:8.2f}ms  keyset {keyset:6.2f}ms  memory {memory:6.3f}ms')
+
+    for page in (0, 100, 1000):
+        offset, rows = measure(lambda: db.db.execute(HISTORY_OFFSET, (0, page * HISTORY_PAGE_SIZE)).fetchall())
+        cursor = None
+        if page:
+            last = db.db.execute(HISTORY_OFFSET, (0, page * HISTORY_PAGE_SIZE - 1)).fetchone()['match_id']
+            cursor = (int(last), last)
+        keyset, matches = measure(lambda: db.get_player_match_history(0, after=cursor))
+        assert [row['match_id'] for row in rows] == [match['match_id'] for match in matches]
+        print(f'history page {page:>5}:     offset {offset:8.2f}ms  keyset {keyset:6.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,29 @@
 from discord.ext.commands import Bot
-from sqlite3 import Connection
+from evio.db import AsyncEvioDB, LeagueRegistry
+from evio.fanout import MessageFanout
 from evio.mm.lobby import MatchmakingLobby, CustomLobby
+from evio.mm.index import LobbyIndex
+from evio.mm.players import PlayerIndex
+from evio.mm.callbacks import MatchCallbackProcessor
+from evio.mm.scheduler import MatchPoller
 from asyncio import Lock
 
 class MatchmakingBot(Bot):
-    db: Connection
+    db: AsyncEvioDB
+    leagues: LeagueRegistry
     # Stores lobbies with running matches
     matches: dict[str, MatchmakingLobby | CustomLobby]
     matches_lock: Lock
     # Stores lobbies with pending matches
     lobbies: dict[str, MatchmakingLobby | CustomLobby]
-    lobbies_lock: Lock
\ No newline at end of file
+    lobbies_lock: Lock
+    # Open matchmaking lobbies indexed for search
+    lobby_index: LobbyIndex
+    # Reverse lookup of players in lobbies and matches
+    player_index: PlayerIndex
+    # Polls running matches, keeps last sweep stats
+    match_poller: MatchPoller
+    # Processes match API callbacks in the background
+    match_callbacks: MatchCallbackProcessor
+    # Sends lobby and match message updates
+    fanout: MessageFanout
@@ -1,8 +1,14 @@
 import asyncio
-import re
-from asyncio import Task
-from typing import TypedDict, Any, Literal, Optional
-from aiohttp import ClientSession, BasicAuth
+import logging
+from functools import wraps
+from traceback import format_exc
+from typing import AsyncIterator, TypedDict, Any, Literal, Optional
+from aiohttp import BasicAuth, ClientError
+
+from evio.cache import NEGATIVE_TTL, ResponseCache
+from evio.codec import TypedDecoder, loads
+from evio.extract import ChunkExtractor
+from evio.transport import CircuitOpenError, HostTransport, LatencyHistogram, SingleFlight, TransportConfig
 
 class EvioAttribute(TypedDict):
     value: Any
@@ -219,99 +225,253 @@ class CreatedMatchInfo(TypedDict):
 class MatchmakingMatchInfoResponse(TypedDict):
     match: CreatedMatchInfo
 
+# Shapes the match API responses are decoded into. The API sends IDs as strings, they're converted to int while decoding.
+# Everything else is Any, so values are passed through as they are, same as convert_match_info_response does.
+# E.g. timeVelocity is a float when set from the lobby config modal.
+class MatchmakingPlayerInfoWire(TypedDict, total=False):
+    account: int
+    stats: Any
+
+
+class MatchmakingTeamInfoWire(TypedDict, total=False):
+    players: list[MatchmakingPlayerInfoWire]
+    placement: Any
+
+
+class CreatedMatchInfoWire(TypedDict, total=False):
+    matchId: Any
+    status: Any
+    teams: list[MatchmakingTeamInfoWire]
+    duration: Any
+    gravity: Any
+    timeVelocity: Any
+    damageMultiplier: Any
+    killsToWin: Any
+    gameMode: Any
+    map: int
+    region: Any
+
+
+class MatchmakingMatchInfoResponseWire(TypedDict):
+    match: CreatedMatchInfoWire
+
+
+def convert_match_info_response(data: MatchmakingMatchInfoResponse) -> MatchmakingMatchInfoResponse:
+    # Used when msgspec isn't installed
+    match = data['match']
+    match['map'] = int(match['map'])
+    for team in match['teams']:
+        for player in team['players']:
+            player['account'] = int(player['account'])
+    return data
+
+
+MATCH_INFO_RESPONSE_DECODER = TypedDecoder(MatchmakingMatchInfoResponseWire, convert_match_info_response)
+
 GameMode = Literal['Deathmatch'] | Literal['Instagib'] | Literal['Search and Destroy'] | Literal['Snipe the Streamer'] | Literal['Sniper Shotgun'] | Literal['Team Deathmatch']
 
-RE_UID = r'href="/user/(\d+)"'
-RE_PAGE_NUM = r'href="\?page=(\d+)"'
+RE_UID = rb'href="/user/(?P<uid>\d+)"'
+RE_PAGE_NUM = rb'href="\?page=(?P<page>\d+)"'
+
+CLAN_CRAWL_CONCURRENCY = 4 # Member pages fetched at once
+CLAN_PAGE_RETRIES = 2 # On top of transport retries, e.g. while the circuit is open
+CLAN_PAGE_RETRY_DELAY = 5 # Seconds, multiplied by attempt number
+USER_INFO_WORKERS = 8
+
+# Seconds. Endpoints that aren't listed are never cached.
+ENDPOINT_TTLS: dict[str, float] = {
+    'get_maps': 60 * 60,
+    'get_user_info': 2 * 60,
+    'get_user_info_by_name': 10 * 60,
+    'get_clan_info': 5 * 60,
+    'get_scholar_info': 2 * 60,
+    'get_flags_info': 2 * 60
+}
+
+
+def coalesced(fn):
+    # Concurrent calls with the same arguments share one upstream request and its decoded result
+    @wraps(fn)
+    async def wrapper(self: 'EvioApiClient', *args):
+        return await self.inflight.run((fn.__name__, *args), fn, self, *args)
+    return wrapper
 
 
 class EvioApiClient:
 
-    def __init__(self, client: ClientSession, credentials: BasicAuth) -> None:
-        self.client = client
+    def __init__(self, credentials: BasicAuth, config: TransportConfig | None = None, cache: ResponseCache | None = None, ttls: dict[str, float] | None = None) -> None:
         self.credentials = credentials
         self.api_base_url = 'https://ev.io'
         self.matchmaking_base_url = 'https://evio-match-api.herokuapp.com'
+        self.cache = cache
+        # Separate pools so a slow ev.io doesn't starve match API calls and vice versa
+        self.evio = HostTransport('ev.io', config, cache, {**ENDPOINT_TTLS, **(ttls or {})})
+        self.matchmaking = HostTransport('match-api', config)
+        self.inflight = SingleFlight()
+
+
+    async def close(self):
+        await self.evio.close()
+        await self.matchmaking.close()
+
+
+    @property
+    def latency(self) -> dict[str, LatencyHistogram]:
+        return {
+            **{f'{self.evio.name}/{k}': v for k, v in self.evio.latency.items()},
+            **{f'{self.matchmaking.name}/{k}': v for k, v in self.matchmaking.latency.items()}
+        }
 
 
     async def create_match(self, match_info: MatchmakingMatchInfoRequest) -> MatchmakingMatchInfoResponse:
-        res = await self.client.post(f'{self.matchmaking_base_url}/v1/matches', json=match_info, headers={'Content-Type': 'application/json'})
-        return await res.json()
+        res = await self.matchmaking.request('POST', f'{self.matchmaking_base_url}/v1/matches', 'create_match', json=match_info, headers={'Content-Type': 'application/json'})
+        return loads(await res.read())
 
 
+    @coalesced
     async def get_match(self, match_id: str) -> MatchmakingMatchInfoResponse:
-        res = await self.client.get(f'{self.matchmaking_base_url}/v1/matches/{match_id}', headers={'Content-Type': 'application/json'})
-        data: MatchmakingMatchInfoResponse = await res.json()
-        # NOTE: API returns str ID while we want int ID. Convert now to avoid conversions later.
-        match = data['match']
-        match['map'] = int(match['map'])
-        for team in match['teams']:
-            for player in team['players']:
-                player['account'] = int(player['account'])
-        return data
+        res = await self.matchmaking.request('GET', f'{self.matchmaking_base_url}/v1/matches/{match_id}', 'get_match', headers={'Content-Type': 'application/json'})
+        # NOTE: API returns str ID while we want int ID. Converted while decoding to avoid conversions later.
+        return MATCH_INFO_RESPONSE_DECODER.decode(await res.read())
 
 
+    @coalesced
     async def get_maps(self) -> list[EvioMap]:
-        res = await self.client.get(f'{self.api_base_url}/maps', headers={'Content-Type': 'application/json'})
-        data: list[EvioMap] = await res.json()
+        res = await self.evio.request('GET', f'{self.api_base_url}/maps', 'get_maps', headers={'Content-Type': 'application/json'})
+        data: list[EvioMap] = loads(await res.read())
         # NOTE: API returns str ID while we want int ID. Convert now to avoid conversions later.
         for item in data:
             item['nid'] = int(item['nid'])
         return data
 
 
+    @coalesced
     async def get_scholar_info(self, evio_user_id: int) -> list[EvioScholarInfo]:
-        res = await self.client.get(f'{self.api_base_url}/scholar/{evio_user_id}', headers={'Content-Type': 'application/json'})
-        return await res.json()
+        res = await self.evio.request('GET', f'{self.api_base_url}/scholar/{evio_user_id}', 'get_scholar_info', headers={'Content-Type': 'application/json'})
+        return loads(await res.read())
 
 
+    @coalesced
     async def get_flags_info(self, evio_user_id: int) -> list[EvioFlagsInfo]:
-        res = await self.client.get(f'{self.api_base_url}/flags/{evio_user_id}', headers={'Content-Type': 'application/json'})
-        return await res.json()
+        res = await self.evio.request('GET', f'{self.api_base_url}/flags/{evio_user_id}', 'get_flags_info', headers={'Content-Type': 'application/json'})
+        return loads(await res.read())
 
 
+    @coalesced
     async def get_user_info(self, evio_user_id: int) -> EvioUserInfo:
-        res = await self.client.get(f'{self.api_base_url}/user/{evio_user_id}?_format=json', headers={'Content-Type': 'application/json'})
-        return await res.json()
+        res = await self.evio.request('GET', f'{self.api_base_url}/user/{evio_user_id}?_format=json', 'get_user_info', headers={'Content-Type': 'application/json'})
+        return loads(await res.read())
 
 
+    @coalesced
     async def get_user_info_by_name(self, username: str) -> EvioUserInfo | None:
-        res = await self.client.get(f'{self.api_base_url}/rankings?uid={username}', headers={'Content-Type': 'application/json'})
-        content = await res.text()
-        uid = re.search(RE_UID, content)
-        if not uid:
+        url = f'{self.api_base_url}/rankings?uid={username}'
+        # Only the first UID is needed, the rest of the page isn't downloaded
+        extractor = await self.evio.scan(url, 'get_user_info_by_name', ChunkExtractor({'uid': RE_UID}, {'uid': 1}), headers={'Content-Type': 'application/json'})
+        uids = extractor.results['uid']
+        if not uids:
+            # User might register on ev.io any moment, don't keep the negative result for long
+            if self.cache is not None:
+                await self.cache.shorten(url, NEGATIVE_TTL)
             return None
-        return await self.get_user_info(uid[1])
+        return await self.get_user_info(int(uids[0]))
 
 
+    @coalesced
     async def get_clan_info(self, evio_clan_id: int) -> EvioClanInfo:
-        res = await self.client.get(f'{self.api_base_url}/group/{evio_clan_id}?_format=json', headers={'Content-Type': 'application/json'})
-        return await res.json()
+        res = await self.evio.request('GET', f'{self.api_base_url}/group/{evio_clan_id}?_format=json', 'get_clan_info', headers={'Content-Type': 'application/json'})
+        return loads(await res.read())
 
 
     async def patch_clan_info(self, evio_clan_id: int, data: EvioClanInfo):
-        res = await self.client.patch(f'{self.api_base_url}/group/{evio_clan_id}?_format=json', json=data, auth=self.credentials, headers={'Content-Type': 'application/json'})
-        return await res.json()
+        res = await self.evio.request('PATCH', f'{self.api_base_url}/group/{evio_clan_id}?_format=json', 'patch_clan_info', json=data, auth=self.credentials, headers={'Content-Type': 'application/json'})
+        return loads(await res.read())
 
 
+    @coalesced
     async def get_clan_member_ids_page(self, evio_clan_id: int, page: int) -> list[int]:
-        res = await self.client.get(f'{self.api_base_url}/group/{evio_clan_id}/members?page={page}', headers={'Content-Type': 'text/html'})
-        content = await res.text()
-        return [int(member_id) for member_id in re.findall(RE_UID, content)]
-
-
+        extractor = await self.evio.scan(f'{self.api_base_url}/group/{evio_clan_id}/members?page={page}', 'get_clan_member_ids_page', ChunkExtractor({'uid': RE_UID}), headers={'Content-Type': 'text/html'})
+        return [int(member_id) for member_id in extractor.results['uid']]
+
+
+    async def get_clan_member_ids_page_with_retry(self, evio_clan_id: int, page: int) -> list[int]:
+        for attempt in range(CLAN_PAGE_RETRIES + 1):
+            try:
+                return await self.get_clan_member_ids_page(evio_clan_id, page)
+            except (ClientError, asyncio.TimeoutError, CircuitOpenError):
+                if attempt == CLAN_PAGE_RETRIES:
+                    raise
+                logging.warning(f'Failed to fetch page {page} of clan {evio_clan_id} members, retrying.')
+                await asyncio.sleep(CLAN_PAGE_RETRY_DELAY * (attempt + 1))
+
+
+    async def iter_clan_member_ids(self, evio_clan_id: int, concurrency: int = CLAN_CRAWL_CONCURRENCY) -> AsyncIterator[int]:
+        extractor = await self.evio.scan(f'{self.api_base_url}/group/{evio_clan_id}/members', 'get_clan_member_ids', ChunkExtractor({'uid': RE_UID, 'page': RE_PAGE_NUM}), headers={'Content-Type': 'text/html'})
+        # First page is the same as page 0, no need to fetch it again
+        for member_id in extractor.results['uid']:
+            yield int(member_id)
+        last_page = max((int(num) for num in extractor.results['page']), default=0)
+
+        next_page = 1
+        # Pages at or after the first empty one aren't fetched
+        stop_at = last_page + 1
+        pending: dict[asyncio.Task, int] = {}
+        try:
+            while pending or next_page < stop_at:
+                while len(pending) < concurrency and next_page < stop_at:
+                    pending[asyncio.ensure_future(self.get_clan_member_ids_page_with_retry(evio_clan_id, next_page))] = next_page
+                    next_page += 1
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    page = pending.pop(task)
+                    member_ids = task.result()
+                    if not member_ids:
+                        stop_at = min(stop_at, page)
+                        continue
+                    for member_id in member_ids:
+                        yield member_id
+                for task, page in list(pending.items()):
+                    if page >= stop_at:
+                        task.cancel()
+                        del pending[task]
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+    @coalesced
     async def get_clan_member_ids(self, evio_clan_id: int) -> list[int]:
-        res = await self.client.get(f'{self.api_base_url}/group/{evio_clan_id}/members', headers={'Content-Type': 'text/html'})
-        content = await res.text()
-
-        pages = [int(num) for num in re.findall(RE_PAGE_NUM, content)]
-        tasks: list[Task] = []
-        for i in range(max(pages) + 1):
-            tasks.append(asyncio.ensure_future(self.get_clan_member_ids_page(evio_clan_id, i)))
-        completed_tasks: list[list[int]] = await asyncio.gather(*tasks, return_exceptions=True)
-
-        members: list[int] = []
-        for result in completed_tasks:
-            members += result
-
-        return members
+        return [member_id async for member_id in self.iter_clan_member_ids(evio_clan_id)]
+
+
+    async def iter_clan_members_info(self, evio_clan_id: int, workers: int = USER_INFO_WORKERS) -> AsyncIterator[EvioUserInfo]:
+        # Member IDs are streamed from the crawler to a pool of workers fetching user info. Order is not preserved.
+        member_ids: asyncio.Queue[int | None] = asyncio.Queue(workers * 2)
+        results: asyncio.Queue[EvioUserInfo | None] = asyncio.Queue()
+
+        async def produce():
+            try:
+                async for member_id in self.iter_clan_member_ids(evio_clan_id):
+                    await member_ids.put(member_id)
+            finally:
+                for _ in range(workers):
+                    await member_ids.put(None)
+
+        async def work():
+            while (member_id := await member_ids.get()) is not None:
+                try:
+                    results.put_nowait(await self.get_user_info(member_id))
+                except (ClientError, asyncio.TimeoutError, CircuitOpenError):
+                    logging.error(f'Failed to fetch user info of clan {evio_clan_id} member {member_id}: {format_exc()}')
+
+        tasks = [asyncio.ensure_future(produce()), *(asyncio.ensure_future(work()) for _ in range(workers))]
+        done = asyncio.gather(*tasks)
+        done.add_done_callback(lambda _: results.put_nowait(None))
+        try:
+            while (info := await results.get()) is not None:
+                yield info
+            # Raises if crawling failed
+            await done
+        finally:
+            for task in tasks:
+                task.cancel()
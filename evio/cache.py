@@ -0,0 +1,173 @@
+import asyncio
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import Any, TypedDict
+from aiohttp import ClientResponseError, RequestInfo
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from evio.codec import loads
+
+RESPONSE_CACHE_SIZE = 2000
+NEGATIVE_TTL = 60 # Seconds, for "not found" results
+# Expired entries are still kept on disk for a while since they can be revalidated with ETag/Last-Modified
+STALE_RETENTION = 24 * 60 * 60 # Seconds
+
+
+class CacheEntry(TypedDict):
+    status: int
+    body: bytes
+    encoding: str
+    etag: str | None
+    last_modified: str | None
+    expires: float # Unix time, so entries loaded from disk keep their age
+
+
+class CachedResponse:
+
+    def __init__(self, url: str, entry: CacheEntry) -> None:
+        self.url = url
+        self.status = entry['status']
+        self.entry = entry
+
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            request_info = RequestInfo(URL(self.url), 'GET', CIMultiDictProxy(CIMultiDict()), URL(self.url))
+            raise ClientResponseError(request_info, (), status=self.status, message='Cached error response')
+
+
+    async def read(self) -> bytes:
+        return self.entry['body']
+
+
+    async def text(self) -> str:
+        return self.entry['body'].decode(self.entry['encoding'])
+
+
+    async def json(self) -> Any:
+        return loads(self.entry['body'])
+
+
+class SQLiteCacheStore:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # Single thread, so the connection is only ever used by one thread at a time
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='http-cache')
+        self.conn: sqlite3.Connection | None = None
+
+
+    async def run(self, fn, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS http_cache (
+            key TEXT PRIMARY KEY,
+            status INTEGER NOT NULL,
+            body BLOB NOT NULL,
+            encoding TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            expires REAL NOT NULL
+        ) WITHOUT ROWID''')
+        self.conn.execute('DELETE FROM http_cache WHERE expires < ?', (time() - STALE_RETENTION,))
+        self.conn.commit()
+
+
+    def _get(self, key: str) -> CacheEntry | None:
+        row = self.conn.execute('SELECT status, body, encoding, etag, last_modified, expires FROM http_cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(status=row[0], body=row[1], encoding=row[2], etag=row[3], last_modified=row[4], expires=row[5])
+
+
+    def _put(self, key: str, entry: CacheEntry):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO http_cache (key, status, body, encoding, etag, last_modified, expires) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (key, entry['status'], entry['body'], entry['encoding'], entry['etag'], entry['last_modified'], entry['expires'])
+        )
+        self.conn.commit()
+
+
+    def _close(self):
+        self.conn.close()
+
+
+    async def open(self):
+        await self.run(self._open)
+
+
+    async def get(self, key: str) -> CacheEntry | None:
+        return await self.run(self._get, key)
+
+
+    async def put(self, key: str, entry: CacheEntry):
+        await self.run(self._put, key, entry)
+
+
+    async def close(self):
+        await self.run(self._close)
+        self.executor.shutdown()
+
+
+class ResponseCache:
+
+    def __init__(self, size: int = RESPONSE_CACHE_SIZE, store: SQLiteCacheStore | None = None) -> None:
+        self.size = size
+        self.store = store
+        # URL -> entry, least recently used first
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+
+    async def open(self):
+        if self.store is not None:
+            await self.store.open()
+
+
+    async def close(self):
+        if self.store is not None:
+            await self.store.close()
+
+
+    def remember(self, key: str, entry: CacheEntry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+    async def get(self, key: str) -> CacheEntry | None:
+        # Returns expired entries too, they can still be revalidated
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+        if self.store is None:
+            return None
+        entry = await self.store.get(key)
+        if entry is not None:
+            self.remember(key, entry)
+        return entry
+
+
+    async def put(self, key: str, entry: CacheEntry):
+        self.remember(key, entry)
+        if self.store is not None:
+            await self.store.put(key, entry)
+
+
+    async def shorten(self, key: str, ttl: float):
+        entry = await self.get(key)
+        if entry is not None and entry['expires'] > time() + ttl:
+            entry['expires'] = time() + ttl
+            await self.put(key, entry)
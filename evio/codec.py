@@ -0,0 +1,56 @@
+import json
+from typing import Any, Callable
+
+# Optional fast backends, the stdlib is used when neither is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+elif msgspec is not None:
+    BACKEND = 'msgspec'
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+else:
+    BACKEND = 'json'
+
+
+def loads(data: bytes | str) -> Any:
+    if BACKEND == 'orjson':
+        return orjson.loads(data)
+    if BACKEND == 'msgspec':
+        return _decoder.decode(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    # Compact output, same as json.dumps(obj, separators=(',', ':')) apart from non-ASCII characters not being escaped.
+    # Non-str dict keys are converted to str like the stdlib does.
+    if BACKEND == 'orjson':
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    if BACKEND == 'msgspec':
+        return _encoder.encode(obj).decode()
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class TypedDecoder:
+    # Decodes JSON into the given TypedDict shape. With msgspec, numeric strings are converted to the annotated int
+    # fields while decoding. Otherwise the result of loads() is passed through `convert`, which has to do the same.
+
+    def __init__(self, type: Any, convert: Callable[[Any], Any] | None = None) -> None:
+        self.decoder = msgspec.json.Decoder(type, strict=False) if msgspec is not None else None
+        self.convert = convert
+
+
+    def decode(self, data: bytes | str) -> Any:
+        if self.decoder is not None:
+            return self.decoder.decode(data)
+        obj = loads(data)
+        return obj if self.convert is None else self.convert(obj)
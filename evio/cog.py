@@ -1,11 +1,9 @@
+import asyncio
 import websockets.client
 import logging
-from asyncio import sleep
-from .mm.lobby import MATCH_INFO_MAP, MMR_DIFF_THRESHOLD, MAPS_POOL, CustomLobby, MatchmakingLobby, get_avg_team_mmr
+from .mm.lobby import MATCH_INFO_MAP, MAPS_POOL, CustomLobby, LobbySnapshot, MatchmakingLobby, get_avg_team_mmr
 from custom_types import MatchmakingBot
-from uuid import uuid4
 from datetime import datetime
-from json import loads, dumps
 from sqlite3 import IntegrityError
 from discord import Client, app_commands, Interaction, ui, ButtonStyle, Client, Embed, Color, User, SelectOption, Message
 from discord.emoji import Emoji
@@ -15,19 +13,21 @@ from discord.interactions import Interaction
 from discord.partial_emoji import PartialEmoji
 from discord.ui import View
 from typing import Any, Coroutine
-from aiohttp import ClientSession, BasicAuth
-from random import choice, shuffle
+from random import choice
 from traceback import format_exc
 from table2ascii import table2ascii
 from urllib.parse import quote
 
 from .api import EvioMap, EvioApiClient, EvioUserInfo
-from .db import EvioDB, League, GameMode, DBHistoricalMatch, MatchStatusEnum, MatchmakingRegionEnum
+from .codec import dumps, loads
+from .db import AsyncEvioDB, LeagueInfo, PlayerSettings, LEADERBOARD_PAGE_SIZE, League, GameMode, HistoricalMatch, PlayerHistory, MatchStatusEnum, MatchmakingRegionEnum
+from .leaderboard import Leaderboard, RenderedPages
+from .mm.players import PlayerState
 
 
 class MatchmakingLobbyScreen(View):
 
-    def __init__(self, bot: MatchmakingBot, api: EvioApiClient, db: EvioDB, user: User, maps: list[EvioMap], league_id: int, mode_id: int, callback_url: str, player_settings: dict):
+    def __init__(self, bot: MatchmakingBot, api: EvioApiClient, db: AsyncEvioDB, user: User, maps: list[EvioMap], league_id: int, mode_id: int, callback_url: str, player_settings: PlayerSettings, league_data: LeagueInfo):
         super().__init__(timeout=None)
 
         self.bot = bot
@@ -41,15 +41,14 @@ class MatchmakingLobbyScreen(View):
         self.mode = GameMode(mode_id)
 
         self.maps = maps
-        player_maps = loads(player_settings['maps'])
-        player_regions = loads(player_settings['regions'])
+        player_maps = player_settings['maps']
+        player_regions = player_settings['regions']
         self.map_pool = [map for map in maps if map['nid'] in player_maps]
         self.region = MatchmakingRegionEnum(player_regions[0])
         self.callback_url = callback_url
 
-        # TODO: Kinda suboptimal... We take league data here, then once again when creating a new lobby
-        self.league_data = self.db.get_league_data(league_id, 'match_config')
-        self.match_config: dict = loads(self.league_data['match_config'])
+        self.league_data = league_data
+        self.match_config = self.league_data['match_config']
 
         self.lobby_key = None
         self.created_at = datetime.utcnow()
@@ -73,34 +72,36 @@ class MatchmakingLobbyScreen(View):
         lobby = self.bot.lobbies[self.lobby_key]
         lobby.leave(discord_id)
         if not lobby.is_empty():
+            self.bot.lobby_index.update(self.lobby_key, lobby)
             self.lobby_key = None
             del lobby.user_messages[discord_id]
+            await lobby.persist()
             return
         async with self.bot.lobbies_lock:
             del self.bot.lobbies[self.lobby_key]
+            self.bot.lobby_index.remove(self.lobby_key)
         self.lobby_key = None
+        await lobby.forget()
 
 
     async def trigger_lobby_start(self):
         lobby = self.bot.lobbies[self.lobby_key]
         if not lobby.is_full():
-            for msg in lobby.user_messages.values():
-                try:
-                    await msg.edit(embed=lobby.render_info(False, True))
-                except:
-                    logging.error(format_exc())
+            self.bot.fanout.broadcast(lobby.user_messages.values(), embed=lobby.render_info(False, True))
             return
         match_id = await lobby.start()
         async with self.bot.matches_lock:
             self.bot.matches[match_id] = lobby
+            lobby.promote()
+        self.bot.match_poller.schedule(match_id)
         async with self.bot.lobbies_lock:
             del self.bot.lobbies[self.lobby_key]
+            self.bot.lobby_index.remove(self.lobby_key)
+        embed = lobby.render_info(True, False)
         for msg in lobby.user_messages.values():
             # TODO: Readiness screen
-            try:
-                await msg.edit(content='Match was found!', embed=lobby.render_info(True, False), view=ConnectScreen(match_id))
-            except:
-                logging.error(format_exc())
+            self.bot.fanout.edit(msg, content='Match was found!', embed=embed, view=ConnectScreen(match_id))
+        await lobby.persist()
 
 
     @ui.button(label="Select map pool", style=ButtonStyle.gray, row=0)
@@ -121,69 +122,42 @@ class MatchmakingLobbyScreen(View):
 
     @ui.button(label="Search", style=ButtonStyle.green, row=1)
     async def search(self, interaction: Interaction, _: ui.Button):
-        def mmr_over_threshold(member_mmr: int, avg_mmr: int):
-            diff = member_mmr - avg_mmr
-            logging.info(f'MM: Rating diff: {diff}')
-            return diff > MMR_DIFF_THRESHOLD or diff < -MMR_DIFF_THRESHOLD
-
         if interaction.user.id != self.creator.id:
             await interaction.response.send_message("You cannot use this menu.", ephemeral=True)
             return
-        if any(interaction.user.id in lobby.discord_player_map for lobby in self.bot.lobbies.values()) \
-            or any(interaction.user.id in lobby.discord_player_map for lobby in self.bot.matches.values()):
+        if interaction.user.id in self.bot.player_index:
             await interaction.response.send_message("You are already playing in another lobby.", ephemeral=True)
             return
-        member = self.db.get_player_with_stats(interaction.user.id, self.league.value, 'p.user_id', 'p.name', 's.mmr')
+        member = await self.db.get_member(interaction.user.id, self.league.value)
         if not member:
             await interaction.response.send_message('You must register first.', ephemeral=True)
             return
 
         target_lobby = None
-        member_mmr = member['mmr']
-        # FIXME: This may be shit performance-wise, but not sure if there's a better way
         async with self.bot.lobbies_lock:
-            shuffled_keys = list(self.bot.lobbies)
-            shuffle(shuffled_keys)
-            for key in shuffled_keys:
-                lobby = self.bot.lobbies[key]
-                # Avoid putting MM players into Custom lobbies
-                if isinstance(lobby, CustomLobby) \
-                    or not any(lobby.map['nid'] == map['nid'] for map in self.map_pool) \
-                    or lobby.region is not self.region \
-                    or lobby.league is not self.league \
-                    or lobby.mode is not self.mode:
-                    continue
-                logging.info(f'MM: Checking lobby with teams: {lobby.teams}')
-                for i, team in enumerate(lobby.teams[:2]):
-                    if not lobby.is_team_joinable(i):
-                        logging.info(f'MM: Team {i} is full. Players num: {len(team["players"])}.')
-                        continue
-                    if self.mode is GameMode.Competitive:
-                        target_avg_mmr = team['avg_mmr']
-                        if target_avg_mmr > 0 and mmr_over_threshold(member_mmr, target_avg_mmr):
-                            logging.info(f'MM: Team {i} doesn\'t match MMR requirements. Player MMR: {member_mmr}, their MMR: {target_avg_mmr}')
-                            continue
-                        enemy_avg_mmr = lobby.teams[int(not i)]['avg_mmr']
-                        if enemy_avg_mmr > 0 and mmr_over_threshold(member_mmr, enemy_avg_mmr):
-                            logging.info(f'MM: Enemy team {int(not i)} has too high avg MMR. Player MMR: {member_mmr}, their MMR: {enemy_avg_mmr}')
-                            continue
-                    lobby.join(i, member, interaction.user.id)
-                    target_lobby = lobby
-                    self.lobby_key = key
-                    break
+            slot = self.bot.lobby_index.find(self.league, self.mode, self.region, [map['nid'] for map in self.map_pool], member['mmr'])
+            if slot is not None:
+                key, team = slot
+                logging.info(f'MM: Found lobby {key}, joining team {team}. Player MMR: {member["mmr"]}')
+                target_lobby = self.bot.lobbies[key]
+                target_lobby.join(team, member, interaction.user.id)
+                self.bot.lobby_index.update(key, target_lobby)
+                self.lobby_key = key
 
         if target_lobby is None:
             logging.info('MM: No matching lobby found. Creating new lobby.')
-            self.lobby_key = str(uuid4())
-            target_lobby = MatchmakingLobby(self.api, self.db, choice(self.map_pool), self.league, self.mode, self.callback_url, self.creator)
+            target_lobby = MatchmakingLobby(self.api, self.db, choice(self.map_pool), self.league, self.league_data, self.mode, self.callback_url, self.creator, self.bot.player_index)
+            self.lobby_key = target_lobby.key
             target_lobby.join(0, member, interaction.user.id)
             # FIXME: Need to refactor lobby class to accept region
             target_lobby.region = self.region
             async with self.bot.lobbies_lock:
                 self.bot.lobbies[self.lobby_key] = target_lobby
+                self.bot.lobby_index.update(self.lobby_key, target_lobby)
         await interaction.response.edit_message(content='Waiting for players...', embed=target_lobby.render_info(False, True), view=MatchSearchScreen(self))
 
         target_lobby.user_messages[interaction.user.id] = self.discord_message
+        await target_lobby.persist()
 
         await self.trigger_lobby_start()
 
@@ -240,12 +214,12 @@ class MMRegionSelect(ui.Select['MMRegionSelectionScreen']):
 
 
     async def callback(self, interaction: Interaction):
-        member = self.view.parent.db.get_player_by_discord_id(interaction.user.id, 'p.user_id')
+        member = await self.view.parent.db.get_player_profile(interaction.user.id)
         if not member:
             await interaction.response.send_message('You must register first.', ephemeral=True)
             return
         region = int(self.values[0])
-        self.view.parent.db.set_player_settings(member['user_id'], regions=[region])
+        await self.view.parent.db.set_player_settings(member['user_id'], regions=[region])
         self.view.parent.region = MatchmakingRegionEnum(region)
         await interaction.response.edit_message(embed=self.view.parent.render_info(), view=self.view.parent)
 
@@ -278,11 +252,11 @@ class MMMapSelect(ui.Select['MMMapSelectionScreen']):
 
 
     async def callback(self, interaction: Interaction):
-        member = self.view.parent.db.get_player_by_discord_id(interaction.user.id, 'p.user_id')
+        member = await self.view.parent.db.get_player_profile(interaction.user.id)
         if not member:
             await interaction.response.send_message('You must register first.', ephemeral=True)
             return
-        self.view.parent.db.set_player_settings(member['user_id'], maps=[map['nid'] for map in self.view.parent.map_pool])
+        await self.view.parent.db.set_player_settings(member['user_id'], maps=[map['nid'] for map in self.view.parent.map_pool])
         self.view.parent.map_pool = [map for map in self.view.parent.maps for value in self.values if map['nid'] == int(value)]
         await interaction.response.edit_message(embed=self.view.parent.render_info(), view=self.view.parent)
 
@@ -290,7 +264,7 @@ class MMMapSelect(ui.Select['MMMapSelectionScreen']):
 
 class CustomLobbyScreen(View):
 
-    def __init__(self, bot: MatchmakingBot, db: EvioDB, user: User, maps: list[EvioMap], lobby: CustomLobby, lobby_key: str):
+    def __init__(self, bot: MatchmakingBot, db: AsyncEvioDB, user: User, maps: list[EvioMap], lobby: CustomLobby, lobby_key: str):
         super().__init__(timeout=None)
 
         self.bot = bot
@@ -351,7 +325,10 @@ class CustomLobbyScreen(View):
             del self.bot.lobbies[self.lobby_key]
         async with self.bot.matches_lock:
             self.bot.matches[match_id] = self.lobby
+            self.lobby.promote()
+        self.bot.match_poller.schedule(match_id)
         await interaction.response.edit_message(embed=self.lobby.render_info(), view=ConnectScreen(match_id))
+        await self.lobby.persist()
 
 
     @ui.button(label="Cancel", style=ButtonStyle.red, row=2)
@@ -361,6 +338,8 @@ class CustomLobbyScreen(View):
             return
         async with self.bot.lobbies_lock:
             del self.bot.lobbies[self.lobby_key]
+        self.lobby.release()
+        await self.lobby.forget()
         await self.discord_message.delete()
 
 
@@ -386,15 +365,12 @@ class JoinTeamButton(ui.Button['CustomLobbyScreen']):
 
     async def callback(self, interaction: Interaction) -> Coroutine[Any, Any, Any]:
         view = self.view
-        member = view.db.get_player_with_stats(interaction.user.id, view.lobby.league.value, 'p.user_id', 'p.name', 's.mmr')
+        member = await view.db.get_member(interaction.user.id, view.lobby.league.value)
         if not member:
             await interaction.response.send_message('You must register first.', ephemeral=True)
             return
-        # TODO: This is double lookup: here and in .join() method... Maybe not a problem since it's O(1)
-        lobby_player = view.lobby.lookup_player(interaction.user.id)
-        if lobby_player is None \
-            and (any(interaction.user.id in lobby.discord_player_map for lobby in self.view.bot.lobbies.values()) \
-            or any(interaction.user.id in lobby.discord_player_map for lobby in self.view.bot.matches.values())):
+        entry = view.bot.player_index.get(interaction.user.id)
+        if entry is not None and entry != (view.lobby.key, PlayerState.LOBBY):
             await interaction.response.send_message("You are already playing in another lobby.", ephemeral=True)
             return
         err = view.lobby.join(self.team, member, interaction.user.id)
@@ -402,6 +378,7 @@ class JoinTeamButton(ui.Button['CustomLobbyScreen']):
             await interaction.response.send_message(err, ephemeral=True)
             return
         await interaction.response.edit_message(embed=view.lobby.render_info(), view=view)
+        await view.lobby.persist()
 
 
 class LeaveTeamButton(ui.Button['CustomLobbyScreen']):
@@ -415,7 +392,7 @@ class LeaveTeamButton(ui.Button['CustomLobbyScreen']):
         if view.creator.id == interaction.user.id:
             await interaction.response.send_message('You cannot leave teams in your own lobby. If you want to leave the lobby, use the **Cancel** button.', ephemeral=True)
             return
-        member = view.db.get_player_by_discord_id(interaction.user.id, 'p.user_id')
+        member = await view.db.get_player_profile(interaction.user.id)
         if not member:
             await interaction.response.send_message('You must register first.', ephemeral=True)
             return
@@ -424,6 +401,7 @@ class LeaveTeamButton(ui.Button['CustomLobbyScreen']):
             await interaction.response.send_message(err, ephemeral=True)
             return
         await interaction.response.edit_message(embed=view.lobby.render_info(), view=view)
+        await view.lobby.persist()
 
 
 class LobbyConfigModal(ui.Modal):
@@ -456,6 +434,7 @@ class LobbyConfigModal(ui.Modal):
             }
         )
         await interaction.response.edit_message(embed=self.parent.lobby.render_info(), view=self.parent)
+        await self.parent.lobby.persist()
 
 
 class CRegionSelectionScreen(View):
@@ -488,6 +467,7 @@ class CRegionSelect(ui.Select['CRegionSelectionScreen']):
     async def callback(self, interaction: Interaction):
         self.view.parent.lobby.region = MatchmakingRegionEnum(int(self.values[0]))
         await interaction.response.edit_message(embed=self.view.parent.lobby.render_info(), view=self.view.parent)
+        await self.view.parent.lobby.persist()
 
 
 class CMapSelectionScreen(View):
@@ -520,6 +500,7 @@ class CMapSelect(ui.Select['CMapSelectionScreen']):
     async def callback(self, interaction: Interaction):
         self.view.parent.lobby.map = next((map for map in self.view.parent.maps if map['nid'] == int(self.values[0])), None)
         await interaction.response.edit_message(embed=self.view.parent.lobby.render_info(), view=self.view.parent)
+        await self.view.parent.lobby.persist()
 
 
 class ConnectScreen(View):
@@ -532,13 +513,15 @@ class ConnectScreen(View):
 
 class HistoryScreen(View):
 
-    def __init__(self, db: EvioDB, creator: User, maps: list[EvioMap]):
+    def __init__(self, db: AsyncEvioDB, creator: User, maps: dict[int, EvioMap], history: PlayerHistory):
         super().__init__(timeout=None)
         self.db = db
         self.creator = creator
-        self.matches = self.db.get_player_match_history(creator.id)
-        self.maps = maps
+        self.history = history
+        self.maps = maps # By nid
         self.pos = 0
+        # Embeds of the current match and its neighbours, built ahead so Previous/Next respond right away
+        self.embeds: dict[int, Embed] = {}
 
 
     # async def interaction_check(self, interaction: Interaction[Client]) -> Coroutine[Any, Any, bool]:
@@ -554,20 +537,20 @@ class HistoryScreen(View):
             return ''
         return f" [{player['kills']}/{player['deaths']}/{player['assists']}]"
 
-    def render_info(self, match: DBHistoricalMatch) -> Embed:
-        mode = GameMode(match['mode_id'])
-        league = League(match['league_id'])
-        teams: list[dict] = loads(match['teams'])
-        config: dict = loads(match['config'])
+    def render_info(self, match: HistoricalMatch) -> Embed:
+        mode = match['mode']
+        league = match['league']
+        teams = match['teams']
+        config = match['config']
         created_at = datetime.fromtimestamp(match['created_at'])
 
-        region = MatchmakingRegionEnum(match['region'])
-        map = next((map for map in self.maps if map['nid'] == match['map']), None)
+        region = match['region']
+        map = self.maps.get(match['map'])
 
         team_red_players = teams[0]['players']
         team_blue_players = teams[1]['players']
 
-        status = MatchStatusEnum(match['status'])
+        status = match['status']
         if status is MatchStatusEnum.COMPLETE:
             draw = int(teams[0]['placement'] == teams[1]['placement'])
             won = int(teams[0]['placement'] > teams[1]['placement'])
@@ -599,32 +582,52 @@ class HistoryScreen(View):
         return embed
 
 
+    def get_embed(self, pos: int) -> Embed:
+        embed = self.embeds.get(pos)
+        if embed is None:
+            embed = self.embeds[pos] = self.render_info(self.history.matches[pos])
+        return embed
+
+
+    async def prerender(self):
+        # Loads the next page when the last loaded match is shown
+        await self.db.load_player_history(self.history, self.pos + 2)
+        self.embeds = {pos: self.get_embed(pos) for pos in (self.pos - 1, self.pos, self.pos + 1) if 0 <= pos < len(self.history.matches)}
+
+
+    async def show(self, interaction: Interaction, pos: int):
+        self.pos = pos
+        await interaction.response.edit_message(content=None, embed=self.get_embed(pos))
+        await self.prerender()
+
+
     @ui.button(label="Previous", style=ButtonStyle.gray)
     async def previous(self, interaction: Interaction, _: ui.Button):
         pos = self.pos - 1
         if pos < 0:
             await interaction.response.edit_message(content='Cannot navigate past the first page.')
             return
-        self.pos = pos
-        await interaction.response.edit_message(content=None, embed=self.render_info(self.matches[pos]))
+        await self.show(interaction, pos)
 
 
     @ui.button(label="Next", style=ButtonStyle.gray)
     async def next(self, interaction: Interaction, _: ui.Button):
         pos = self.pos + 1
-        if pos >= len(self.matches):
-            await interaction.response.edit_message(content='Cannot navigate past the last page.')
-            return
-        self.pos = pos
-        await interaction.response.edit_message(content=None, embed=self.render_info(self.matches[pos]))
+        if pos >= len(self.history.matches):
+            await self.db.load_player_history(self.history, pos + 1)
+            if pos >= len(self.history.matches):
+                await interaction.response.edit_message(content='Cannot navigate past the last page.')
+                return
+        await self.show(interaction, pos)
 
 # ---------------
 
 class LeaderboardScreen(View):
 
-    def __init__(self, db: EvioDB, creator: User, league: League):
+    def __init__(self, leaderboard: Leaderboard, rendered_pages: RenderedPages, creator: User, league: League):
         super().__init__(timeout=None)
-        self.db = db
+        self.leaderboard = leaderboard
+        self.rendered_pages = rendered_pages
         self.creator = creator
         self.league = league
         self.pos = 0
@@ -643,11 +646,16 @@ class LeaderboardScreen(View):
             return ''
         return f" [{player['kills']}/{player['deaths']}/{player['assists']}]"
 
-    def render_info(self, data: list[dict]) -> Embed:
-        table = table2ascii(
-            header=('#', 'Name', 'MMR', 'K', 'D', 'A'),
-            body=[(player['pos'], player['name'], player['mmr'], player['kills'], player['deaths'], player['assists']) for player in data]
-        )
+    def render_info(self) -> Embed:
+        # Pages are only rendered again once a rank or a row on them has changed
+        key = (self.league.value, self.pos, self.leaderboard.page_version(self.pos))
+        table = self.rendered_pages.get(key)
+        if table is None:
+            table = table2ascii(
+                header=('#', 'Name', 'MMR', 'K', 'D', 'A'),
+                body=[(self.pos * LEADERBOARD_PAGE_SIZE + i + 1, player['name'], player['mmr'], player['kills'], player['deaths'], player['assists']) for i, player in enumerate(self.leaderboard.page(self.pos))]
+            )
+            self.rendered_pages.put(key, table)
         return Embed(title=f'Leaderboard for {self.league.name} league', description=f'```{table}```', color=Color.darker_grey())
 
 
@@ -658,19 +666,17 @@ class LeaderboardScreen(View):
             await interaction.response.edit_message(content='Cannot navigate past the first page.')
             return
         self.pos = pos
-        data = self.db.get_top_10_players(self.league.value, pos, 'p.name', 's.mmr', 's.kills', 's.deaths', 's.assists', 's.won', 's.draw', 's.lost')
-        await interaction.response.edit_message(content=None, embed=self.render_info(data))
+        await interaction.response.edit_message(content=None, embed=self.render_info())
 
 
     @ui.button(label="Next", style=ButtonStyle.gray)
     async def next(self, interaction: Interaction, _: ui.Button):
         pos = self.pos + 1
-        data = self.db.get_top_10_players(self.league.value, pos, 'p.name', 's.mmr', 's.kills', 's.deaths', 's.assists', 's.won', 's.draw', 's.lost')
-        if not data:
+        if pos >= self.leaderboard.pages():
             await interaction.response.edit_message(content='Cannot navigate past the last page.')
             return
         self.pos = pos
-        await interaction.response.edit_message(content=None, embed=self.render_info(data))
+        await interaction.response.edit_message(content=None, embed=self.render_info())
 
 
     @ui.button(label="Close", style=ButtonStyle.red)
@@ -683,7 +689,7 @@ class LeaderboardScreen(View):
 
 class VerifyView(View):
 
-    def __init__(self, db: EvioDB, player: EvioUserInfo, is_created: bool):
+    def __init__(self, db: AsyncEvioDB, player: EvioUserInfo, is_created: bool):
         super().__init__(timeout=None)
         self.db = db
         self.player = player
@@ -697,7 +703,7 @@ class VerifyView(View):
 
 class VerifyModal(ui.Modal):
 
-    def __init__(self, db: EvioDB, player: EvioUserInfo, is_created: bool):
+    def __init__(self, db: AsyncEvioDB, player: EvioUserInfo, is_created: bool):
         super().__init__(title='Verification')
 
         self.player = player
@@ -734,7 +740,7 @@ class VerifyModal(ui.Modal):
 
                 if self.is_created:
                     try:
-                        self.db.update_player_registration(self.player['uid'][0]['value'], interaction.user.id)
+                        await self.db.update_player_registration(self.player['uid'][0]['value'], interaction.user.id)
                         await interaction.response.edit_message(content="You've been registered successfully.", view=None)
                     except:
                         logging.error(format_exc())
@@ -742,7 +748,7 @@ class VerifyModal(ui.Modal):
                     return
 
                 try:
-                    self.db.register_player(self.player, interaction.user.id)
+                    await self.db.register_player(self.player, interaction.user.id)
                     await interaction.response.edit_message(content="You've been registered successfully.", view=None)
                 except:
                     logging.error(format_exc())
@@ -754,16 +760,95 @@ class VerifyModal(ui.Modal):
 
 class Evio(commands.Cog):
 
-    def __init__(self, bot: MatchmakingBot, client: ClientSession, credentials: BasicAuth, callback_url: str):
+    def __init__(self, bot: MatchmakingBot, api: EvioApiClient, callback_url: str):
         self.bot = bot
-        self.api = EvioApiClient(client, credentials)
-        self.db = EvioDB(self.bot.db)
+        self.api = api
+        self.db = self.bot.db
         self.callback_url = callback_url
+        # Shared by every open leaderboard view
+        self.rendered_pages = RenderedPages()
         self.bot.loop.create_task(self.load_maps())
 
 
     async def load_maps(self):
         self.maps = tuple(map for map in await self.api.get_maps() if map['nid'] in MAPS_POOL)
+        self.maps_by_nid = {map['nid']: map for map in self.maps}
+
+
+    async def restore_lobbies(self):
+        # Brings back lobbies and running matches saved on shutdown. Messages get fresh views since old ones died with the process.
+        await self.load_maps()
+        restored = 0
+        for row in await self.db.get_active_lobbies():
+            try:
+                await self.restore_lobby(loads(row['state']))
+                restored += 1
+            except:
+                logging.error(f'Failed to restore lobby {row["lobby_key"]}: {format_exc()}')
+                await self.db.delete_active_lobby(row['lobby_key'])
+        logging.info(f'Restored {restored} lobbies and matches.')
+
+
+    async def restore_lobby(self, snapshot: LobbySnapshot):
+        lobby_cls = CustomLobby if snapshot['kind'] == CustomLobby.__name__ else MatchmakingLobby
+        creator = await self.bot.fetch_user(snapshot['creator_id'])
+        league_data = self.bot.leagues[League(snapshot['league'])]
+        lobby = lobby_cls.from_snapshot(snapshot, self.api, self.db, league_data, self.callback_url, creator, self.bot.player_index)
+        # Players are in the player index from here on, so everything that can fail is done before the lobby is registered
+        try:
+            for discord_id, (channel_id, message_id) in snapshot['messages'].items():
+                lobby.user_messages[int(discord_id)] = self.bot.get_partial_messageable(channel_id).get_partial_message(message_id)
+            if lobby.match_id is None and isinstance(lobby, CustomLobby):
+                view = CustomLobbyScreen(self.bot, self.db, creator, self.maps, lobby, lobby.key)
+                view.discord_message = lobby.user_messages[creator.id]
+                screens = [(view.discord_message, {'embed': lobby.render_info(), 'view': view})]
+            elif lobby.match_id is None:
+                screens = await self.restore_search_screens(lobby, league_data)
+        except:
+            lobby.release()
+            raise
+
+        if lobby.match_id is not None:
+            async with self.bot.matches_lock:
+                self.bot.matches[lobby.match_id] = lobby
+            # Result might have been missed while offline
+            self.bot.match_poller.schedule(lobby.match_id, 0)
+            return
+
+        if isinstance(lobby, MatchmakingLobby) and lobby.is_empty():
+            # Everyone unregistered while the bot was offline
+            lobby.release()
+            await lobby.forget()
+            return
+        async with self.bot.lobbies_lock:
+            self.bot.lobbies[lobby.key] = lobby
+            if isinstance(lobby, MatchmakingLobby):
+                self.bot.lobby_index.update(lobby.key, lobby)
+        for msg, kwargs in screens:
+            self.bot.fanout.edit(msg, **kwargs)
+
+
+    async def restore_search_screens(self, lobby: MatchmakingLobby, league_data: LeagueInfo) -> list[tuple[Message, dict[str, Any]]]:
+        # Every player has own search screen with their settings. Players who unregistered while the bot was offline are
+        # removed from the lobby.
+        screens = []
+        left = False
+        for discord_id, msg in list(lobby.user_messages.items()):
+            profile = await self.db.get_player_profile(discord_id)
+            if profile is None or discord_id not in lobby.discord_player_map:
+                lobby.leave(discord_id)
+                del lobby.user_messages[discord_id]
+                self.bot.fanout.delete(msg)
+                left = True
+                continue
+            user = await self.bot.fetch_user(discord_id)
+            screen = MatchmakingLobbyScreen(self.bot, self.api, self.db, user, self.maps, lobby.league.value, lobby.mode.value, self.callback_url, profile['settings'], league_data)
+            screen.lobby_key = lobby.key
+            screen.discord_message = msg
+            screens.append((msg, {'embed': lobby.render_info(False, True), 'view': MatchSearchScreen(screen)}))
+        if left and not lobby.is_empty():
+            await lobby.persist()
+        return screens
 
 
     @app_commands.command(name='history')
@@ -774,15 +859,17 @@ class Evio(commands.Cog):
             await interaction.response.send_message('Bot is going to maintenance mode and is not accepting any commands.', ephemeral=True)
             return
 
-        player = self.db.get_player_by_discord_id(interaction.user.id, 'COUNT(1) as count')
-        if not player['count']:
+        player = await self.db.get_player_profile(interaction.user.id)
+        if player is None:
             await interaction.response.send_message('You must register first.', ephemeral=True)
             return
-        view = HistoryScreen(self.db, interaction.user, self.maps)
-        if not view.matches:
+        history = await self.db.get_player_history(player['user_id'])
+        if not history.matches:
             await interaction.response.send_message('You have no played matches yet.', ephemeral=True)
             return
-        await interaction.response.send_message(embed=view.render_info(view.matches[0]), view=view, ephemeral=True)
+        view = HistoryScreen(self.db, interaction.user, self.maps_by_nid, history)
+        await interaction.response.send_message(embed=view.get_embed(0), view=view, ephemeral=True)
+        await view.prerender()
 
 
     @app_commands.command(name='leaderboard')
@@ -795,9 +882,8 @@ class Evio(commands.Cog):
             return
 
         league = League(league.value)
-        view = LeaderboardScreen(self.db, interaction.user, league)
-        data = self.db.get_top_10_players(league.value, 0, 'p.name', 's.mmr', 's.kills', 's.deaths', 's.assists', 's.won', 's.draw', 's.lost')
-        await interaction.response.send_message(view=view, embed=view.render_info(data))
+        view = LeaderboardScreen(self.db.leaderboards[league.value], self.rendered_pages, interaction.user, league)
+        await interaction.response.send_message(view=view, embed=view.render_info())
 
 
     @app_commands.command(name='stats')
@@ -809,7 +895,7 @@ class Evio(commands.Cog):
             await interaction.response.send_message('Bot is going to maintenance mode and is not accepting any commands.', ephemeral=True)
             return
 
-        player = self.db.get_player_with_stats(interaction.user.id, league.value, 'p.name', 's.mmr', 's.kills', 's.deaths', 's.assists', 's.won', 's.draw', 's.lost')
+        player = await self.db.get_member(interaction.user.id, league.value)
         if not player:
             await interaction.response.send_message('You must register first.', ephemeral=True)
             return
@@ -818,6 +904,10 @@ class Evio(commands.Cog):
         embed = Embed(color=Color.brand_green())
         embed.set_author(name=player['name'], icon_url=avatar)
         embed.add_field(name='Rating', value=player['mmr'], inline=False)
+        leaderboard = self.db.leaderboards[league.value]
+        rank = leaderboard.rank(player['user_id'])
+        if rank is not None:
+            embed.add_field(name='Rank', value=f'{rank + 1} of {len(leaderboard)}', inline=False)
         embed.add_field(name='Won', value=player['won'], inline=True)
         embed.add_field(name='Draw', value=player['draw'], inline=True)
         embed.add_field(name='Lost', value=player['lost'], inline=True)
@@ -852,19 +942,17 @@ class Evio(commands.Cog):
             await interaction.response.send_message('Bot is going to maintenance mode and is not accepting any commands.', ephemeral=True)
             return
 
-        if any(interaction.user.id in lobby.discord_player_map for lobby in self.bot.lobbies.values()) \
-            or any(interaction.user.id in lobby.discord_player_map for lobby in self.bot.matches.values()):
+        if interaction.user.id in self.bot.player_index:
             await interaction.response.send_message("You are already playing in another lobby.", ephemeral=True)
             return
-        player = self.db.get_player_by_discord_id(interaction.user.id, 'p.user_id')
+        player = await self.db.get_player_profile(interaction.user.id)
         if not player:
             await interaction.response.send_message('You must register first.', ephemeral=True)
             return
 
         await interaction.response.send_message('See the message below', ephemeral=True, silent=True, delete_after=0)
 
-        player_settings = self.db.get_player_settings(player['user_id'], 'regions', 'maps')
-        view = MatchmakingLobbyScreen(self.bot, self.api, self.db, interaction.user, self.maps, league.value, mode.value, self.callback_url, player_settings)
+        view = MatchmakingLobbyScreen(self.bot, self.api, self.db, interaction.user, self.maps, league.value, mode.value, self.callback_url, player['settings'], self.bot.leagues[League(league.value)])
         view.discord_message = await interaction.channel.send(embed=view.render_info(), view=view)
 
 
@@ -882,22 +970,21 @@ class Evio(commands.Cog):
             await interaction.response.send_message('Bot is going to maintenance mode and is not accepting any commands.', ephemeral=True)
             return
 
-        player = self.db.get_player_with_stats(interaction.user.id, league.value, 'p.user_id', 'p.name', 's.mmr')
+        player = await self.db.get_member(interaction.user.id, league.value)
         if player is None:
             await interaction.response.send_message('You must register first.', ephemeral=True)
             return
 
-        if any(interaction.user.id in lobby.discord_player_map for lobby in self.bot.lobbies.values()) \
-            or any(interaction.user.id in lobby.discord_player_map for lobby in self.bot.matches.values()):
+        if interaction.user.id in self.bot.player_index:
             await interaction.response.send_message("You are already playing in another lobby.", ephemeral=True)
             return
 
         await interaction.response.send_message('See the message below', ephemeral=True, silent=True, delete_after=0)
 
         # TODO: Refactor
-        lobby = CustomLobby(self.api, self.db, self.maps[0], League(league.value), GameMode.Casual, self.callback_url, interaction.user)
+        lobby = CustomLobby(self.api, self.db, self.maps[0], League(league.value), self.bot.leagues[League(league.value)], GameMode.Casual, self.callback_url, interaction.user, self.bot.player_index)
         lobby.join(0, player, interaction.user.id)
-        lobby_key = str(uuid4())
+        lobby_key = lobby.key
         async with self.bot.lobbies_lock:
             self.bot.lobbies[lobby_key] = lobby
 
@@ -905,6 +992,7 @@ class Evio(commands.Cog):
         view.discord_message = await interaction.channel.send(embed=view.lobby.render_info(), view=view)
 
         lobby.user_messages[interaction.user.id] = view.discord_message
+        await lobby.persist()
 
 
     @app_commands.command(name='register')
@@ -915,8 +1003,8 @@ class Evio(commands.Cog):
             await interaction.response.send_message('Bot is going to maintenance mode and is not accepting any commands.', ephemeral=True)
             return
 
-        registered_player = self.db.get_player_by_discord_id(interaction.user.id, 'COUNT(1) as count')
-        if registered_player['count']:
+        registered_player = await self.db.get_player_profile(interaction.user.id)
+        if registered_player is not None:
             await interaction.response.send_message("You're already registered.", ephemeral=True)
             return
 
@@ -928,7 +1016,7 @@ class Evio(commands.Cog):
             return
 
         uid = player['uid'][0]['value']
-        db_player = self.db.get_player(uid, 'i.discord_id')
+        db_player = await self.db.get_player(uid, 'i.discord_id')
         is_created = False
         if db_player is not None:
             discord_id = db_player['discord_id']
@@ -948,17 +1036,18 @@ class Evio(commands.Cog):
             await interaction.response.send_message('Bot is going to maintenance mode and is not accepting any commands.', ephemeral=True)
             return
 
-        player = self.db.get_player_by_discord_id(interaction.user.id, 'COUNT(1) as count')
-        if not player['count']:
+        player = await self.db.get_player_profile(interaction.user.id)
+        if player is None:
             await interaction.response.send_message('You are not registered.', ephemeral=True)
             return
 
-        if any(interaction.user.id in lobby.discord_player_map for lobby in self.bot.matches.values()):
+        entry = self.bot.player_index.get(interaction.user.id)
+        if entry is not None and entry[1] is PlayerState.MATCH:
             await interaction.response.send_message("Cannot unregister while playing in a match.", ephemeral=True)
             return
 
         await self.leave_lobby(interaction.user.id)
-        self.db.remove_player(interaction.user.id)
+        await self.db.remove_player(interaction.user.id)
         await interaction.response.send_message("You've been unregistered successfully.", ephemeral=True)
 
 
@@ -970,8 +1059,8 @@ class Evio(commands.Cog):
             await interaction.response.send_message('Bot is going to maintenance mode and is not accepting any commands.', ephemeral=True)
             return
 
-        player = self.db.get_player_by_discord_id(interaction.user.id, 'COUNT(1) as count')
-        if not player['count']:
+        player = await self.db.get_player_profile(interaction.user.id)
+        if player is None:
             await interaction.response.send_message('You are not registered.', ephemeral=True)
             return
 
@@ -980,43 +1069,71 @@ class Evio(commands.Cog):
 
 
     async def leave_lobby(self, discord_id: int) -> str:
-        kv = next((lobby for lobby in self.bot.lobbies.items() if discord_id in lobby[1].discord_player_map), None)
-        if kv is None:
+        entry = self.bot.player_index.get(discord_id)
+        if entry is None or entry[1] is not PlayerState.LOBBY:
             return 'You are not present in any lobby.'
-        lobby_key, lobby = kv
+        lobby_key, _ = entry
+        lobby = self.bot.lobbies[lobby_key]
         match lobby:
             case CustomLobby():
                 # If lobby creator is interaction user - delete the lobby. Leave otherwise.
                 if lobby.creator.id == discord_id:
                     async with self.bot.lobbies_lock:
                         del self.bot.lobbies[lobby_key]
-                    try:
-                        await lobby.user_messages[discord_id].delete()
-                    except:
-                        logging.error(format_exc())
+                    lobby.release()
+                    await lobby.forget()
+                    self.bot.fanout.delete(lobby.user_messages[discord_id])
                 else:
                     lobby.leave(discord_id)
                     # Don't forget to update the lobby message
-                    for msg in lobby.user_messages.values():
-                        try:
-                            await msg.edit(embed=lobby.render_info())
-                        except:
-                            logging.error(format_exc())
+                    self.bot.fanout.broadcast(lobby.user_messages.values(), embed=lobby.render_info())
+                    await lobby.persist()
             case MatchmakingLobby():
                 # Leave lobby unconditionally
                 lobby.leave(discord_id)
                 # Matchmaking lobby messages don't need to be updated since they include anonymized information
                 # Since matchmaking lobbies don't have a creator, keep them until there are no players
-                if len(lobby.discord_player_map) == 0:
-                    async with self.bot.lobbies_lock:
+                async with self.bot.lobbies_lock:
+                    if len(lobby.discord_player_map) == 0:
                         del self.bot.lobbies[lobby_key]
-                try:
-                    await lobby.user_messages[discord_id].delete()
-                except:
-                    logging.error(format_exc())
+                        self.bot.lobby_index.remove(lobby_key)
+                    else:
+                        self.bot.lobby_index.update(lobby_key, lobby)
+                self.bot.fanout.delete(lobby.user_messages.pop(discord_id))
+                if len(lobby.discord_player_map) == 0:
+                    await lobby.forget()
+                else:
+                    await lobby.persist()
         return "You've been removed from the lobby."
 
 
+    @app_commands.command(name='reload_leagues')
+    async def evio_reload_leagues(self, interaction: Interaction):
+        """Reloads league configuration after it was edited"""
+
+        if interaction.user.id != self.bot.owner_id:
+            return await interaction.response.send_message('You cannot use this command.', ephemeral=True)
+
+        await self.bot.leagues.invalidate()
+        await interaction.response.send_message('Leagues have been reloaded.', ephemeral=True)
+
+
+    @app_commands.command(name='cache_stats')
+    async def evio_cache_stats(self, interaction: Interaction):
+        """Shows cache hit and miss counters"""
+
+        if interaction.user.id != self.bot.owner_id:
+            return await interaction.response.send_message('You cannot use this command.', ephemeral=True)
+
+        players = self.db.players
+        lines = [f'Players: {players.hits} hits, {players.misses} misses, {len(players.profiles)}/{players.size} profiles']
+        lines.append(f'Leaderboard pages: {self.rendered_pages.hits} hits, {self.rendered_pages.misses} misses, {len(self.rendered_pages.pages)}/{self.rendered_pages.size} pages')
+        responses = self.api.cache
+        if responses is not None:
+            lines.append(f'ev.io responses: {responses.hits} hits, {responses.misses} misses, {responses.revalidated} revalidated, {len(responses.entries)}/{responses.size} entries')
+        await interaction.response.send_message('\n'.join(lines), ephemeral=True)
+
+
     @app_commands.command(name='shutdown')
     async def evio_shutdown(self, interaction: Interaction):
         """Gracefully shuts down the bot"""
@@ -1032,15 +1149,17 @@ class Evio(commands.Cog):
 
         await interaction.response.defer(thinking=True, ephemeral=True)
 
-        for lobby in self.bot.lobbies.values():
-            for msg in lobby.user_messages.values():
-                try:
-                    await msg.delete()
-                except:
-                    logging.error(format_exc())
-
-        while len(self.bot.matches):
-            await sleep(1)
+        await self.bot.match_callbacks.join()
+        # Lobbies and running matches are restored on the next start, so there's no need to wait for matches to finish
+        results = await asyncio.gather(*(lobby.persist() for lobby in (*self.bot.lobbies.values(), *self.bot.matches.values())), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f'Failed to save lobby: {result!r}')
+        # Make sure all message updates are sent while still connected
+        await self.bot.fanout.drain()
+
+        # Make sure pending match results hit the disk before shutting down
+        await self.db.flush()
 
         await interaction.followup.send('Shutting down...')
 
@@ -1,12 +1,29 @@
+import asyncio
+import logging
 import sqlite3
-from json import dumps
+import threading
+from collections import OrderedDict
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import TypedDict, Optional
+from typing import TypedDict, Optional, Callable, Any, Iterator
 from enum import IntEnum
 
 from .api import EvioUserInfo, MatchStatus
+from .codec import dumps, loads
+from .leaderboard import LeaderboardRow, Leaderboards
 
 TABLE_PREFIX = 'evio'
+DB_READERS = 4
+# Write-behind journal is flushed in a single transaction when either limit is reached
+JOURNAL_FLUSH_INTERVAL = 0.1 # Seconds
+JOURNAL_FLUSH_SIZE = 50 # Entries
+PLAYER_CACHE_SIZE = 10000
+PLAYER_CACHE_TTL = 600 # Seconds
+PLAYER_HISTORY_CACHE_SIZE = 1000 # Players
+LEADERBOARD_PAGE_SIZE = 10
+HISTORY_PAGE_SIZE = 25
+REPLAY_FETCH_SIZE = 10000
 # TODO: Maybe need to store in the DB
 MAPS_POOL = [
     232, 724, 698,
@@ -16,6 +33,147 @@ MAPS_POOL = [
     132, 234, 191
 ]
 
+# (created_at, match_id) of the last/first match on a history page
+HistoryCursor = tuple[int, str]
+
+# Applied in order on top of the base schema. Current version is tracked with PRAGMA user_version.
+MIGRATIONS: list[tuple[str, ...]] = [
+    # 1: Composite keys and leaderboard index for stats, composite key for players history
+    (
+        f'''
+            CREATE TABLE {TABLE_PREFIX}_competitive_stats_new (
+                user_id BIGINT NOT NULL REFERENCES {TABLE_PREFIX}_players(user_id) ON DELETE CASCADE,
+                league_id BIGINT NOT NULL REFERENCES {TABLE_PREFIX}_leagues(league_id) ON DELETE CASCADE,
+                won BIGINT DEFAULT 0,
+                lost BIGINT DEFAULT 0,
+                draw BIGINT DEFAULT 0,
+                kills BIGINT DEFAULT 0,
+                deaths BIGINT DEFAULT 0,
+                assists BIGINT DEFAULT 0,
+                mmr BIGINT DEFAULT 2000,
+                PRIMARY KEY (user_id, league_id)
+            ) WITHOUT ROWID''',
+        f'''
+            INSERT OR IGNORE INTO {TABLE_PREFIX}_competitive_stats_new
+            SELECT user_id, league_id, won, lost, draw, kills, deaths, assists, mmr FROM {TABLE_PREFIX}_competitive_stats
+            WHERE user_id IS NOT NULL AND league_id IS NOT NULL''',
+        f'DROP TABLE {TABLE_PREFIX}_competitive_stats',
+        f'ALTER TABLE {TABLE_PREFIX}_competitive_stats_new RENAME TO {TABLE_PREFIX}_competitive_stats',
+        f'CREATE INDEX competitive_stats_league_mmr_idx ON {TABLE_PREFIX}_competitive_stats(league_id, mmr DESC, user_id)',
+        f'''
+            CREATE TABLE {TABLE_PREFIX}_players_history_new (
+                user_id BIGINT NOT NULL REFERENCES {TABLE_PREFIX}_players(user_id) ON DELETE CASCADE,
+                match_id VARCHAR(36) NOT NULL REFERENCES {TABLE_PREFIX}_matches_history(match_id) ON DELETE CASCADE,
+                PRIMARY KEY (user_id, match_id)
+            ) WITHOUT ROWID''',
+        f'''
+            INSERT OR IGNORE INTO {TABLE_PREFIX}_players_history_new
+            SELECT user_id, match_id FROM {TABLE_PREFIX}_players_history
+            WHERE user_id IS NOT NULL AND match_id IS NOT NULL''',
+        f'DROP TABLE {TABLE_PREFIX}_players_history',
+        f'ALTER TABLE {TABLE_PREFIX}_players_history_new RENAME TO {TABLE_PREFIX}_players_history',
+        # Used by cascades from matches history
+        f'CREATE INDEX players_history_match_idx ON {TABLE_PREFIX}_players_history(match_id)',
+    ),
+    # 2: Denormalized match time in players history so history pages are read in order from an index
+    (
+        f'ALTER TABLE {TABLE_PREFIX}_players_history ADD COLUMN created_at BIGINT',
+        f'UPDATE {TABLE_PREFIX}_players_history AS ph SET created_at = mh.created_at FROM {TABLE_PREFIX}_matches_history AS mh WHERE mh.match_id = ph.match_id',
+        f'CREATE INDEX players_history_user_created_idx ON {TABLE_PREFIX}_players_history(user_id, created_at DESC, match_id DESC)',
+    ),
+    # 3: Snapshots of open lobbies and running matches, restored on startup
+    (
+        f'''
+            CREATE TABLE {TABLE_PREFIX}_active_lobbies (
+                lobby_key VARCHAR(36) PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at BIGINT NOT NULL
+            ) WITHOUT ROWID''',
+    ),
+    # 4: Match players and deduplicated match configs in typed columns instead of JSON blobs
+    (
+        f'''
+            CREATE TABLE {TABLE_PREFIX}_match_configs (
+                config_id INTEGER PRIMARY KEY,
+                damage_multiplier NUMERIC,
+                duration INT,
+                game_mode TEXT,
+                gravity NUMERIC,
+                kills_to_win INT,
+                time_velocity NUMERIC,
+                UNIQUE (damage_multiplier, duration, game_mode, gravity, kills_to_win, time_velocity)
+            )''',
+        f'''
+            CREATE TABLE {TABLE_PREFIX}_match_players (
+                match_id VARCHAR(36) NOT NULL REFERENCES {TABLE_PREFIX}_matches_history(match_id) ON DELETE CASCADE,
+                team TINYINT NOT NULL,
+                slot TINYINT NOT NULL,
+                user_id BIGINT REFERENCES {TABLE_PREFIX}_players(user_id) ON DELETE SET NULL,
+                name NVARCHAR,
+                placement TINYINT,
+                kills INT,
+                deaths INT,
+                assists INT,
+                mmr BIGINT,
+                PRIMARY KEY (match_id, team, slot)
+            ) WITHOUT ROWID''',
+        f'CREATE INDEX match_players_user_idx ON {TABLE_PREFIX}_match_players(user_id)',
+        f'''
+            INSERT OR IGNORE INTO {TABLE_PREFIX}_match_configs (damage_multiplier, duration, game_mode, gravity, kills_to_win, time_velocity)
+            SELECT DISTINCT json_extract(config, '$.damageMultiplier'), json_extract(config, '$.duration'), json_extract(config, '$.gameMode'),
+                json_extract(config, '$.gravity'), json_extract(config, '$.killsToWin'), json_extract(config, '$.timeVelocity')
+            FROM {TABLE_PREFIX}_matches_history''',
+        f'ALTER TABLE {TABLE_PREFIX}_matches_history ADD COLUMN config_id INTEGER REFERENCES {TABLE_PREFIX}_match_configs(config_id)',
+        f'''
+            UPDATE {TABLE_PREFIX}_matches_history AS mh SET config_id = c.config_id FROM {TABLE_PREFIX}_match_configs AS c
+            WHERE c.damage_multiplier IS json_extract(mh.config, '$.damageMultiplier') AND c.duration IS json_extract(mh.config, '$.duration')
+                AND c.game_mode IS json_extract(mh.config, '$.gameMode') AND c.gravity IS json_extract(mh.config, '$.gravity')
+                AND c.kills_to_win IS json_extract(mh.config, '$.killsToWin') AND c.time_velocity IS json_extract(mh.config, '$.timeVelocity')''',
+        # History blobs only have player names. Players history has the user IDs of everyone in the match, so names are
+        # only looked up among them, and a name taken over by someone else doesn't get their matches.
+        f'''
+            INSERT INTO {TABLE_PREFIX}_match_players
+            SELECT mh.match_id, t.key, p.key,
+                (
+                    SELECT ph.user_id FROM {TABLE_PREFIX}_players_history AS ph JOIN {TABLE_PREFIX}_players AS pl ON pl.user_id = ph.user_id
+                    WHERE ph.match_id = mh.match_id AND pl.name = json_extract(p.value, '$.name')
+                ),
+                json_extract(p.value, '$.name'), json_extract(t.value, '$.placement'),
+                json_extract(p.value, '$.kills'), json_extract(p.value, '$.deaths'), json_extract(p.value, '$.assists'), json_extract(p.value, '$.mmr')
+            FROM {TABLE_PREFIX}_matches_history AS mh
+            JOIN json_each(mh.teams) AS t
+            JOIN json_each(t.value, '$.players') AS p''',
+        # A player renamed since the match is still known when they're the only one of the match left on both sides
+        f'''
+            UPDATE {TABLE_PREFIX}_match_players AS mp SET user_id = (
+                SELECT ph.user_id FROM {TABLE_PREFIX}_players_history AS ph JOIN {TABLE_PREFIX}_players AS pl ON pl.user_id = ph.user_id
+                WHERE ph.match_id = mp.match_id AND ph.user_id NOT IN (SELECT user_id FROM {TABLE_PREFIX}_match_players WHERE match_id = mp.match_id AND user_id IS NOT NULL)
+            )
+            WHERE mp.user_id IS NULL
+                AND (SELECT COUNT(*) FROM {TABLE_PREFIX}_match_players WHERE match_id = mp.match_id AND user_id IS NULL) = 1
+                AND (
+                    SELECT COUNT(*) FROM {TABLE_PREFIX}_players_history AS ph JOIN {TABLE_PREFIX}_players AS pl ON pl.user_id = ph.user_id
+                    WHERE ph.match_id = mp.match_id AND ph.user_id NOT IN (SELECT user_id FROM {TABLE_PREFIX}_match_players WHERE match_id = mp.match_id AND user_id IS NOT NULL)
+                ) = 1''',
+        f'ALTER TABLE {TABLE_PREFIX}_matches_history DROP COLUMN config',
+        f'ALTER TABLE {TABLE_PREFIX}_matches_history DROP COLUMN teams',
+    ),
+    # 5: Leaderboards are read from memory, the MMR index only slowed down stats updates
+    (
+        'DROP INDEX IF EXISTS competitive_stats_league_mmr_idx',
+    ),
+]
+
+# Match config key -> match_configs column
+MATCH_CONFIG_COLUMNS = {
+    'damageMultiplier': 'damage_multiplier',
+    'duration': 'duration',
+    'gameMode': 'game_mode',
+    'gravity': 'gravity',
+    'killsToWin': 'kills_to_win',
+    'timeVelocity': 'time_velocity',
+}
+
 
 class MatchmakingRegionEnum(IntEnum):
     AMSTERDAM = 0
@@ -112,6 +270,26 @@ class DBPlayerWithStats(DBPlayer):
     mmr: int
 
 
+class DBCompetitiveStats(TypedDict):
+    won: int
+    draw: int
+    lost: int
+    kills: int
+    deaths: int
+    assists: int
+    mmr: int
+
+
+class PlayerSettings(TypedDict):
+    regions: list[int] # MatchmakingRegionEnum
+    maps: list[int]
+
+
+class PlayerProfile(DBPlayer):
+    stats: dict[int, DBCompetitiveStats] # By league ID
+    settings: PlayerSettings
+
+
 class DBDeployedMember(TypedDict):
     user_id: int
     user_uuid: str
@@ -132,7 +310,9 @@ class DBStatsChange(TypedDict):
     mmr: int
 
 
-class DBBlobPlayerInfo(TypedDict):
+# Cancelled matches only store player names and no placement
+class DBBlobPlayerInfo(TypedDict, total=False):
+    user_id: int
     name: str
     kills: int
     deaths: int
@@ -141,9 +321,10 @@ class DBBlobPlayerInfo(TypedDict):
     mmr: int
 
 
-class DBBlobTeamInfo(TypedDict):
+class DBBlobTeamInfo(TypedDict, total=False):
     placement: int
-    players: DBBlobPlayerInfo
+    players: list[DBBlobPlayerInfo]
+
 
 
 class DBBlobMatchConfig(TypedDict):
@@ -163,17 +344,56 @@ class DBLeague(TypedDict):
     match_config: str
 
 
+class LeagueInfo(TypedDict):
+    name: str
+    team_size: int
+    match_config: DBBlobMatchConfig
+
+
 class DBHistoricalMatch(TypedDict):
     status: int # MatchStatusEnum
     mode_id: int
     league_id: int
     match_id: str
-    config: str
-    teams: str
     map: int
     region: int # MatchmakingRegionEnum
     comment: str | None
     created_at: int
+    # Config, columns of MATCH_CONFIG_COLUMNS
+    damage_multiplier: float
+    duration: int
+    game_mode: str
+    gravity: float
+    kills_to_win: int
+    time_velocity: float
+
+
+# Cancelled matches only have names, players who weren't registered have no user ID
+class DBMatchPlayer(TypedDict):
+    match_id: str
+    team: int
+    slot: int
+    user_id: int | None
+    name: str
+    placement: int | None
+    kills: int | None
+    deaths: int | None
+    assists: int | None
+    mmr: int | None
+
+
+# Match history entry with the JSON columns decoded
+class HistoricalMatch(TypedDict):
+    match_id: str
+    status: MatchStatusEnum
+    mode: GameMode
+    league: League
+    region: MatchmakingRegionEnum
+    map: int
+    config: dict[str, Any]
+    teams: list[DBBlobTeamInfo]
+    comment: str | None
+    created_at: int
 
 
 class MatchData(TypedDict):
@@ -188,11 +408,61 @@ class MatchData(TypedDict):
     comment: str | None
 
 
+# One row per player, rows of a match are consecutive
+class DBRatedMatchPlayer(TypedDict):
+    league_id: int
+    match_id: str
+    team: int
+    placement: int
+    user_id: int | None
+
+
+class DBActiveLobby(TypedDict):
+    lobby_key: str
+    state: str # JSON encoded LobbySnapshot
+
+
+def decode_historical_match(row: DBHistoricalMatch, players: list[DBMatchPlayer]) -> HistoricalMatch:
+    teams = [DBBlobTeamInfo(players=[]), DBBlobTeamInfo(players=[])]
+    for player in players:
+        team = teams[player['team']]
+        if player['placement'] is not None:
+            team['placement'] = player['placement']
+        info = DBBlobPlayerInfo(name=player['name'])
+        for field in ('kills', 'deaths', 'assists', 'mmr'):
+            if player[field] is not None:
+                info[field] = player[field]
+        team['players'].append(info)
+    return HistoricalMatch(
+        match_id=row['match_id'],
+        status=MatchStatusEnum(row['status']),
+        mode=GameMode(row['mode_id']),
+        league=League(row['league_id']),
+        region=MatchmakingRegionEnum(row['region']),
+        map=row['map'],
+        config={key: row[column] for key, column in MATCH_CONFIG_COLUMNS.items() if row[column] is not None},
+        teams=teams,
+        comment=row['comment'],
+        created_at=row['created_at'],
+    )
+
+
+def connect(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('PRAGMA foreign_keys=ON')
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=normal')
+    db.execute('PRAGMA journal_size_limit=67110000')
+    db.row_factory = sqlite3.Row
+    return db
+
+
 class EvioDB:
 
-    def __init__(self, db: sqlite3.Connection) -> None:
+    def __init__(self, db: sqlite3.Connection, init: bool = True) -> None:
         self.db = db
-        self.init()
+        if init:
+            self.init()
 
 
     def init(self):
@@ -277,6 +547,26 @@ class EvioDB:
             )
         )
         self.db.commit()
+        self.migrate()
+
+
+    def migrate(self):
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        for i, migration in enumerate(MIGRATIONS[version:], version + 1):
+            self.db.execute('BEGIN')
+            try:
+                for statement in migration:
+                    self.db.execute(statement)
+                self.db.execute(f'PRAGMA user_version = {i}')
+            except:
+                self.db.rollback()
+                raise
+            self.db.commit()
+            if i == 4:
+                # Left without a user ID by the backfill, replays count them as unknown players
+                unresolved = self.db.execute(f'SELECT COUNT(*) FROM {TABLE_PREFIX}_match_players WHERE user_id IS NULL').fetchone()[0]
+                if unresolved:
+                    logging.warning(f'{unresolved} match players could not be matched to a registered player')
 
 
     def get_player(self, user_id: int, *fields: str) -> DBPlayer | None:
@@ -291,29 +581,38 @@ class EvioDB:
         return self.db.execute(f'SELECT {",".join(fields)} FROM {TABLE_PREFIX}_players AS p LEFT JOIN {TABLE_PREFIX}_discord_integration AS i ON i.user_id = p.user_id WHERE i.discord_id = ?', (discord_id,)).fetchone()
 
 
-    def get_player_with_stats(self, discord_id: int, league_id: int, *fields: str) -> Optional[DBPlayerWithStats]:
-        return self.db.execute(f'SELECT {",".join([field for field in fields])} FROM {TABLE_PREFIX}_competitive_stats AS s LEFT JOIN {TABLE_PREFIX}_players AS p ON p.user_id = s.user_id LEFT JOIN {TABLE_PREFIX}_discord_integration AS i ON i.user_id = p.user_id WHERE i.discord_id = ? AND s.league_id = ?', (discord_id, league_id)).fetchone()
-
-
-    def get_top_10_players(self, league_id: int, page: int, *fields: str) -> list[DBPlayerWithStats]:
-        return self.db.execute(f'SELECT ROW_NUMBER() OVER (ORDER BY s.mmr DESC) AS pos, {",".join([field for field in fields])} FROM {TABLE_PREFIX}_competitive_stats AS s LEFT JOIN {TABLE_PREFIX}_players AS p ON p.user_id = s.user_id WHERE s.league_id = ? AND p.deleted_at IS NULL LIMIT 10 OFFSET {page * 10}', (league_id,)).fetchall()
+    def get_leaderboard_rows(self, user_id: int | None = None) -> list[LeaderboardRow]:
+        # Stats of every registered player in every league, or of a single player
+        query = f'SELECT s.league_id, s.user_id, p.name, s.won, s.lost, s.draw, s.kills, s.deaths, s.assists, s.mmr FROM {TABLE_PREFIX}_competitive_stats AS s JOIN {TABLE_PREFIX}_players AS p ON p.user_id = s.user_id WHERE p.deleted_at IS NULL'
+        params: list[Any] = []
+        if user_id is not None:
+            query += ' AND s.user_id = ?'
+            params.append(user_id)
+        return [LeaderboardRow(**row) for row in self.db.execute(query, params)]
 
 
     def get_league_data(self, league_id: int, *fields: str) -> DBLeague:
         return self.db.execute(f'SELECT {",".join([field for field in fields])} FROM {TABLE_PREFIX}_leagues WHERE league_id = ?', (league_id,)).fetchone()
 
 
-    def remove_player(self, discord_id: int):
+    def get_leagues(self, *fields: str) -> list[DBLeague]:
+        return self.db.execute(f'SELECT {",".join([field for field in fields])} FROM {TABLE_PREFIX}_leagues').fetchall()
+
+
+    def remove_player(self, discord_id: int) -> int | None:
+        # Returns the user ID of the removed player
+        row = self.db.execute(f'SELECT user_id FROM {TABLE_PREFIX}_discord_integration WHERE discord_id = ?', (discord_id,)).fetchone()
         self.db.execute(f'UPDATE {TABLE_PREFIX}_players AS p SET deleted_at = ? FROM (SELECT user_id FROM {TABLE_PREFIX}_discord_integration WHERE discord_id = ?) AS i WHERE p.user_id = i.user_id', (int(datetime.utcnow().timestamp()), discord_id))
         self.db.execute(f'DELETE FROM {TABLE_PREFIX}_discord_integration WHERE discord_id = ?', (discord_id,))
         self.db.commit()
+        return row['user_id'] if row is not None else None
 
 
     def register_player(self, user: EvioUserInfo, discord_id: int):
         user_id = user['uid'][0]['value']
         self.db.execute(f'INSERT INTO {TABLE_PREFIX}_players(user_id, name) VALUES (?,?)', (user_id, user['name'][0]['value']))
         self.db.execute(f'INSERT INTO {TABLE_PREFIX}_discord_integration VALUES (?,?)', (user_id, discord_id))
-        self.db.execute(f'INSERT INTO {TABLE_PREFIX}_player_settings(user_id, regions, maps) VALUES (?,?,?)', (user_id, dumps([MatchmakingRegionEnum.AMSTERDAM], separators=(',', ':')), dumps(MAPS_POOL, separators=(',', ':'))))
+        self.db.execute(f'INSERT INTO {TABLE_PREFIX}_player_settings(user_id, regions, maps) VALUES (?,?,?)', (user_id, dumps([MatchmakingRegionEnum.AMSTERDAM]), dumps(MAPS_POOL)))
         self.db.executemany(f'INSERT INTO {TABLE_PREFIX}_competitive_stats (user_id, league_id) VALUES (?,?)', [(user_id, e.value) for e in League])
         self.db.commit()
 
@@ -324,21 +623,109 @@ class EvioDB:
         self.db.commit()
 
 
-    def update_players_stats(self, data: list[DBStatsChange]):
+    def execute_update_players_stats(self, data: list[DBStatsChange]):
         self.db.executemany(f'UPDATE {TABLE_PREFIX}_competitive_stats SET won = won + :won, lost = lost + :lost, draw = draw + :draw, kills = kills + :kills, deaths = deaths + :deaths, assists = assists + :assists, mmr = mmr + :mmr WHERE user_id = :user_id AND league_id = :league_id', data)
+
+
+    def update_players_stats(self, data: list[DBStatsChange]):
+        self.execute_update_players_stats(data)
         self.db.commit()
 
 
+    def execute_get_config_id(self, config: DBBlobMatchConfig) -> int:
+        # Looked up first since the unique constraint doesn't cover configs with missing keys
+        values = [config.get(key) for key in MATCH_CONFIG_COLUMNS]
+        condition = ' AND '.join(f'{column} IS ?' for column in MATCH_CONFIG_COLUMNS.values())
+        row = self.db.execute(f'SELECT config_id FROM {TABLE_PREFIX}_match_configs WHERE {condition}', values).fetchone()
+        if row is not None:
+            return row['config_id']
+        return self.db.execute(f'INSERT INTO {TABLE_PREFIX}_match_configs ({",".join(MATCH_CONFIG_COLUMNS.values())}) VALUES ({",".join("?" * len(values))})', values).lastrowid
+
+
+    def execute_insert_match(self, data: MatchData, user_ids: list[int]):
+        created_at = int(datetime.utcnow().timestamp())
+        config_id = self.execute_get_config_id(data['config'])
+        self.db.execute(f'INSERT INTO {TABLE_PREFIX}_matches_history(match_id, league_id, mode_id, status, config_id, map, region, comment, created_at) VALUES (?,?,?,?,?,?,?,?,?)', (data['match_id'], data['league_id'], data['mode_id'], data['status'], config_id, data['map'], data['region'], data['comment'], created_at))
+        self.db.executemany(
+            f'INSERT INTO {TABLE_PREFIX}_match_players VALUES (?,?,?,?,?,?,?,?,?,?)',
+            [
+                (data['match_id'], team_number, slot, player.get('user_id'), player['name'], team.get('placement'), player.get('kills'), player.get('deaths'), player.get('assists'), player.get('mmr'))
+                for team_number, team in enumerate(data['teams'])
+                for slot, player in enumerate(team['players'])
+            ]
+        )
+        self.db.executemany(f'INSERT INTO {TABLE_PREFIX}_players_history(user_id, match_id, created_at) VALUES (?,?,?)', [(user_id, data['match_id'], created_at) for user_id in user_ids])
+
+
     def insert_match(self, data: MatchData, user_ids: list[int]):
-        self.db.execute(f'INSERT INTO {TABLE_PREFIX}_matches_history VALUES (?,?,?,?,?,?,?,?,?,?)', (data['match_id'], data['league_id'], data['mode_id'], data['status'], dumps(data['config'], separators=(',', ':')), dumps(data['teams'], separators=(',', ':')), data['map'], data['region'], data['comment'], int(datetime.utcnow().timestamp())))
-        self.db.executemany(f'INSERT INTO {TABLE_PREFIX}_players_history VALUES (?,?)', [(user_id, data['match_id']) for user_id in user_ids])
+        self.execute_insert_match(data, user_ids)
         self.db.commit()
 
 
+    def execute_save_active_lobby(self, lobby_key: str, state: str):
+        self.db.execute(f'INSERT OR REPLACE INTO {TABLE_PREFIX}_active_lobbies(lobby_key, state, updated_at) VALUES (?,?,?)', (lobby_key, state, int(datetime.utcnow().timestamp())))
+
+
+    def save_active_lobby(self, lobby_key: str, state: str):
+        self.execute_save_active_lobby(lobby_key, state)
+        self.db.commit()
+
+
+    def execute_delete_active_lobby(self, lobby_key: str):
+        self.db.execute(f'DELETE FROM {TABLE_PREFIX}_active_lobbies WHERE lobby_key = ?', (lobby_key,))
+
+
+    def get_active_lobbies(self) -> list[DBActiveLobby]:
+        return self.db.execute(f'SELECT lobby_key, state FROM {TABLE_PREFIX}_active_lobbies ORDER BY updated_at').fetchall()
+
+
+    def apply_journal(self, entries: list[tuple[Callable[..., None], tuple]]) -> list[Exception | None]:
+        # Applies the entries in a single transaction and returns the error of each entry.
+        # Every entry runs in its own savepoint, so a failing entry is rolled back alone and the rest are committed.
+        errors: list[Exception | None] = []
+        try:
+            if not self.db.in_transaction:
+                self.db.execute('BEGIN')
+            for fn, args in entries:
+                self.db.execute('SAVEPOINT journal_entry')
+                try:
+                    fn(self, *args)
+                except Exception as e:
+                    self.db.execute('ROLLBACK TO journal_entry')
+                    errors.append(e)
+                else:
+                    errors.append(None)
+                self.db.execute('RELEASE journal_entry')
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        return errors
+
+
     def get_player_settings(self, user_id: int, *fields: str) -> dict | None:
         return self.db.execute(f'SELECT {",".join(fields)} FROM {TABLE_PREFIX}_player_settings WHERE user_id = ?', (user_id,)).fetchone()
 
 
+    def get_player_profile(self, discord_id: int) -> PlayerProfile | None:
+        player = self.get_player_by_discord_id(discord_id, 'p.user_id', 'p.name', 'i.discord_id')
+        if player is None:
+            return None
+        user_id = player['user_id']
+        stats = self.db.execute(f'SELECT league_id, won, draw, lost, kills, deaths, assists, mmr FROM {TABLE_PREFIX}_competitive_stats WHERE user_id = ?', (user_id,)).fetchall()
+        settings = self.get_player_settings(user_id, 'regions', 'maps')
+        return PlayerProfile(
+            user_id=user_id,
+            name=player['name'],
+            discord_id=player['discord_id'],
+            stats={
+                row['league_id']: DBCompetitiveStats(won=row['won'], draw=row['draw'], lost=row['lost'], kills=row['kills'], deaths=row['deaths'], assists=row['assists'], mmr=row['mmr'])
+                for row in stats
+            },
+            settings=PlayerSettings(regions=loads(settings['regions']), maps=loads(settings['maps']))
+        )
+
+
     def set_player_settings(self, user_id: int, *, regions: list[int] | None = None, maps: list[int] | None = None):
         if regions is None and maps is None:
             return
@@ -346,13 +733,446 @@ class EvioDB:
         data = []
         if regions is not None:
             query.append('regions = ?')
-            data.append(dumps(regions, separators=(',', ':')))
+            data.append(dumps(regions))
         if maps is not None:
             query.append('maps = ?')
-            data.append(dumps(maps, separators=(',', ':')))
+            data.append(dumps(maps))
         data.append(user_id)
         self.db.execute(f'UPDATE {TABLE_PREFIX}_player_settings SET {",".join(query)} WHERE user_id = ?', data)
         self.db.commit()
 
-    def get_player_match_history(self, discord_id: int, page: int = 0) -> list[DBHistoricalMatch]:
-        return self.db.execute(f'SELECT mh.status, mh.league_id, mh.mode_id, mh.match_id, mh.config, mh.teams, mh.map, mh.region, mh.comment, mh.created_at FROM {TABLE_PREFIX}_matches_history AS mh LEFT JOIN {TABLE_PREFIX}_players_history AS ph ON mh.match_id = ph.match_id LEFT JOIN {TABLE_PREFIX}_discord_integration AS i ON i.user_id = ph.user_id WHERE i.discord_id = ? ORDER BY mh.created_at DESC LIMIT 25 OFFSET {page * 25}', (discord_id,)).fetchall()
+    def get_player_match_history(self, user_id: int, *, after: HistoryCursor | None = None, before: HistoryCursor | None = None) -> list[HistoricalMatch]:
+        # Keyset pagination over (created_at DESC, match_id DESC), matches players_history_user_created_idx
+        config_columns = ', '.join(f'c.{column}' for column in MATCH_CONFIG_COLUMNS.values())
+        query = f'SELECT mh.status, mh.league_id, mh.mode_id, mh.match_id, mh.map, mh.region, mh.comment, mh.created_at, {config_columns} FROM {TABLE_PREFIX}_players_history AS ph JOIN {TABLE_PREFIX}_matches_history AS mh ON mh.match_id = ph.match_id LEFT JOIN {TABLE_PREFIX}_match_configs AS c ON c.config_id = mh.config_id WHERE ph.user_id = ?'
+        params: list[Any] = [user_id]
+        order = 'ph.created_at DESC, ph.match_id DESC'
+        if after is not None:
+            query += ' AND ph.created_at <= ? AND (ph.created_at < ? OR ph.match_id < ?)'
+            params += [after[0], after[0], after[1]]
+        elif before is not None:
+            query += ' AND ph.created_at >= ? AND (ph.created_at > ? OR ph.match_id > ?)'
+            params += [before[0], before[0], before[1]]
+            order = 'ph.created_at ASC, ph.match_id ASC'
+        rows = self.db.execute(f'{query} ORDER BY {order} LIMIT {HISTORY_PAGE_SIZE}', params).fetchall()
+        if before is not None:
+            rows.reverse()
+        players: dict[str, list[DBMatchPlayer]] = {row['match_id']: [] for row in rows}
+        if players:
+            for player in self.db.execute(f'SELECT * FROM {TABLE_PREFIX}_match_players WHERE match_id IN ({",".join("?" * len(players))}) ORDER BY match_id, team, slot', list(players)):
+                players[player['match_id']].append(player)
+        return [decode_historical_match(row, players[row['match_id']]) for row in rows]
+
+
+    def get_rated_matches_count(self) -> int:
+        return self.db.execute(f'SELECT COUNT(*) FROM {TABLE_PREFIX}_matches_history WHERE mode_id = ? AND status = ?', (GameMode.Competitive.value, MatchStatusEnum.COMPLETE.value)).fetchone()[0]
+
+
+    def iter_rated_matches(self) -> Iterator[DBRatedMatchPlayer]:
+        # Players of completed competitive matches, oldest match first, read from matches_created_at_idx in batches
+        cursor = self.db.execute(f'SELECT mh.league_id, mp.match_id, mp.team, mp.placement, mp.user_id FROM {TABLE_PREFIX}_matches_history AS mh JOIN {TABLE_PREFIX}_match_players AS mp ON mp.match_id = mh.match_id WHERE mh.mode_id = ? AND mh.status = ? ORDER BY mh.created_at, mh.match_id, mp.team, mp.slot', (GameMode.Competitive.value, MatchStatusEnum.COMPLETE.value))
+        while rows := cursor.fetchmany(REPLAY_FETCH_SIZE):
+            yield from rows
+
+
+    def get_competitive_mmr(self) -> dict[tuple[int, int], int]:
+        return {(row[0], row[1]): row[2] for row in self.db.execute(f'SELECT league_id, user_id, mmr FROM {TABLE_PREFIX}_competitive_stats')}
+
+
+    def write_shadow_stats(self, ratings: dict[tuple[int, int], int], initial_mmr: int):
+        # Copy of the stats with MMR replaced, swapped in with swap_shadow_stats()
+        shadow = f'{TABLE_PREFIX}_competitive_stats_shadow'
+        self.db.execute(f'DROP TABLE IF EXISTS {shadow}')
+        self.db.execute(f'''
+            CREATE TABLE {shadow} (
+                user_id BIGINT NOT NULL REFERENCES {TABLE_PREFIX}_players(user_id) ON DELETE CASCADE,
+                league_id BIGINT NOT NULL REFERENCES {TABLE_PREFIX}_leagues(league_id) ON DELETE CASCADE,
+                won BIGINT DEFAULT 0,
+                lost BIGINT DEFAULT 0,
+                draw BIGINT DEFAULT 0,
+                kills BIGINT DEFAULT 0,
+                deaths BIGINT DEFAULT 0,
+                assists BIGINT DEFAULT 0,
+                mmr BIGINT DEFAULT 2000,
+                PRIMARY KEY (user_id, league_id)
+            ) WITHOUT ROWID'''
+        )
+        self.db.execute(f'INSERT INTO {shadow} SELECT user_id, league_id, won, lost, draw, kills, deaths, assists, ? FROM {TABLE_PREFIX}_competitive_stats', (initial_mmr,))
+        self.db.executemany(f'UPDATE {shadow} SET mmr = ? WHERE user_id = ? AND league_id = ?', ((mmr, user_id, league_id) for (league_id, user_id), mmr in ratings.items()))
+        self.db.commit()
+
+
+    def swap_shadow_stats(self):
+        self.db.execute('BEGIN')
+        try:
+            self.db.execute(f'DROP TABLE {TABLE_PREFIX}_competitive_stats')
+            self.db.execute(f'ALTER TABLE {TABLE_PREFIX}_competitive_stats_shadow RENAME TO {TABLE_PREFIX}_competitive_stats')
+        except:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+
+# LRU of player profiles by Discord ID, kept consistent by write-through from AsyncEvioDB
+class PlayerCache:
+
+    def __init__(self, size: int = PLAYER_CACHE_SIZE, ttl: float = PLAYER_CACHE_TTL) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.profiles: OrderedDict[int, tuple[float, PlayerProfile]] = OrderedDict()
+        # User ID -> Discord ID, stats updates only know user IDs
+        self.discord_ids: dict[int, int] = {}
+        # A profile loaded while a write was in flight might be stale, so it's not stored
+        self.generation = 0
+        self.writes_in_flight = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, discord_id: int) -> PlayerProfile | None:
+        entry = self.profiles.get(discord_id)
+        if entry is None or entry[0] < monotonic():
+            if entry is not None:
+                self.discard(discord_id)
+            self.misses += 1
+            return None
+        self.profiles.move_to_end(discord_id)
+        self.hits += 1
+        return entry[1]
+
+
+    def put(self, profile: PlayerProfile, generation: int):
+        if generation != self.generation or self.writes_in_flight:
+            return
+        discord_id = profile['discord_id']
+        self.profiles[discord_id] = (monotonic() + self.ttl, profile)
+        self.profiles.move_to_end(discord_id)
+        self.discord_ids[profile['user_id']] = discord_id
+        while len(self.profiles) > self.size:
+            _, (_, evicted) = self.profiles.popitem(last=False)
+            self.discord_ids.pop(evicted['user_id'], None)
+
+
+    def discard(self, discord_id: int):
+        entry = self.profiles.pop(discord_id, None)
+        if entry is not None:
+            self.discord_ids.pop(entry[1]['user_id'], None)
+
+
+    def get_by_user_id(self, user_id: int) -> PlayerProfile | None:
+        discord_id = self.discord_ids.get(user_id)
+        if discord_id is None:
+            return None
+        return self.profiles[discord_id][1]
+
+
+    def begin_write(self):
+        self.generation += 1
+        self.writes_in_flight += 1
+
+
+    def end_write(self):
+        self.generation += 1
+        self.writes_in_flight -= 1
+
+
+    def apply_stats(self, data: list[DBStatsChange]):
+        for change in data:
+            profile = self.get_by_user_id(change['user_id'])
+            if profile is None:
+                continue
+            stats = profile['stats'][change['league_id']]
+            for key in DBCompetitiveStats.__annotations__:
+                stats[key] += change[key]
+
+
+    def apply_settings(self, user_id: int, regions: list[int] | None, maps: list[int] | None):
+        profile = self.get_by_user_id(user_id)
+        if profile is None:
+            return
+        if regions is not None:
+            profile['settings']['regions'] = list(regions)
+        if maps is not None:
+            profile['settings']['maps'] = list(maps)
+
+
+class PlayerHistory:
+    # Decoded matches of a player, newest first. Loaded page by page as the player scrolls.
+
+    def __init__(self, user_id: int) -> None:
+        self.user_id = user_id
+        self.matches: list[HistoricalMatch] = []
+        self.complete = False
+
+
+# LRU of player histories by user ID. Dropped when the player finishes another match.
+class PlayerHistoryCache:
+
+    def __init__(self, size: int = PLAYER_HISTORY_CACHE_SIZE) -> None:
+        self.size = size
+        self.histories: OrderedDict[int, PlayerHistory] = OrderedDict()
+
+
+    def get(self, user_id: int) -> PlayerHistory:
+        history = self.histories.get(user_id)
+        if history is None:
+            history = self.histories[user_id] = PlayerHistory(user_id)
+            if len(self.histories) > self.size:
+                self.histories.popitem(last=False)
+        self.histories.move_to_end(user_id)
+        return history
+
+
+    def discard(self, user_id: int):
+        # Open history views keep their own reference, so they stay consistent
+        self.histories.pop(user_id, None)
+
+
+# Runs EvioDB queries off the event loop.
+# Writes are serialized on a dedicated writer thread, reads are spread over a pool of reader connections.
+class AsyncEvioDB:
+
+    def __init__(self, path: str, readers: int = DB_READERS) -> None:
+        self.path = path
+        self.local = threading.local()
+        self.connections: list[sqlite3.Connection] = []
+        self.connections_lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix='evio-db-writer', initializer=self.connect)
+        self.readers = ThreadPoolExecutor(readers, thread_name_prefix='evio-db-reader', initializer=self.connect)
+        # Write-behind journal. Entries are applied in order on the writer thread, so per-player ordering is kept.
+        # Every entry has its own future, so only the caller of a failed entry gets the error.
+        self.journal: list[tuple[Callable[..., None], tuple, asyncio.Future]] = []
+        self.journal_timer: asyncio.TimerHandle | None = None
+        self.flush_tasks: set[asyncio.Task] = set()
+        self.players = PlayerCache()
+        self.histories = PlayerHistoryCache()
+        self.leaderboards = Leaderboards(LEADERBOARD_PAGE_SIZE)
+
+
+    def connect(self):
+        db = connect(self.path)
+        with self.connections_lock:
+            self.connections.append(db)
+        self.local.db = EvioDB(db, init=False)
+
+
+    async def run(self, executor: ThreadPoolExecutor, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(executor, lambda: fn(self.local.db, *args, **kwargs))
+
+
+    async def read(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return await self.run(self.readers, fn, *args, **kwargs)
+
+
+    async def write(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return await self.run(self.writer, fn, *args, **kwargs)
+
+
+    async def journal_write(self, fn: Callable[..., None], *args):
+        loop = asyncio.get_running_loop()
+        if not self.journal:
+            self.journal_timer = loop.call_later(JOURNAL_FLUSH_INTERVAL, self.schedule_flush)
+        entry = loop.create_future()
+        self.journal.append((fn, args, entry))
+        if len(self.journal) >= JOURNAL_FLUSH_SIZE:
+            self.schedule_flush()
+        # Resolves once the batch containing this entry is committed
+        await asyncio.shield(entry)
+
+
+    def schedule_flush(self):
+        task = asyncio.ensure_future(self.flush())
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+
+    async def flush(self):
+        if not self.journal:
+            return
+        entries = self.journal
+        self.journal = []
+        self.journal_timer.cancel()
+        try:
+            errors = await self.write(EvioDB.apply_journal, [(fn, args) for fn, args, _ in entries])
+        except Exception as e:
+            # Commit itself failed, nothing of the batch was written
+            errors = [e] * len(entries)
+        for (_, _, entry), error in zip(entries, errors):
+            if error is None:
+                entry.set_result(None)
+            else:
+                entry.set_exception(error)
+
+
+    async def open(self):
+        await self.write(EvioDB.init)
+        self.leaderboards.load(await self.read(EvioDB.get_leaderboard_rows))
+
+
+    async def close(self):
+        await self.flush()
+        await self.write(lambda db: db.db.execute('PRAGMA optimize'))
+        self.writer.shutdown()
+        self.readers.shutdown()
+        for db in self.connections:
+            db.close()
+
+
+    async def get_player(self, user_id: int, *fields: str) -> DBPlayer | None:
+        return await self.read(EvioDB.get_player, user_id, *fields)
+
+
+    async def get_players(self, *fields: str) -> list[DBPlayer]:
+        return await self.read(EvioDB.get_players, *fields)
+
+
+    async def get_player_by_discord_id(self, discord_id: int, *fields: str) -> Optional[DBPlayer]:
+        return await self.read(EvioDB.get_player_by_discord_id, discord_id, *fields)
+
+
+    async def get_league_data(self, league_id: int, *fields: str) -> DBLeague:
+        return await self.read(EvioDB.get_league_data, league_id, *fields)
+
+
+    async def get_leagues(self, *fields: str) -> list[DBLeague]:
+        return await self.read(EvioDB.get_leagues, *fields)
+
+
+    async def get_player_profile(self, discord_id: int) -> PlayerProfile | None:
+        profile = self.players.get(discord_id)
+        if profile is not None:
+            return profile
+        generation = self.players.generation
+        profile = await self.read(EvioDB.get_player_profile, discord_id)
+        if profile is not None:
+            self.players.put(profile, generation)
+        return profile
+
+
+    async def get_member(self, discord_id: int, league_id: int) -> DBPlayerWithStats | None:
+        profile = await self.get_player_profile(discord_id)
+        if profile is None:
+            return None
+        return DBPlayerWithStats(user_id=profile['user_id'], name=profile['name'], discord_id=discord_id, **profile['stats'][league_id])
+
+
+    async def remove_player(self, discord_id: int):
+        self.players.begin_write()
+        try:
+            user_id = await self.write(EvioDB.remove_player, discord_id)
+            self.players.discard(discord_id)
+            if user_id is not None:
+                self.leaderboards.remove_player(user_id)
+        finally:
+            self.players.end_write()
+
+
+    async def register_player(self, user: EvioUserInfo, discord_id: int):
+        self.players.begin_write()
+        try:
+            await self.write(EvioDB.register_player, user, discord_id)
+            self.players.discard(discord_id)
+            self.leaderboards.add_player(await self.read(EvioDB.get_leaderboard_rows, user['uid'][0]['value']))
+        finally:
+            self.players.end_write()
+
+
+    async def update_player_registration(self, user_id: int, discord_id: int):
+        self.players.begin_write()
+        try:
+            await self.write(EvioDB.update_player_registration, user_id, discord_id)
+            self.players.discard(discord_id)
+            self.leaderboards.add_player(await self.read(EvioDB.get_leaderboard_rows, user_id))
+        finally:
+            self.players.end_write()
+
+
+    async def update_players_stats(self, data: list[DBStatsChange]):
+        self.players.begin_write()
+        try:
+            await self.journal_write(EvioDB.execute_update_players_stats, data)
+            self.players.apply_stats(data)
+            self.leaderboards.apply_stats(data)
+        finally:
+            self.players.end_write()
+
+
+    async def insert_match(self, data: MatchData, user_ids: list[int]):
+        await self.journal_write(EvioDB.execute_insert_match, data, user_ids)
+        for user_id in user_ids:
+            self.histories.discard(user_id)
+
+
+    async def save_active_lobby(self, lobby_key: str, state: str):
+        # Saved on every lobby change, so snapshots are batched. Saves and deletes of a lobby stay in order.
+        await self.journal_write(EvioDB.execute_save_active_lobby, lobby_key, state)
+
+
+    async def delete_active_lobby(self, lobby_key: str):
+        # Journaled so it lands in the same transaction as the match result
+        await self.journal_write(EvioDB.execute_delete_active_lobby, lobby_key)
+
+
+    async def get_active_lobbies(self) -> list[DBActiveLobby]:
+        return await self.read(EvioDB.get_active_lobbies)
+
+
+    async def get_player_settings(self, user_id: int, *fields: str) -> dict | None:
+        return await self.read(EvioDB.get_player_settings, user_id, *fields)
+
+
+    async def set_player_settings(self, user_id: int, *, regions: list[int] | None = None, maps: list[int] | None = None):
+        self.players.begin_write()
+        try:
+            await self.write(EvioDB.set_player_settings, user_id, regions=regions, maps=maps)
+            self.players.apply_settings(user_id, regions, maps)
+        finally:
+            self.players.end_write()
+
+
+    async def get_player_match_history(self, user_id: int, *, after: HistoryCursor | None = None, before: HistoryCursor | None = None) -> list[HistoricalMatch]:
+        return await self.read(EvioDB.get_player_match_history, user_id, after=after, before=before)
+
+
+    async def get_player_history(self, user_id: int) -> PlayerHistory:
+        history = self.histories.get(user_id)
+        await self.load_player_history(history, 1)
+        return history
+
+
+    async def load_player_history(self, history: PlayerHistory, count: int):
+        # Loads pages until there are at least `count` matches or the history ends
+        while len(history.matches) < count and not history.complete:
+            loaded = len(history.matches)
+            last = history.matches[-1] if loaded else None
+            matches = await self.get_player_match_history(history.user_id, after=(last['created_at'], last['match_id']) if last is not None else None)
+            if len(history.matches) != loaded:
+                # Another view loaded the same page meanwhile
+                continue
+            history.matches.extend(matches)
+            history.complete = len(matches) < HISTORY_PAGE_SIZE
+
+
+# Leagues almost never change, so they're loaded once and kept parsed in memory.
+# Must be reloaded explicitly after editing the leagues table.
+class LeagueRegistry:
+
+    def __init__(self, db: AsyncEvioDB) -> None:
+        self.db = db
+        self.leagues: dict[League, LeagueInfo] = {}
+
+
+    def __getitem__(self, league: League) -> LeagueInfo:
+        return self.leagues[league]
+
+
+    async def load(self):
+        rows = await self.db.get_leagues('league_id', 'name', 'team_size', 'match_config')
+        self.leagues = {
+            League(row['league_id']): LeagueInfo(name=row['name'], team_size=row['team_size'], match_config=loads(row['match_config']))
+            for row in rows
+        }
+
+
+    async def invalidate(self):
+        await self.load()
@@ -0,0 +1,42 @@
+import re
+
+SCAN_CHUNK_SIZE = 16 * 1024
+# Longest possible match of any pattern. Patterns must be delimited on both ends (e.g. by quotes),
+# so a match can't be cut short by a chunk boundary.
+MAX_MATCH_LENGTH = 64
+
+
+class ChunkExtractor:
+    # Incrementally matches named patterns over a response body fed in chunks
+
+    def __init__(self, patterns: dict[str, bytes], limits: dict[str, int] | None = None) -> None:
+        # Each pattern has a single named group with its own name, e.g. rb'href="/user/(?P<uid>\d+)"'
+        self.regex = re.compile(b'|'.join(patterns.values()))
+        self.names = tuple(patterns)
+        # Name -> number of matches after which the pattern is no longer needed
+        self.limits = limits or {}
+        self.reset()
+
+
+    def reset(self):
+        self.results: dict[str, list[bytes]] = {name: [] for name in self.names}
+        self.tail = b''
+
+
+    @property
+    def done(self) -> bool:
+        return bool(self.limits) and all(len(self.results[name]) >= limit for name, limit in self.limits.items())
+
+
+    def feed(self, chunk: bytes) -> bool:
+        buf = self.tail + chunk
+        end = 0
+        for m in self.regex.finditer(buf):
+            name = m.lastgroup
+            self.results[name].append(m[name])
+            end = m.end()
+            if self.done:
+                return True
+        # Only keep what could be the start of a match crossing into the next chunk
+        self.tail = buf[max(end, len(buf) - MAX_MATCH_LENGTH):]
+        return False
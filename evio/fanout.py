@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from typing import Any, Iterable
+from discord import Message, NotFound
+
+FANOUT_CONCURRENCY = 20
+# Discord allows roughly 5 message edits per 5 seconds per channel
+CHANNEL_BURST = 5
+CHANNEL_WINDOW = 5 # Seconds
+
+
+class TokenBucket:
+
+    def __init__(self, burst: int = CHANNEL_BURST, window: float = CHANNEL_WINDOW) -> None:
+        self.burst = burst
+        self.rate = burst / window
+        self.tokens = float(burst)
+        self.updated_at = 0.0
+
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class PendingUpdate:
+
+    def __init__(self, message: Message, action: str, kwargs: dict[str, Any]) -> None:
+        self.message = message
+        self.action = action # 'edit' or 'delete'
+        self.kwargs = kwargs
+        self.future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+
+class MessageFanout:
+    # Sends message edits and deletions concurrently. Updates of the same message are sent in order, and updates
+    # queued behind one that is still being sent are collapsed into a single request.
+
+    def __init__(self, concurrency: int = FANOUT_CONCURRENCY) -> None:
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.buckets: dict[int, TokenBucket] = {}
+        # Message ID -> update that hasn't been sent yet
+        self.pending: dict[int, PendingUpdate] = {}
+        # Message ID -> last update being sent or waiting to be sent
+        self.last: dict[int, PendingUpdate] = {}
+        # asyncio only keeps weak references to tasks, so running sends are kept here
+        self.tasks: set[asyncio.Task] = set()
+        self.sent = 0
+        self.collapsed = 0
+        self.failed = 0
+
+
+    def edit(self, message: Message, **kwargs) -> asyncio.Future[None]:
+        return self.submit(message, 'edit', kwargs)
+
+
+    def delete(self, message: Message) -> asyncio.Future[None]:
+        return self.submit(message, 'delete', {})
+
+
+    def broadcast(self, messages: Iterable[Message], **kwargs) -> asyncio.Future:
+        return asyncio.gather(*(self.edit(message, **kwargs) for message in messages))
+
+
+    def delete_all(self, messages: Iterable[Message]) -> asyncio.Future:
+        return asyncio.gather(*(self.delete(message) for message in messages))
+
+
+    async def drain(self):
+        # Waits for everything submitted so far to be sent, including updates whose callers gave up on them
+        futures = [update.future for update in self.last.values()]
+        if futures:
+            await asyncio.wait(futures)
+
+
+    def submit(self, message: Message, action: str, kwargs: dict[str, Any]) -> asyncio.Future[None]:
+        update = self.pending.get(message.id)
+        if update is not None:
+            self.collapsed += 1
+            if action == 'delete' or update.action == 'delete':
+                # Nothing to edit once the message is gone
+                update.action = 'delete'
+                update.kwargs = {}
+            else:
+                update.kwargs.update(kwargs)
+            return update.future
+
+        update = PendingUpdate(message, action, dict(kwargs))
+        previous = self.last.get(message.id)
+        self.pending[message.id] = update
+        self.last[message.id] = update
+        task = asyncio.ensure_future(self.send(update, previous))
+        self.tasks.add(task)
+        task.add_done_callback(self.done)
+        return update.future
+
+
+    def done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f'Message update task failed: {task.exception()!r}')
+
+
+    def get_bucket(self, message: Message) -> TokenBucket:
+        channel = getattr(message, 'channel', None)
+        channel_id = channel.id if channel is not None else message.id
+        if channel_id not in self.buckets:
+            self.buckets[channel_id] = TokenBucket()
+        return self.buckets[channel_id]
+
+
+    async def send(self, update: PendingUpdate, previous: PendingUpdate | None):
+        message_id = update.message.id
+        try:
+            if previous is not None:
+                # Doesn't raise if a caller cancelled the previous update's future
+                await asyncio.wait((previous.future,))
+            async with self.semaphore:
+                await self.get_bucket(update.message).acquire()
+                # Updates submitted from now on are sent after this one
+                del self.pending[message_id]
+                try:
+                    if update.action == 'delete':
+                        await update.message.delete()
+                    else:
+                        await update.message.edit(**update.kwargs)
+                    self.sent += 1
+                except Exception as e:
+                    self.report(update, e)
+        finally:
+            if self.pending.get(message_id) is update:
+                del self.pending[message_id]
+            if self.last.get(message_id) is update:
+                del self.last[message_id]
+            if not update.future.done():
+                update.future.set_result(None)
+
+
+    def report(self, update: PendingUpdate, e: Exception):
+        self.failed += 1
+        if isinstance(e, NotFound):
+            # Message was deleted or the interaction token expired
+            logging.warning(f'Message {update.message.id} no longer exists, {update.action} skipped.')
+            return
+        logging.error(f'Failed to {update.action} message {update.message.id}: {e!r}')
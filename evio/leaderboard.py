@@ -0,0 +1,192 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Iterable, TypedDict
+
+# Counters added up by stats updates
+STAT_FIELDS = ('won', 'lost', 'draw', 'kills', 'deaths', 'assists', 'mmr')
+RENDERED_PAGES_SIZE = 500
+
+# Leaderboard order, MMR descending and then user ID
+LeaderboardKey = tuple[int, int]
+
+
+class LeaderboardRow(TypedDict):
+    league_id: int
+    user_id: int
+    name: str
+    won: int
+    lost: int
+    draw: int
+    kills: int
+    deaths: int
+    assists: int
+    mmr: int
+
+
+def get_key(row: LeaderboardRow) -> LeaderboardKey:
+    return (-row['mmr'], row['user_id'])
+
+
+class Leaderboard:
+    # Registered players of one league in leaderboard order. Keys are kept in a sorted list, so rank and page
+    # lookups are a bisect and a slice.
+
+    def __init__(self, page_size: int) -> None:
+        self.page_size = page_size
+        self.keys: list[LeaderboardKey] = []
+        self.rows: dict[int, LeaderboardRow] = {}
+        # Bumped on every change of the order or of a listed row
+        self.version = 0
+        # Page -> version of its last change. Pages that are missing haven't changed since the last load.
+        self.page_versions: dict[int, int] = {}
+        self.loaded_version = 0
+
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.rows
+
+
+    def touch(self, first: int, last: int):
+        # Marks pages with ranks from first to last as changed
+        self.version += 1
+        for page in range(first // self.page_size, last // self.page_size + 1):
+            self.page_versions[page] = self.version
+
+
+    def page_version(self, page: int) -> int:
+        return self.page_versions.get(page, self.loaded_version)
+
+
+    def load(self, rows: Iterable[LeaderboardRow]):
+        self.rows = {row['user_id']: row for row in rows}
+        self.keys = sorted(get_key(row) for row in self.rows.values())
+        self.version += 1
+        self.loaded_version = self.version
+        self.page_versions.clear()
+
+
+    def add(self, row: LeaderboardRow):
+        self.remove(row['user_id'])
+        self.rows[row['user_id']] = row
+        insort(self.keys, get_key(row))
+        # Everyone below moves one rank down
+        self.touch(self.rank(row['user_id']), len(self.keys) - 1)
+
+
+    def remove(self, user_id: int):
+        row = self.rows.pop(user_id, None)
+        if row is None:
+            return
+        rank = bisect_left(self.keys, get_key(row))
+        del self.keys[rank]
+        self.touch(rank, len(self.keys))
+
+
+    def apply(self, change: dict[str, int]):
+        row = self.rows.get(change['user_id'])
+        if row is None:
+            return
+        old_rank = bisect_left(self.keys, get_key(row))
+        if change['mmr']:
+            del self.keys[old_rank]
+        for field in STAT_FIELDS:
+            row[field] += change[field]
+        if change['mmr']:
+            insort(self.keys, get_key(row))
+        # Only players between the old and the new rank move
+        new_rank = self.rank(row['user_id'])
+        self.touch(min(old_rank, new_rank), max(old_rank, new_rank))
+
+
+    def rank(self, user_id: int) -> int | None:
+        # Zero-based
+        row = self.rows.get(user_id)
+        if row is None:
+            return None
+        return bisect_left(self.keys, get_key(row))
+
+
+    def pages(self) -> int:
+        return -(-len(self.keys) // self.page_size)
+
+
+    def page(self, page: int) -> list[LeaderboardRow]:
+        return [self.rows[user_id] for _, user_id in self.keys[page * self.page_size:(page + 1) * self.page_size]]
+
+
+    def around(self, user_id: int, count: int) -> tuple[int, list[LeaderboardRow]]:
+        # Up to `count` players above and below the player, with the rank of the first one
+        rank = self.rank(user_id)
+        if rank is None:
+            return 0, []
+        start = max(rank - count, 0)
+        return start, [self.rows[user_id] for _, user_id in self.keys[start:rank + count + 1]]
+
+
+class Leaderboards:
+    # Materialized leaderboards of every league. Loaded once and kept up to date by AsyncEvioDB writes.
+
+    def __init__(self, page_size: int) -> None:
+        self.page_size = page_size
+        self.leagues: dict[int, Leaderboard] = {}
+
+
+    def __getitem__(self, league_id: int) -> Leaderboard:
+        if league_id not in self.leagues:
+            self.leagues[league_id] = Leaderboard(self.page_size)
+        return self.leagues[league_id]
+
+
+    def load(self, rows: Iterable[LeaderboardRow]):
+        by_league: dict[int, list[LeaderboardRow]] = {}
+        for row in rows:
+            by_league.setdefault(row['league_id'], []).append(row)
+        for league_id, league_rows in by_league.items():
+            self[league_id].load(league_rows)
+
+
+    def add_player(self, rows: Iterable[LeaderboardRow]):
+        for row in rows:
+            self[row['league_id']].add(row)
+
+
+    def remove_player(self, user_id: int):
+        for leaderboard in self.leagues.values():
+            leaderboard.remove(user_id)
+
+
+    def apply_stats(self, changes: Iterable[dict[str, int]]):
+        for change in changes:
+            self[change['league_id']].apply(change)
+
+
+class RenderedPages:
+    # Rendered leaderboard pages shared by all leaderboard views, keyed by (league ID, page, page version).
+    # Outdated versions are never looked up again and fall out of the LRU.
+
+    def __init__(self, size: int = RENDERED_PAGES_SIZE) -> None:
+        self.size = size
+        self.pages: OrderedDict[tuple[int, int, int], str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key: tuple[int, int, int]) -> str | None:
+        page = self.pages.get(key)
+        if page is None:
+            self.misses += 1
+            return None
+        self.pages.move_to_end(key)
+        self.hits += 1
+        return page
+
+
+    def put(self, key: tuple[int, int, int], page: str):
+        self.pages[key] = page
+        self.pages.move_to_end(key)
+        if len(self.pages) > self.size:
+            self.pages.popitem(last=False)
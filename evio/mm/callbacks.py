@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from traceback import format_exc
+from typing import TYPE_CHECKING
+
+from evio.api import CreatedMatchInfo
+from evio.transport import LatencyHistogram
+
+if TYPE_CHECKING:
+    from custom_types import MatchmakingBot
+
+CALLBACK_WORKERS = 4
+CALLBACK_QUEUE_SIZE = 1000
+# Match IDs remembered to drop repeated callbacks
+SEEN_MATCHES_SIZE = 10000
+
+
+def is_valid_match_info(match: CreatedMatchInfo) -> bool:
+    if not isinstance(match, dict) or not isinstance(match.get('matchId'), str) or not isinstance(match.get('status'), str):
+        return False
+    teams = match.get('teams')
+    if not isinstance(teams, list) or len(teams) < 2:
+        return False
+    return all(isinstance(team, dict) and isinstance(team.get('players'), list) for team in teams)
+
+
+class MatchCallbackProcessor:
+    # Callbacks are acknowledged right away and processed by background workers
+
+    def __init__(self, bot: 'MatchmakingBot', workers: int = CALLBACK_WORKERS) -> None:
+        self.bot = bot
+        self.workers = workers
+        self.queue: asyncio.Queue[CreatedMatchInfo] = asyncio.Queue(CALLBACK_QUEUE_SIZE)
+        self.seen: OrderedDict[str, None] = OrderedDict()
+        self.tasks: list[asyncio.Task] = []
+        self.duplicates = 0
+        # Time spent in the request handler
+        self.ack_latency = LatencyHistogram()
+
+
+    def start(self):
+        self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+
+    async def join(self):
+        # Waits for queued callbacks to be processed
+        await self.queue.join()
+
+
+    async def stop(self):
+        await self.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+    def submit(self, match: CreatedMatchInfo) -> bool:
+        # Returns False if the match info is invalid, or if the queue is full and the callback should be retried later.
+        # Polled results are submitted too, so they're checked here rather than by the callback handler.
+        if not is_valid_match_info(match):
+            logging.warning(f'Invalid match info: {match}')
+            return False
+        match_id = match['matchId']
+        if match_id in self.seen:
+            self.duplicates += 1
+            return True
+        if match_id not in self.bot.matches:
+            # Matches don't persist between restarts
+            return True
+        try:
+            self.queue.put_nowait(match)
+        except asyncio.QueueFull:
+            return False
+        self.seen[match_id] = None
+        if len(self.seen) > SEEN_MATCHES_SIZE:
+            self.seen.popitem(last=False)
+        return True
+
+
+    async def work(self):
+        while True:
+            match = await self.queue.get()
+            try:
+                await self.process(match)
+            except:
+                logging.error(format_exc())
+            finally:
+                self.queue.task_done()
+
+
+    async def process(self, match: CreatedMatchInfo):
+        match_id = match['matchId']
+        # Taken out first so the poller doesn't abandon the match while it's being finished
+        async with self.bot.matches_lock:
+            m = self.bot.matches.pop(match_id, None)
+        if m is None:
+            return
+        self.bot.match_poller.unschedule(match_id)
+
+        try:
+            res = await m.finish(match)
+        except:
+            # To avoid spam in case there're any issues with the match
+            logging.error(format_exc())
+            m.release()
+            await m.forget()
+            self.bot.fanout.broadcast(m.user_messages.values(), content=f'Something went wrong with the match. Please notify @emojikage about the issue.', view=None)
+            return
+        m.release()
+        await m.forget()
+
+        self.bot.fanout.broadcast(m.user_messages.values(), content=f'Match finished! {res}', embed=m.render_info(True, False), view=None)
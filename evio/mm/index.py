@@ -0,0 +1,91 @@
+from bisect import bisect_left, insort
+from random import shuffle
+
+from evio.db import League, GameMode, MatchmakingRegionEnum
+from evio.mm.lobby import MatchmakingLobby
+from evio.mm.rating import MMR_DIFF_THRESHOLD
+
+# (league, mode, region, map nid)
+BucketKey = tuple[League, GameMode, MatchmakingRegionEnum, int]
+# (reference MMR, lobby key, team number)
+Slot = tuple[int, str, int]
+
+
+def get_slot_mmr(lobby: MatchmakingLobby, team: int) -> int:
+    # Team average is the primary constraint. Empty teams accept anyone, so fall back to the enemy team average.
+    team_avg_mmr = lobby.teams[team]['avg_mmr']
+    if team_avg_mmr > 0:
+        return team_avg_mmr
+    return max(lobby.teams[int(not team)]['avg_mmr'], 0)
+
+
+class LobbyIndex:
+
+    def __init__(self, mmr_threshold: int = MMR_DIFF_THRESHOLD) -> None:
+        self.mmr_threshold = mmr_threshold
+        # Open team slots per bucket, sorted by reference MMR
+        self.buckets: dict[BucketKey, list[Slot]] = {}
+        self.lobbies: dict[str, MatchmakingLobby] = {}
+        # Reverse lookup to drop lobby slots without scanning buckets
+        self.slots: dict[str, tuple[BucketKey, list[Slot]]] = {}
+
+
+    def __len__(self) -> int:
+        return len(self.lobbies)
+
+
+    def update(self, key: str, lobby: MatchmakingLobby):
+        self.remove(key)
+        bucket_key = (lobby.league, lobby.mode, lobby.region, lobby.map['nid'])
+        bucket = self.buckets.setdefault(bucket_key, [])
+        slots: list[Slot] = []
+        for team in range(2):
+            if not lobby.is_team_joinable(team):
+                continue
+            slot = (get_slot_mmr(lobby, team), key, team)
+            insort(bucket, slot)
+            slots.append(slot)
+        self.lobbies[key] = lobby
+        self.slots[key] = (bucket_key, slots)
+
+
+    def remove(self, key: str):
+        if key not in self.slots:
+            return
+        bucket_key, slots = self.slots.pop(key)
+        del self.lobbies[key]
+        bucket = self.buckets[bucket_key]
+        for slot in slots:
+            del bucket[bisect_left(bucket, slot)]
+        if not bucket:
+            del self.buckets[bucket_key]
+
+
+    def is_mmr_acceptable(self, member_mmr: int, avg_mmr: int) -> bool:
+        diff = member_mmr - avg_mmr
+        return avg_mmr <= 0 or -self.mmr_threshold <= diff <= self.mmr_threshold
+
+
+    def find(self, league: League, mode: GameMode, region: MatchmakingRegionEnum, map_pool: list[int], member_mmr: int) -> tuple[str, int] | None:
+        map_pool = list(map_pool)
+        shuffle(map_pool)
+        for nid in map_pool:
+            bucket = self.buckets.get((league, mode, region, nid))
+            if not bucket:
+                continue
+            if mode is not GameMode.Competitive:
+                _, key, team = bucket[0]
+                return key, team
+            # Slots without any MMR constraint are kept at the head of the bucket
+            candidates = []
+            if bucket[0][0] <= 0:
+                candidates.append(bucket[0])
+            lo = bisect_left(bucket, (max(member_mmr - self.mmr_threshold, 1),))
+            hi = bisect_left(bucket, (member_mmr + self.mmr_threshold + 1,))
+            candidates += bucket[lo:hi]
+            for _, key, team in candidates:
+                lobby = self.lobbies[key]
+                if self.is_mmr_acceptable(member_mmr, lobby.teams[team]['avg_mmr']) \
+                    and self.is_mmr_acceptable(member_mmr, lobby.teams[int(not team)]['avg_mmr']):
+                    return key, team
+        return None
@@ -1,40 +1,15 @@
 import logging
 from abc import abstractmethod, ABC
-from json import loads
 from discord import Embed, Color, Message, User
 from typing import Any, TypedDict
 from datetime import datetime
+from uuid import uuid4
 
 from evio.api import EvioMap, EvioApiClient, MatchmakingMatchInfoRequest, MatchmakingTeamInfo, MatchmakingDatacenter, MatchmakingPlayerInfo, CreatedMatchInfo
-from evio.db import EvioDB, DBStatsChange, DBBlobTeamInfo, DBBlobPlayerInfo, League, GameMode, MatchData, DBPlayerWithStats, MatchmakingRegionEnum, MatchStatusEnum
-
-# If I want 2-step threshold, then I need additional value that will be used
-MMR_DIFF_THRESHOLD = 500
-# MMR_DIMINISHING_THRESHOLD = MMR_DIFF_THRESHOLD * 2
-ADDITIONAL_MMR_RATE = 20
-# DIMINISHING_MMR_RATE = 10
-BASE_MMR_RATE = 30 # 10 points per match outcome
-
-
-def map_value(x: float, in_min: float, in_max: float, out_min: float, out_max: float) -> float:
-    return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
-
-
-def calc_mmr_bonus(mmr_diff: int) -> float:
-    return min(ADDITIONAL_MMR_RATE, map_value(mmr_diff, 0, MMR_DIFF_THRESHOLD, 0, ADDITIONAL_MMR_RATE))
-
-
-def get_mmr_bonus(diff: float, won: bool) -> int:
-    if diff < -MMR_DIFF_THRESHOLD or diff > MMR_DIFF_THRESHOLD:
-        return -ADDITIONAL_MMR_RATE
-    elif diff < 0 and not won or diff > 0 and won:
-        return -round(calc_mmr_bonus(abs(diff)))
-    return round(calc_mmr_bonus(abs(diff)))
-
-
-def get_rating_diff(player_mmr: int, enemy_avg_mmr: int) -> int:
-    return player_mmr - enemy_avg_mmr
-
+from evio.codec import dumps
+from evio.db import AsyncEvioDB, LeagueInfo, DBStatsChange, DBBlobTeamInfo, DBBlobPlayerInfo, League, GameMode, MatchData, DBPlayerWithStats, MatchmakingRegionEnum, MatchStatusEnum
+from evio.mm.players import PlayerIndex, PlayerState
+from evio.mm.rating import get_rating_changes
 
 MAPS_POOL = [
     232, 724, 698,
@@ -71,6 +46,24 @@ class LobbyTeamInfo(TypedDict):
     players: dict[int, LobbyPlayerInfo]
 
 
+# Everything needed to bring a lobby or a running match back after a restart
+class LobbySnapshot(TypedDict):
+    kind: str # Lobby class name
+    key: str
+    match_id: str | None
+    league: int
+    mode: int
+    region: int
+    map: EvioMap
+    match_config: dict
+    teams: list[LobbyTeamInfo] # NOTE: Player IDs become str keys in JSON
+    discord_player_map: dict[int, dict[str, Any]] # Same here
+    creator_id: int
+    messages: dict[int, tuple[int, int]] # Discord ID -> (channel ID, message ID)
+    created_at: str
+    started_at: str | None
+
+
 def get_avg_team_mmr(players: list[LobbyPlayerInfo]) -> int:
     if not len(players):
         return 0
@@ -79,14 +72,17 @@ def get_avg_team_mmr(players: list[LobbyPlayerInfo]) -> int:
 
 class AbstractLobby(ABC):
 
-    def __init__(self, api: EvioApiClient, db: EvioDB, map: EvioMap, league: League, mode: GameMode, callback_url: str, creator: User) -> None:
+    def __init__(self, api: EvioApiClient, db: AsyncEvioDB, map: EvioMap, league: League, league_data: LeagueInfo, mode: GameMode, callback_url: str, creator: User, player_index: PlayerIndex) -> None:
         self.db = db
         self.api = api
+        self.player_index = player_index
+        self.key = str(uuid4())
 
         self.creator = creator
         self.callback_url = callback_url
-        self.league_data = self.db.get_league_data(league.value, 'match_config', 'team_size')
-        self.match_config: dict = loads(self.league_data['match_config'])
+        self.league_data = league_data
+        # Custom lobbies can be reconfigured, so keep a copy
+        self.match_config: dict = dict(self.league_data['match_config'])
         self.map = map
         self.region = MatchmakingRegionEnum.AMSTERDAM
 
@@ -106,6 +102,59 @@ class AbstractLobby(ABC):
         self.created_at = datetime.utcnow()
         self.started_at: datetime | None = None
         self.winner: int | None = None
+        # Whether a snapshot of the lobby is stored in the DB
+        self.persisted = False
+
+
+    @classmethod
+    def from_snapshot(cls, snapshot: LobbySnapshot, api: EvioApiClient, db: AsyncEvioDB, league_data: LeagueInfo, callback_url: str, creator: User, player_index: PlayerIndex) -> 'AbstractLobby':
+        # Messages are re-attached by the caller
+        lobby = cls(api, db, snapshot['map'], League(snapshot['league']), league_data, GameMode(snapshot['mode']), callback_url, creator, player_index)
+        lobby.key = snapshot['key']
+        lobby.match_id = snapshot['match_id']
+        lobby.region = MatchmakingRegionEnum(snapshot['region'])
+        lobby.match_config = snapshot['match_config']
+        lobby.teams = tuple({**team, 'players': {int(user_id): player for user_id, player in team['players'].items()}} for team in snapshot['teams'])
+        lobby.discord_player_map = {int(discord_id): p for discord_id, p in snapshot['discord_player_map'].items()}
+        lobby.created_at = datetime.fromisoformat(snapshot['created_at'])
+        lobby.started_at = datetime.fromisoformat(snapshot['started_at']) if snapshot['started_at'] else None
+        lobby.persisted = True
+        if lobby.match_id is None:
+            player_index.move(lobby.discord_player_map, lobby.key, PlayerState.LOBBY)
+        else:
+            lobby.promote()
+        return lobby
+
+
+    def snapshot(self) -> LobbySnapshot:
+        return LobbySnapshot(
+            kind=type(self).__name__,
+            key=self.key,
+            match_id=self.match_id,
+            league=self.league.value,
+            mode=self.mode.value,
+            region=self.region.value,
+            map=self.map,
+            match_config=self.match_config,
+            teams=list(self.teams),
+            discord_player_map=self.discord_player_map,
+            creator_id=self.creator.id,
+            messages={discord_id: (msg.channel.id, msg.id) for discord_id, msg in self.user_messages.items()},
+            created_at=self.created_at.isoformat(),
+            started_at=self.started_at.isoformat() if self.started_at else None
+        )
+
+
+    async def persist(self):
+        # Set before the save commits, so a forget() that follows is never skipped
+        self.persisted = True
+        await self.db.save_active_lobby(self.key, dumps(self.snapshot()))
+
+
+    async def forget(self):
+        if self.persisted:
+            await self.db.delete_active_lobby(self.key)
+            self.persisted = False
 
 
     def join(self, team_number: int, member: DBPlayerWithStats, discord_id: int) -> str | None:
@@ -119,6 +168,7 @@ class AbstractLobby(ABC):
         user_id = member['user_id']
         players[user_id] = LobbyPlayerInfo(name=member['name'], mvp_count=0, mmr=member['mmr'])
         self.discord_player_map[discord_id] = { 'user_id': user_id, 'team': team_number }
+        self.player_index.add(discord_id, self.key, PlayerState.LOBBY)
         team['avg_mmr'] = get_avg_team_mmr(players.values())
 
 
@@ -126,8 +176,23 @@ class AbstractLobby(ABC):
         if discord_id not in self.discord_player_map:
             return 'You are not present in any team.'
         p = self.discord_player_map[discord_id]
-        del self.teams[p['team']]['players'][p['user_id']]
+        team = self.teams[p['team']]
+        del team['players'][p['user_id']]
         del self.discord_player_map[discord_id]
+        self.player_index.discard(discord_id, self.key)
+        team['avg_mmr'] = get_avg_team_mmr(team['players'].values())
+
+
+    def promote(self):
+        # Lobby -> match transition. Players are now looked up by match ID.
+        self.player_index.move(self.discord_player_map, self.match_id, PlayerState.MATCH)
+
+
+    def release(self):
+        # Lobby was dropped or match is over. Players are free to join other lobbies.
+        key = self.key if self.match_id is None else self.match_id
+        for discord_id in self.discord_player_map:
+            self.player_index.discard(discord_id, key)
 
 
     def is_full(self) -> bool:
@@ -196,8 +261,8 @@ class AbstractLobby(ABC):
         self.winner = None
         return match_id
 
-    def cancel(self):
-        self.db.insert_match(
+    async def cancel(self):
+        await self.db.insert_match(
             MatchData(
                 match_id=self.match_id,
                 league_id=self.league.value,
@@ -207,8 +272,8 @@ class AbstractLobby(ABC):
                 teams=[
                     DBBlobTeamInfo(
                         players=[
-                            DBBlobPlayerInfo(name=player['name'])
-                            for player in team['players'].values()
+                            DBBlobPlayerInfo(user_id=user_id, name=player['name'])
+                            for user_id, player in team['players'].items()
                         ],
                         # placement=None
                     )
@@ -222,7 +287,19 @@ class AbstractLobby(ABC):
         )
 
 
-    def finish(self, data: CreatedMatchInfo) -> str | None:
+    def get_rating_changes(self, teams: list[MatchmakingTeamInfo]) -> dict[int, int]:
+        # User ID -> MMR change, for every lobby player at once. Team averages are the ones from before the match.
+        user_ids, mmr, team_numbers, placements = [], [], [], []
+        for i, team in enumerate(self.teams[:2]):
+            for user_id, player in team['players'].items():
+                user_ids.append(user_id)
+                mmr.append(player['mmr'])
+                team_numbers.append(i)
+                placements.append(teams[i]['placement'])
+        return dict(zip(user_ids, get_rating_changes(mmr, team_numbers, placements)))
+
+
+    async def finish(self, data: CreatedMatchInfo) -> str | None:
         status = data['status']
 
         if status != 'complete':
@@ -236,6 +313,7 @@ class AbstractLobby(ABC):
         self.winner = None if draw else winner
         team_match_info: list[DBBlobTeamInfo] = []
         changes: list[DBStatsChange] = []
+        mmr_changes = self.get_rating_changes(teams) if self.mode is GameMode.Competitive and not draw else {}
         # TODO: It's potentially dangerous to iterate over teams received from ev.io
         # In case a player was not included in the stats for some reason, his stats won't be taken into account
         for i, team in enumerate(teams[:2]):
@@ -244,7 +322,6 @@ class AbstractLobby(ABC):
             placement = team['placement']
             players: list[DBBlobPlayerInfo] = []
             won = not placement
-            sign = 1 if won else -1
             # mvp = max(teams[winner]['players'], key=lambda x: x['stats']['score'])
             # self.teams[winner]['players'][mvp['account']]['mvp_count'] += 1
             for player in team['players']:
@@ -270,14 +347,13 @@ class AbstractLobby(ABC):
                 )
 
                 player_info = DBBlobPlayerInfo(
+                    user_id=user_id,
                     name=lobby_player['name'],
                     **kda
                 )
 
                 if self.mode is GameMode.Competitive and not draw:
-                    diff = get_rating_diff(lobby_player['mmr'], enemy_team_avg_mmr)
-                    bonus = get_mmr_bonus(diff, won)
-                    mmr_change = (BASE_MMR_RATE + bonus) * sign
+                    mmr_change = mmr_changes[user_id]
                     logging.info(f'{lobby_player["name"]} / PLACEMENT: {placement} / MMR: {lobby_player["mmr"]} / ENEMY AVG MMR: {enemy_team_avg_mmr} / CHANGE: {mmr_change}')
                     # TODO: Need to avoid making player MMR below zero
                     lobby_player['mmr'] += mmr_change
@@ -293,7 +369,7 @@ class AbstractLobby(ABC):
             for team in self.teams:
                 team['avg_mmr'] = get_avg_team_mmr(team['players'].values())
 
-        self.db.update_players_stats(changes)
+        await self.db.update_players_stats(changes)
 
         if not draw:
             winner = teams[0]['placement'] > teams[1]['placement'] # True (1) - Red, False (0) - Blue
@@ -302,7 +378,7 @@ class AbstractLobby(ABC):
         else:
             result = 'Draw!'
 
-        self.db.insert_match(
+        await self.db.insert_match(
             MatchData(
                 match_id=self.match_id,
                 league_id=self.league.value,
@@ -322,8 +398,8 @@ class AbstractLobby(ABC):
 
 class MatchmakingLobby(AbstractLobby):
 
-    def __init__(self, api: EvioApiClient, db: EvioDB, map: EvioMap, league: League, mode: GameMode, callback_url: str, creator: User) -> None:
-        super().__init__(api, db, map, league, mode, callback_url, creator)
+    def __init__(self, api: EvioApiClient, db: AsyncEvioDB, map: EvioMap, league: League, league_data: LeagueInfo, mode: GameMode, callback_url: str, creator: User, player_index: PlayerIndex) -> None:
+        super().__init__(api, db, map, league, league_data, mode, callback_url, creator, player_index)
 
 
     # TODO: Probably needs to be handled by states
@@ -356,8 +432,8 @@ class MatchmakingLobby(AbstractLobby):
 
 class CustomLobby(AbstractLobby):
 
-    def __init__(self, api: EvioApiClient, db: EvioDB, map: EvioMap, league: League, mode: GameMode, callback_url: str, creator: User) -> None:
-        super().__init__(api, db, map, league, mode, callback_url, creator)
+    def __init__(self, api: EvioApiClient, db: AsyncEvioDB, map: EvioMap, league: League, league_data: LeagueInfo, mode: GameMode, callback_url: str, creator: User, player_index: PlayerIndex) -> None:
+        super().__init__(api, db, map, league, league_data, mode, callback_url, creator, player_index)
 
 
     def render_info(self, include_players: bool = False, is_searching: bool = False) -> Embed:
@@ -0,0 +1,42 @@
+from enum import IntEnum
+from typing import Iterable
+
+
+class PlayerState(IntEnum):
+    LOBBY = 0
+    MATCH = 1
+
+
+class PlayerIndex:
+
+    def __init__(self) -> None:
+        # Discord ID -> (lobby key or match ID, state)
+        self.players: dict[int, tuple[str, PlayerState]] = {}
+
+
+    def __contains__(self, discord_id: int) -> bool:
+        return discord_id in self.players
+
+
+    def __len__(self) -> int:
+        return len(self.players)
+
+
+    def get(self, discord_id: int) -> tuple[str, PlayerState] | None:
+        return self.players.get(discord_id)
+
+
+    def add(self, discord_id: int, key: str, state: PlayerState = PlayerState.LOBBY):
+        self.players[discord_id] = (key, state)
+
+
+    def move(self, discord_ids: Iterable[int], key: str, state: PlayerState):
+        for discord_id in discord_ids:
+            self.players[discord_id] = (key, state)
+
+
+    def discard(self, discord_id: int, key: str):
+        # Only drop the entry if it still points to the given lobby or match
+        entry = self.players.get(discord_id)
+        if entry is not None and entry[0] == key:
+            del self.players[discord_id]
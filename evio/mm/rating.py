@@ -0,0 +1,159 @@
+from typing import Iterable, Iterator, Sequence, TypedDict
+
+# Optional, whole batches of matches are computed with array operations when installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# If I want 2-step threshold, then I need additional value that will be used
+MMR_DIFF_THRESHOLD = 500
+# MMR_DIMINISHING_THRESHOLD = MMR_DIFF_THRESHOLD * 2
+ADDITIONAL_MMR_RATE = 20
+# DIMINISHING_MMR_RATE = 10
+BASE_MMR_RATE = 30 # 10 points per match outcome
+DEFAULT_MMR = 2000 # Same as the competitive_stats column default
+# Below this many players the per-call NumPy overhead costs more than the plain loop
+NUMPY_MIN_PLAYERS = 64
+# Matches computed together when recomputing ratings
+RECOMPUTE_WAVE_SIZE = 4096
+
+
+class RatingPolicy(TypedDict):
+    base_rate: float
+    additional_rate: float
+    diff_threshold: float
+
+
+DEFAULT_POLICY = RatingPolicy(base_rate=BASE_MMR_RATE, additional_rate=ADDITIONAL_MMR_RATE, diff_threshold=MMR_DIFF_THRESHOLD)
+
+
+# Result of one match, one entry per player in each list
+class MatchResult(TypedDict):
+    league_id: int
+    players: list[int] # User IDs
+    teams: list[int] # Team number, 0 or 1
+    placements: list[int] # Placement of the player's team, 0 is the winner
+
+
+def map_value(x: float, in_min: float, in_max: float, out_min: float, out_max: float) -> float:
+    return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
+
+
+def calc_mmr_bonus(mmr_diff: int, policy: RatingPolicy = DEFAULT_POLICY) -> float:
+    return min(policy['additional_rate'], map_value(mmr_diff, 0, policy['diff_threshold'], 0, policy['additional_rate']))
+
+
+def get_mmr_bonus(diff: float, won: bool, policy: RatingPolicy = DEFAULT_POLICY) -> int:
+    if diff < -policy['diff_threshold'] or diff > policy['diff_threshold']:
+        return -policy['additional_rate']
+    elif diff < 0 and not won or diff > 0 and won:
+        return -round(calc_mmr_bonus(abs(diff), policy))
+    return round(calc_mmr_bonus(abs(diff), policy))
+
+
+def get_rating_diff(player_mmr: int, enemy_avg_mmr: int) -> int:
+    return player_mmr - enemy_avg_mmr
+
+
+def _get_rating_changes_py(mmr: Sequence[int], teams: Sequence[int], placements: Sequence[int], matches: Sequence[int], policy: RatingPolicy) -> list[int]:
+    # (match, team) -> [MMR sum, player count, placement]
+    groups: dict[tuple[int, int], list[int]] = {}
+    for player_mmr, team, placement, match in zip(mmr, teams, placements, matches):
+        group = groups.get((match, team))
+        if group is None:
+            groups[(match, team)] = [player_mmr, 1, placement]
+        else:
+            group[0] += player_mmr
+            group[1] += 1
+
+    changes = []
+    for player_mmr, team, placement, match in zip(mmr, teams, placements, matches):
+        enemy = groups.get((match, int(not team)))
+        if enemy is not None and enemy[2] == placement:
+            changes.append(0) # Draw
+            continue
+        enemy_avg_mmr = enemy[0] // enemy[1] if enemy is not None else 0
+        won = not placement
+        bonus = get_mmr_bonus(get_rating_diff(player_mmr, enemy_avg_mmr), won, policy)
+        changes.append((policy['base_rate'] + bonus) * (1 if won else -1))
+    return changes
+
+
+def _get_rating_changes_np(mmr: Sequence[int], teams: Sequence[int], placements: Sequence[int], matches: Sequence[int], policy: RatingPolicy) -> list[int]:
+    # Same operations as get_mmr_bonus, in the same order, so results are identical
+    mmr = np.asarray(mmr, dtype=np.int64)
+    placements = np.asarray(placements, dtype=np.int64)
+    groups = np.asarray(matches, dtype=np.int64) * 2 + np.asarray(teams, dtype=np.int64)
+    enemy_groups = groups ^ 1
+    size = int(groups.max()) + 2
+
+    counts = np.bincount(groups, minlength=size)
+    # Float sums are exact for any realistic MMR total
+    sums = np.bincount(groups, weights=mmr, minlength=size).astype(np.int64)
+    avg = np.zeros(size, dtype=np.int64)
+    np.floor_divide(sums, counts, out=avg, where=counts > 0)
+    group_placements = np.full(size, -1, dtype=np.int64)
+    group_placements[groups] = placements
+
+    diff = mmr - avg[enemy_groups]
+    won = placements == 0
+    rate = policy['additional_rate']
+    threshold = policy['diff_threshold']
+    distance = np.abs(diff)
+    # np.rint rounds half to even like round()
+    bonus = np.rint(np.minimum(rate, distance * rate / threshold))
+    bonus = np.where((diff < 0) & ~won | (diff > 0) & won, -bonus, bonus)
+    bonus = np.where(distance > threshold, -rate, bonus)
+    changes = (policy['base_rate'] + bonus) * np.where(won, 1, -1)
+    changes[group_placements[enemy_groups] == placements] = 0 # Draw
+    if all(isinstance(value, int) for value in policy.values()):
+        changes = changes.astype(np.int64)
+    return changes.tolist()
+
+
+def get_rating_changes(mmr: Sequence[int], teams: Sequence[int], placements: Sequence[int], matches: Sequence[int] | None = None, policy: RatingPolicy = DEFAULT_POLICY) -> list[int]:
+    # Rating change of every player, computed against the enemy team average before the match.
+    # Players of several matches can be passed at once, `matches` then tells which match each player belongs to.
+    if not len(mmr):
+        return []
+    if matches is None:
+        matches = [0] * len(mmr)
+    if np is not None and len(mmr) >= NUMPY_MIN_PLAYERS:
+        return _get_rating_changes_np(mmr, teams, placements, matches, policy)
+    return _get_rating_changes_py(mmr, teams, placements, matches, policy)
+
+
+def iter_rating_changes(results: Iterable[MatchResult], ratings: dict[tuple[int, int], int], initial_mmr: int = DEFAULT_MMR, policy: RatingPolicy = DEFAULT_POLICY) -> Iterator[tuple[MatchResult, list[int]]]:
+    # Replays matches in the given order, updating `ratings` ((league ID, user ID) -> MMR) and yielding each match with its changes.
+    # Consecutive matches that share no players don't depend on each other, so they're computed together.
+    wave: list[MatchResult] = []
+    wave_players: set[tuple[int, int]] = set()
+    for result in results:
+        players = [(result['league_id'], user_id) for user_id in result['players']]
+        if len(wave) >= RECOMPUTE_WAVE_SIZE or not wave_players.isdisjoint(players):
+            yield from _apply_wave(wave, ratings, initial_mmr, policy)
+            wave = []
+            wave_players = set()
+        wave.append(result)
+        wave_players.update(players)
+    yield from _apply_wave(wave, ratings, initial_mmr, policy)
+
+
+def _apply_wave(wave: list[MatchResult], ratings: dict[tuple[int, int], int], initial_mmr: int, policy: RatingPolicy) -> Iterator[tuple[MatchResult, list[int]]]:
+    players = [(result['league_id'], user_id) for result in wave for user_id in result['players']]
+    changes = get_rating_changes(
+        [ratings.get(player, initial_mmr) for player in players],
+        [team for result in wave for team in result['teams']],
+        [placement for result in wave for placement in result['placements']],
+        [i for i, result in enumerate(wave) for _ in result['players']],
+        policy
+    )
+    for player, change in zip(players, changes):
+        ratings[player] = ratings.get(player, initial_mmr) + change
+
+    start = 0
+    for result in wave:
+        end = start + len(result['players'])
+        yield result, changes[start:end]
+        start = end
@@ -0,0 +1,57 @@
+import logging
+from itertools import groupby
+from operator import itemgetter
+from time import perf_counter
+from typing import Iterable, Iterator, TypedDict
+
+from evio.db import DBRatedMatchPlayer, EvioDB
+from evio.mm.rating import DEFAULT_MMR, DEFAULT_POLICY, MatchResult, RatingPolicy, iter_rating_changes
+
+PROGRESS_INTERVAL = 100000 # Matches
+
+
+class ReplaySummary(TypedDict):
+    matches: int
+    ratings: int # (league, player) pairs with at least one rated match
+    changed: int # Stats rows whose MMR differs from the current one
+    unknown_players: int # Match players that weren't registered
+    elapsed: float # Seconds
+
+
+def iter_match_results(rows: Iterable[DBRatedMatchPlayer], summary: ReplaySummary) -> Iterator[MatchResult]:
+    # Players without a user ID are left out, which also leaves them out of the team average
+    for _, match_rows in groupby(rows, itemgetter('match_id')):
+        result = MatchResult(league_id=0, players=[], teams=[], placements=[])
+        for row in match_rows:
+            if row['user_id'] is None:
+                summary['unknown_players'] += 1
+                continue
+            result['league_id'] = row['league_id']
+            result['players'].append(row['user_id'])
+            result['teams'].append(row['team'])
+            result['placements'].append(row['placement'])
+        yield result
+
+
+def replay_ratings(db: EvioDB, policy: RatingPolicy = DEFAULT_POLICY, initial_mmr: int = DEFAULT_MMR, swap: bool = True) -> ReplaySummary:
+    # Recomputes every MMR from the match history, oldest match first, and writes the result to the shadow stats table.
+    # Stats updates made while this runs would be lost by the swap, so the bot has to be stopped.
+    started = perf_counter()
+    summary = ReplaySummary(matches=0, ratings=0, changed=0, unknown_players=0, elapsed=0)
+    total = db.get_rated_matches_count()
+    ratings: dict[tuple[int, int], int] = {}
+    results = iter_match_results(db.iter_rated_matches(), summary)
+    for _ in iter_rating_changes(results, ratings, initial_mmr, policy):
+        summary['matches'] += 1
+        if summary['matches'] % PROGRESS_INTERVAL == 0:
+            elapsed = perf_counter() - started
+            logging.info(f'Replayed {summary["matches"]}/{total} matches ({summary["matches"] / total:.0%}), {summary["matches"] / elapsed:.0f} matches/s')
+
+    current = db.get_competitive_mmr()
+    summary['ratings'] = len(ratings)
+    summary['changed'] = sum(ratings.get(key, initial_mmr) != mmr for key, mmr in current.items())
+    db.write_shadow_stats(ratings, initial_mmr)
+    if swap:
+        db.swap_shadow_stats()
+    summary['elapsed'] = perf_counter() - started
+    return summary
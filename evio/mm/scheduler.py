@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from time import perf_counter
+from traceback import format_exc
+from typing import Callable, TypedDict
+from urllib.parse import urlparse
+
+from evio.api import CreatedMatchInfo
+from evio.mm.lobby import AbstractLobby
+
+MAX_CONCURRENT_POLLS = 10
+MAX_POLLS_PER_SECOND = 20 # Per host
+PENDING_TIMEOUT = timedelta(minutes=2)
+# Poll intervals in seconds
+FIRST_POLL_DELAY = 30
+PENDING_POLL_INTERVAL = 30
+RETRY_POLL_INTERVAL = 15
+MIN_RUNNING_POLL_INTERVAL = 30
+MAX_RUNNING_POLL_INTERVAL = 180
+RUNNING_POLLS_PER_MATCH = 5 # Roughly how many times a running match is polled during its configured duration
+
+
+class SweepStats(TypedDict):
+    checked: int
+    abandoned: int
+    scheduled: int
+    duration: float # Seconds
+
+
+class RateLimiter:
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate
+        self.next_at = 0.0
+
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # Reserve the next free time slot before sleeping so concurrent callers queue up behind each other
+        start_at = max(now, self.next_at)
+        self.next_at = start_at + self.interval
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+
+
+def get_running_poll_interval(match: AbstractLobby) -> float:
+    interval = match.match_config['duration'] / RUNNING_POLLS_PER_MATCH
+    return min(MAX_RUNNING_POLL_INTERVAL, max(MIN_RUNNING_POLL_INTERVAL, interval))
+
+
+class MatchPoller:
+
+    def __init__(self, concurrency: int = MAX_CONCURRENT_POLLS, rate: float = MAX_POLLS_PER_SECOND) -> None:
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate = rate
+        self.limiters: dict[str, RateLimiter] = {}
+        # Min-heap of (next check time, match ID). Entries are dropped lazily: an entry is only valid if it matches due_at.
+        self.queue: list[tuple[float, str]] = []
+        self.due_at: dict[str, float] = {}
+        self.last_sweep: SweepStats | None = None
+        # Called with polled data of complete matches in case the callback never arrives. Returns False to retry later.
+        self.on_complete: Callable[[CreatedMatchInfo], bool] | None = None
+
+
+    def __len__(self) -> int:
+        return len(self.due_at)
+
+
+    def schedule(self, match_id: str, delay: float = FIRST_POLL_DELAY):
+        due_at = asyncio.get_running_loop().time() + delay
+        self.due_at[match_id] = due_at
+        heapq.heappush(self.queue, (due_at, match_id))
+
+
+    def unschedule(self, match_id: str):
+        self.due_at.pop(match_id, None)
+
+
+    def pop_due(self) -> list[str]:
+        now = asyncio.get_running_loop().time()
+        match_ids: list[str] = []
+        while self.queue and self.queue[0][0] <= now:
+            due_at, match_id = heapq.heappop(self.queue)
+            if self.due_at.get(match_id) == due_at:
+                match_ids.append(match_id)
+        return match_ids
+
+
+    def get_limiter(self, match: AbstractLobby) -> RateLimiter:
+        host = urlparse(match.api.matchmaking_base_url).netloc
+        if host not in self.limiters:
+            self.limiters[host] = RateLimiter(self.rate)
+        return self.limiters[host]
+
+
+    async def poll(self, match_id: str, match: AbstractLobby, now: datetime) -> bool:
+        async with self.semaphore:
+            await self.get_limiter(match).acquire()
+            try:
+                data = await match.get_match_data()
+            except:
+                logging.error(format_exc())
+                data = None
+
+        # Callback was delivered while polling
+        if match_id not in self.due_at:
+            return False
+
+        if data is None:
+            self.schedule(match_id, RETRY_POLL_INTERVAL)
+            return False
+
+        status = data['status']
+        # Everyone left at any stage
+        if status == 'cancelled':
+            logging.info(f'Match {match.match_id} was cancelled.')
+            self.unschedule(match_id)
+            return True
+        if status == 'pending':
+            pending_for = now - match.started_at
+            # No one has joined the match
+            if pending_for > PENDING_TIMEOUT:
+                logging.info(f'Match {match.match_id} is in pending for more than 2 minutes.')
+                self.unschedule(match_id)
+                return True
+            # Make sure the next check lands right after the deadline
+            self.schedule(match_id, min(PENDING_POLL_INTERVAL, (PENDING_TIMEOUT - pending_for).total_seconds() + 1))
+            return False
+        if status == 'complete' and self.on_complete is not None and self.on_complete(data):
+            # Callback might have been lost, e.g. while the bot was restarting
+            self.unschedule(match_id)
+            return False
+        # Running or complete, the result is expected to be delivered by the callback. Complete results that weren't
+        # taken, e.g. invalid ones, are polled again.
+        self.schedule(match_id, get_running_poll_interval(match))
+        return False
+
+
+    async def sweep(self, matches: dict[str, AbstractLobby]) -> list[str]:
+        now = datetime.utcnow()
+        started = perf_counter()
+        due: list[tuple[str, AbstractLobby]] = []
+        for match_id in self.pop_due():
+            match = matches.get(match_id)
+            if match is None or match.started_at is None:
+                self.unschedule(match_id)
+                continue
+            due.append((match_id, match))
+        results = await asyncio.gather(*(self.poll(m_id, m, now) for m_id, m in due))
+        ids_to_delete = [m_id for (m_id, _), abandoned in zip(due, results) if abandoned]
+        self.last_sweep = SweepStats(checked=len(due), abandoned=len(ids_to_delete), scheduled=len(self.due_at), duration=perf_counter() - started)
+        if due:
+            logging.info(f'Checked {self.last_sweep["checked"]} matches in {self.last_sweep["duration"]:.3f}s, {self.last_sweep["abandoned"]} abandoned, {self.last_sweep["scheduled"]} scheduled.')
+        return ids_to_delete
@@ -0,0 +1,286 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from random import uniform
+from time import monotonic, perf_counter, time
+from typing import Any, Awaitable, Callable, Hashable, TypedDict
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError, ClientResponse, ClientResponseError
+
+from evio.cache import NEGATIVE_TTL, CacheEntry, CachedResponse, ResponseCache
+from evio.extract import SCAN_CHUNK_SIZE, ChunkExtractor
+
+# Upper bounds of latency histogram buckets in seconds. The last bucket catches everything above.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MAX_RETRY_BACKOFF = 10 # Seconds
+
+
+class TransportConfig(TypedDict, total=False):
+    connections: int # Max concurrent connections to the host
+    keepalive: float # Seconds
+    timeout: float # Seconds, whole request
+    connect_timeout: float # Seconds
+    retries: int # Only for GET requests
+    retry_backoff: float # Seconds, doubled with each retry
+    breaker_threshold: int # Consecutive failures before the circuit opens
+    breaker_timeout: float # Seconds before a trial request is let through
+
+
+DEFAULT_TRANSPORT_CONFIG = TransportConfig(
+    connections=20,
+    keepalive=30,
+    timeout=15,
+    connect_timeout=5,
+    retries=3,
+    retry_backoff=0.5,
+    breaker_threshold=5,
+    breaker_timeout=30
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class LatencyHistogram:
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket containing the quantile
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return 0.0
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold: int, timeout: float) -> None:
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial = False
+
+
+    def check(self) -> bool:
+        # True when the request is the trial request, which has to be released once it's over
+        if self.opened_at is None:
+            return False
+        if self.trial or monotonic() - self.opened_at < self.timeout:
+            raise CircuitOpenError()
+        # Half-open, let a single trial request through
+        self.trial = True
+        return True
+
+
+    def release(self):
+        # Trial request ended without a result, e.g. cancelled. The next request becomes the trial.
+        self.trial = False
+
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.failures >= self.threshold:
+            self.opened_at = monotonic()
+
+
+class SingleFlight:
+
+    def __init__(self) -> None:
+        # Key -> in-flight call. Entries are removed as soon as the call completes.
+        self.calls: dict[Hashable, asyncio.Task] = {}
+        self.saved = 0 # Upstream calls avoided by joining an in-flight one
+
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+
+    async def run(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self.calls[key] = task
+            task.add_done_callback(lambda t: self.done(key, t))
+        else:
+            self.saved += 1
+        # Shielded so one caller giving up doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+
+    def done(self, key: Hashable, task: asyncio.Task):
+        self.calls.pop(key, None)
+        # Mark the exception as retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+
+def stream_into(extractor: ChunkExtractor, body: bytearray | None) -> Callable[[ClientResponse], Awaitable[None]]:
+    async def read(res: ClientResponse):
+        # Called again on retry, so start over
+        extractor.reset()
+        if body is not None:
+            body.clear()
+        if res.status == 304:
+            return
+        async for chunk in res.content.iter_chunked(SCAN_CHUNK_SIZE):
+            if body is not None:
+                body.extend(chunk)
+            if extractor.feed(chunk):
+                # Rest of the body is dropped with the connection
+                break
+    return read
+
+
+def is_retriable(e: Exception) -> bool:
+    if isinstance(e, ClientResponseError):
+        return e.status >= 500 or e.status == 429
+    return True
+
+
+class HostTransport:
+
+    def __init__(self, name: str, config: TransportConfig | None = None, cache: ResponseCache | None = None, ttls: dict[str, float] | None = None) -> None:
+        self.name = name
+        self.cache = cache
+        # Endpoint -> seconds. Only GET requests to these endpoints are cached.
+        self.ttls = ttls or {}
+        self.config = TransportConfig(**{**DEFAULT_TRANSPORT_CONFIG, **(config or {})})
+        self.session = ClientSession(
+            connector=TCPConnector(limit=self.config['connections'], keepalive_timeout=self.config['keepalive']),
+            timeout=ClientTimeout(total=self.config['timeout'], connect=self.config['connect_timeout']),
+            raise_for_status=True
+        )
+        self.breaker = CircuitBreaker(self.config['breaker_threshold'], self.config['breaker_timeout'])
+        self.latency: dict[str, LatencyHistogram] = {}
+
+
+    async def close(self):
+        await self.session.close()
+
+
+    def observe(self, endpoint: str, seconds: float):
+        if endpoint not in self.latency:
+            self.latency[endpoint] = LatencyHistogram()
+        self.latency[endpoint].observe(seconds)
+
+
+    async def request(self, method: str, url: str, endpoint: str, **kwargs) -> ClientResponse | CachedResponse:
+        ttl = self.ttls.get(endpoint)
+        if method != 'GET' or self.cache is None or ttl is None:
+            return await self.send(method, url, endpoint, **kwargs)
+        return await self.cached_get(url, endpoint, ttl, **kwargs)
+
+
+    async def scan(self, url: str, endpoint: str, extractor: ChunkExtractor, **kwargs) -> ChunkExtractor:
+        # GET that feeds the body to the extractor as it arrives, and stops reading once the extractor is done
+        ttl = self.ttls.get(endpoint)
+        if self.cache is None or ttl is None:
+            await self.send('GET', url, endpoint, stream_into(extractor, None), **kwargs)
+        else:
+            await self.cached_get(url, endpoint, ttl, extractor, **kwargs)
+        return extractor
+
+
+    async def cached_get(self, url: str, endpoint: str, ttl: float, extractor: ChunkExtractor | None = None, **kwargs) -> ClientResponse | CachedResponse:
+        entry = await self.cache.get(url)
+        if entry is not None and entry['expires'] > time():
+            self.cache.hits += 1
+            res = CachedResponse(url, entry)
+            res.raise_for_status()
+            if extractor is not None:
+                extractor.feed(entry['body'])
+            return res
+        self.cache.misses += 1
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None and entry['status'] == 200:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        body = bytearray()
+        try:
+            res = await self.send('GET', url, endpoint, stream_into(extractor, body) if extractor is not None else None, headers=headers, **kwargs)
+        except ClientResponseError as e:
+            if e.status == 404:
+                await self.cache.put(url, CacheEntry(status=404, body=b'', encoding='utf-8', etag=None, last_modified=None, expires=time() + NEGATIVE_TTL))
+            raise
+
+        if res.status == 304 and entry is not None:
+            self.cache.revalidated += 1
+            entry['expires'] = time() + ttl
+            await self.cache.put(url, entry)
+            if extractor is not None:
+                extractor.feed(entry['body'])
+            return CachedResponse(url, entry)
+        if res.status == 200:
+            await self.cache.put(url, CacheEntry(
+                status=200,
+                # When scanning, only the part read so far is kept. Scanning it again gives the same result.
+                body=bytes(body) if extractor is not None else await res.read(),
+                # get_encoding() may sniff the body, which isn't read by aiohttp when scanning
+                encoding=(res.charset or 'utf-8') if extractor is not None else res.get_encoding(),
+                etag=res.headers.get('ETag'),
+                last_modified=res.headers.get('Last-Modified'),
+                expires=time() + ttl
+            ))
+        return res
+
+
+    async def send(self, method: str, url: str, endpoint: str, read: Callable[[ClientResponse], Awaitable[None]] | None = None, **kwargs) -> ClientResponse:
+        # Only idempotent requests are retried
+        attempts = self.config['retries'] + 1 if method == 'GET' else 1
+        for attempt in range(attempts):
+            trial = self.breaker.check()
+            started = perf_counter()
+            try:
+                async with self.session.request(method, url, **kwargs) as res:
+                    if read is None:
+                        # Body is cached by aiohttp, so .json() and .text() still work after release
+                        await res.read()
+                    else:
+                        await read(res)
+            except (ClientError, asyncio.TimeoutError) as e:
+                self.observe(endpoint, perf_counter() - started)
+                if not is_retriable(e):
+                    # Host is alive, the request itself is bad
+                    self.breaker.success()
+                    raise
+                self.breaker.failure()
+                if attempt == attempts - 1:
+                    raise
+                backoff = uniform(0, min(MAX_RETRY_BACKOFF, self.config['retry_backoff'] * 2 ** attempt))
+                logging.warning(f'{self.name}: {method} {endpoint} failed ({e!r}), retrying in {backoff:.2f}s')
+                await asyncio.sleep(backoff)
+                continue
+            except BaseException:
+                # Cancelled or failed for a reason that says nothing about the host
+                if trial:
+                    self.breaker.release()
+                raise
+            self.observe(endpoint, perf_counter() - started)
+            self.breaker.success()
+            return res
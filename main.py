@@ -1,16 +1,21 @@
 import asyncio
-import sqlite3
 import discord
 import logging
-from random import randint
-from datetime import datetime, timedelta
-from aiohttp import web, ClientSession, BasicAuth
+from aiohttp import web, BasicAuth
 from discord.ext import commands, tasks
 from custom_types import MatchmakingBot
 from json import load
+from time import perf_counter
 from traceback import format_exc
 
-from evio.api import MatchmakingMatchInfoResponse
+from evio.api import MATCH_INFO_RESPONSE_DECODER, EvioApiClient, MatchmakingMatchInfoResponse
+from evio.cache import RESPONSE_CACHE_SIZE, ResponseCache, SQLiteCacheStore
+from evio.db import AsyncEvioDB, LeagueRegistry
+from evio.fanout import MessageFanout
+from evio.mm.callbacks import MatchCallbackProcessor, is_valid_match_info
+from evio.mm.index import LobbyIndex
+from evio.mm.players import PlayerIndex
+from evio.mm.scheduler import MatchPoller
 from evio import cog as evio
 
 discord.utils.setup_logging()
@@ -30,35 +35,22 @@ with open('config.json', encoding='utf-8') as f:
     cfg = load(f)
 
 
-@tasks.loop(seconds=15)
+@tasks.loop(seconds=5)
 async def timeout_matches():
-    now = datetime.utcnow()
-    ids_to_delete: list[str] = []
+    # Only matches that are due are polled. The lock is only needed to apply the results.
+    ids_to_delete = await bot.match_poller.sweep(bot.matches)
+    abandoned_matches = []
     async with bot.matches_lock:
-        for m_id, m in bot.matches.items():
-            # TODO: This is kinda suboptimal, but what to do... We'll have to poll all matches and check if any of them were cancelled
-            if m.started_at is None:
-                continue
-            data = await m.get_match_data()
-            status = data['status']
-            # Everyone left at any stage
-            if status == 'cancelled':
-                logging.info(f'Match {m.match_id} was cancelled.')
-                ids_to_delete.append(m_id)
-            # No one has joined the match
-            elif status == 'pending' and now - m.started_at > timedelta(minutes=2):
-                logging.info(f'Match {m.match_id} is in pending for more than 2 minutes.')
-                ids_to_delete.append(m_id)
-            await asyncio.sleep(randint(0, 300) / 1000) # Sleep between 0-300ms
         for m_id in ids_to_delete:
-            m = bot.matches[m_id]
-            del bot.matches[m_id]
-            m.cancel()
-            for msg in m.user_messages.values():
-                try:
-                    await msg.edit(content='Match has been abandoned. Stats will not be tracked.', view=None)
-                except:
-                    pass
+            # Match might have been finished by the callback while polling
+            m = bot.matches.pop(m_id, None)
+            if m is not None:
+                abandoned_matches.append(m)
+    for m in abandoned_matches:
+        m.release()
+        await m.cancel()
+        await m.forget()
+        bot.fanout.broadcast(m.user_messages.values(), content='Match has been abandoned. Stats will not be tracked.', view=None)
 
 
 @bot.event
@@ -67,48 +59,28 @@ async def on_ready():
     await bot.tree.sync()
     timeout_matches.start()
 
-# TODO: Move to "evio" module
 @routes.post('/matchCallback')
 async def matchCallback(req: web.Request):
+    # Only checks the payload and queues it, the match is finished by callback workers
+    started = perf_counter()
     if not req.content_type.startswith('application/json'):
-        return
-    data: MatchmakingMatchInfoResponse = await req.json()
-    match_data = data['match']
-    match_data['map'] = int(match_data['map'])
-    for team in match_data['teams']:
-        for player in team['players']:
-            player['account'] = int(player['account'])
-
-    match_id = match_data['matchId']
-    logging.info(f'Received callback for {match_id}')
-    if match_id not in bot.matches:
-        # TODO: Currently, matches don't persist between restarts. Respond with 200 to keep ev.io happy
-        return web.json_response(status=200)
-
-    m = bot.matches[match_id]
-
+        return web.json_response(status=400)
     try:
-        res = m.finish(match_data)
+        data: MatchmakingMatchInfoResponse = MATCH_INFO_RESPONSE_DECODER.decode(await req.read())
+        match_data = data['match']
     except:
-        # To avoid spam in case there're any issues with the match
-        logging.error(format_exc())
-        for msg in m.user_messages.values():
-            try:
-                await msg.edit(content=f'Something went wrong with the match. Please notify @emojikage about the issue.', view=None)
-            except:
-                logging.error(format_exc())
-        return web.json_response(status=200)
-    embed = m.render_info(True, False)
-    for msg in m.user_messages.values():
-        try:
-            await msg.edit(content=f'Match finished! {res}', embed=embed, view=None)
-        except:
-            logging.error(format_exc())
-
-    async with bot.matches_lock:
-        del bot.matches[match_id]
+        logging.warning(f'Received malformed callback: {format_exc()}')
+        return web.json_response(status=400)
+    # Also checked by submit, but an invalid callback is rejected for good instead of being retried
+    if not is_valid_match_info(match_data):
+        logging.warning(f'Received invalid callback: {match_data}')
+        return web.json_response(status=400)
 
-    return web.json_response(status=200)
+    logging.info(f'Received callback for {match_data["matchId"]}')
+    # Respond with 200 for unknown and repeated matches to keep ev.io happy
+    status = 200 if bot.match_callbacks.submit(match_data) else 503
+    bot.match_callbacks.ack_latency.observe(perf_counter() - started)
+    return web.json_response(status=status)
 
 
 async def main():
@@ -121,32 +93,46 @@ async def main():
         site = web.TCPSite(runner, host=None, port=8080)
         await site.start()
 
-        client = ClientSession(raise_for_status=True)
         credentials = BasicAuth(cfg['evio_username'], cfg['evio_password'])
+        # ev.io responses are cached in memory, and also on disk if a path is configured
+        cache_cfg = cfg.get('http_cache', {})
+        cache = ResponseCache(cache_cfg.get('size', RESPONSE_CACHE_SIZE), SQLiteCacheStore(cache_cfg['path']) if 'path' in cache_cfg else None)
+        await cache.open()
+        api = EvioApiClient(credentials, cfg.get('http'), cache, cache_cfg.get('ttls'))
 
         # Match tracking
         bot.matches = {}
         bot.lobbies = {}
         bot.matches_lock = asyncio.Lock()
         bot.lobbies_lock = asyncio.Lock()
+        bot.lobby_index = LobbyIndex()
+        bot.player_index = PlayerIndex()
+        bot.match_poller = MatchPoller()
+        bot.fanout = MessageFanout()
+        bot.match_callbacks = MatchCallbackProcessor(bot)
+        bot.match_callbacks.start()
+        bot.match_poller.on_complete = bot.match_callbacks.submit
         bot.maintenance = False
         bot.owner_id = 277821614345945089
 
-        # Initialize db connection
-        db = sqlite3.connect('bot.db')
-        bot.db = db
-        bot.db.execute('PRAGMA foreign_keys=ON')
-        bot.db.execute('PRAGMA journal_mode=WAL')
-        bot.db.execute('PRAGMA synchronous=normal')
-        bot.db.execute('PRAGMA journal_size_limit=67110000')
-        bot.db.row_factory = sqlite3.Row
-
-        await bot.add_cog(evio.Evio(bot, client, credentials, cfg['callback_url']))
-        await bot.start(cfg['token'])
-
-        await client.close()
-        bot.db.execute('PRAGMA optimize')
-        bot.db.close()
+        # Initialize db connections
+        bot.db = AsyncEvioDB('bot.db')
+        await bot.db.open()
+        bot.leagues = LeagueRegistry(bot.db)
+        await bot.leagues.load()
+
+        cog = evio.Evio(bot, api, cfg['callback_url'])
+        await bot.add_cog(cog)
+        # Lobbies and matches from the previous run are restored once logged in, before connecting to the gateway
+        await bot.login(cfg['token'])
+        await cog.restore_lobbies()
+        await bot.connect()
+
+        await bot.match_callbacks.stop()
+        await api.close()
+        await cache.close()
+        # Flushes pending journal writes
+        await bot.db.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
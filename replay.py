@@ -0,0 +1,31 @@
+import logging
+from argparse import ArgumentParser
+
+from evio.db import EvioDB, connect
+from evio.mm.rating import ADDITIONAL_MMR_RATE, BASE_MMR_RATE, DEFAULT_MMR, MMR_DIFF_THRESHOLD, RatingPolicy
+from evio.mm.replay import replay_ratings
+
+# Recomputes every player's MMR from the match history, e.g. after changing the rating formula.
+# Run it while the bot is stopped.
+
+parser = ArgumentParser(description='Replay the match history and recompute MMR of every player.')
+parser.add_argument('--db', default='bot.db')
+parser.add_argument('--base-rate', type=int, default=BASE_MMR_RATE)
+parser.add_argument('--additional-rate', type=int, default=ADDITIONAL_MMR_RATE)
+parser.add_argument('--diff-threshold', type=int, default=MMR_DIFF_THRESHOLD)
+parser.add_argument('--initial-mmr', type=int, default=DEFAULT_MMR)
+parser.add_argument('--no-swap', action='store_true', help='Only write evio_competitive_stats_shadow and keep the current stats')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    policy = RatingPolicy(base_rate=args.base_rate, additional_rate=args.additional_rate, diff_threshold=args.diff_threshold)
+    db = EvioDB(connect(args.db))
+    summary = replay_ratings(db, policy, args.initial_mmr, not args.no_swap)
+    db.db.close()
+    logging.info(
+        f'Replayed {summary["matches"]} matches in {summary["elapsed"]:.1f}s. '
+        f'{summary["ratings"]} ratings recomputed, {summary["changed"]} changed, {summary["unknown_players"]} unknown players in history.'
+        + (' Results were left in evio_competitive_stats_shadow.' if args.no_swap else '')
+    )
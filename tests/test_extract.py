@@ -0,0 +1,93 @@
+# ChunkExtractor has to find the same UIDs and page numbers as a regex over the whole page, however the body is split.
+# The fixtures are clan member pages and a rankings page looked up by name, with the markup of ev.io listings: a table of
+# players, pager links and user links that must not match, like /user/login and /user/<uid>/edit.
+import re
+from pathlib import Path
+
+import pytest
+
+from evio.api import RE_PAGE_NUM, RE_UID
+from evio.extract import MAX_MATCH_LENGTH, SCAN_CHUNK_SIZE, ChunkExtractor
+
+FIXTURES = sorted((Path(__file__).parent / 'fixtures').glob('*.html'))
+RANKINGS = Path(__file__).parent / 'fixtures' / 'rankings_by_name.html'
+CHUNK_SIZES = (1, 2, 3, 7, MAX_MATCH_LENGTH - 1, MAX_MATCH_LENGTH, MAX_MATCH_LENGTH + 1, 1000, SCAN_CHUNK_SIZE)
+
+
+def expected(page: bytes) -> dict[str, list[bytes]]:
+    return {'uid': re.findall(RE_UID, page), 'page': re.findall(RE_PAGE_NUM, page)}
+
+
+def extract(chunks) -> dict[str, list[bytes]]:
+    extractor = ChunkExtractor({'uid': RE_UID, 'page': RE_PAGE_NUM})
+    for chunk in chunks:
+        assert not extractor.feed(chunk)
+    return extractor.results
+
+
+def split(page: bytes, size: int):
+    return (page[i:i + size] for i in range(0, len(page), size))
+
+
+@pytest.fixture(params=FIXTURES, ids=lambda path: path.name)
+def page(request) -> bytes:
+    return request.param.read_bytes()
+
+
+def test_fixtures():
+    assert FIXTURES
+    for path in FIXTURES:
+        assert re.findall(RE_UID, path.read_bytes())
+
+
+@pytest.mark.parametrize('size', CHUNK_SIZES)
+def test_chunk_sizes(page: bytes, size: int):
+    assert extract(split(page, size)) == expected(page)
+
+
+def test_split_inside_match(page: bytes):
+    # Boundary at every position inside every match, including right after the opening and before the closing quote
+    matches = [m.span() for pattern in (RE_UID, RE_PAGE_NUM) for m in re.finditer(pattern, page)]
+    for start, end in matches:
+        for cut in range(start + 1, end):
+            assert extract([page[:cut], page[cut:]]) == expected(page), (start, end, cut)
+        # Match spread over several chunks, with the middle one entirely inside it
+        middle = (start + end) // 2
+        assert extract([page[:start + 1], page[start + 1:middle], page[middle:end - 1], page[end - 1:]]) == expected(page)
+
+
+def test_longest_match():
+    # Only the last MAX_MATCH_LENGTH bytes of a chunk are carried over. A match of that length has to be found wherever
+    # it's cut.
+    uid = b'1' * (MAX_MATCH_LENGTH - len(b'href="/user/"'))
+    body = b'x' * 1000 + b'href="/user/' + uid + b'"' + b'x' * 1000
+    start = body.index(b'href')
+    for cut in range(start + 1, start + MAX_MATCH_LENGTH):
+        assert extract([body[:cut], body[cut:]])['uid'] == [uid]
+
+
+def test_limit(page: bytes):
+    extractor = ChunkExtractor({'uid': RE_UID}, {'uid': 1})
+    for chunk in split(page, 7):
+        if extractor.feed(chunk):
+            break
+    else:
+        pytest.fail('Extractor never finished')
+    assert extractor.results['uid'] == [re.search(RE_UID, page)['uid']]
+
+
+@pytest.mark.parametrize('size', CHUNK_SIZES)
+def test_stop_at_first_uid(size: int):
+    # A lookup by name only needs the first UID, the rest of the page must not be read
+    page = RANKINGS.read_bytes()
+    first = re.search(RE_UID, page)
+    extractor = ChunkExtractor({'uid': RE_UID}, {'uid': 1})
+    read = 0
+    for chunk in split(page, size):
+        read += len(chunk)
+        if extractor.feed(chunk):
+            break
+    assert extractor.results['uid'] == [first['uid']]
+    # Stopped in the chunk where the match ends
+    assert read - size < first.end() <= read
+    assert read < len(page)
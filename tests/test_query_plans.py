@@ -0,0 +1,78 @@
+# Every hot query has to be answered from an index. The statements are captured while the EvioDB methods run, so the
+# test follows the queries as they change. Rank and leaderboard pages are read from memory and aren't covered.
+import pytest
+
+from evio.db import MAPS_POOL, EvioDB, GameMode, League, MatchStatusEnum, connect
+
+USER_ID = 1
+DISCORD_ID = 100
+# How SQLite reports a lookup through the primary key of a WITHOUT ROWID table or through an index
+INDEXED = ('USING PRIMARY KEY', 'USING INDEX', 'USING COVERING INDEX', 'USING INTEGER PRIMARY KEY')
+
+
+@pytest.fixture
+def db() -> EvioDB:
+    db = EvioDB(connect(':memory:'))
+    for user_id in (USER_ID, USER_ID + 1):
+        db.register_player({'uid': [{'value': user_id}], 'name': [{'value': f'player{user_id}'}]}, DISCORD_ID + user_id - USER_ID)
+    teams = [
+        {'placement': 0, 'players': [{'user_id': USER_ID, 'name': 'player1', 'kills': 10, 'deaths': 2, 'assists': 1, 'mmr': 30}]},
+        {'placement': 1, 'players': [{'user_id': USER_ID + 1, 'name': 'player2', 'kills': 2, 'deaths': 10, 'assists': 0, 'mmr': -30}]}
+    ]
+    config = {'damageMultiplier': 1, 'duration': 300, 'gameMode': 'team_deathmatch', 'gravity': 0.07, 'killsToWin': 25, 'timeVelocity': 1}
+    for i in range(3):
+        db.insert_match({
+            'match_id': f'match{i}', 'status': MatchStatusEnum.COMPLETE.value, 'league_id': League.Solo.value, 'mode_id': GameMode.Competitive.value,
+            'config': config, 'teams': teams, 'map': MAPS_POOL[0], 'region': 0, 'comment': None
+        }, [USER_ID, USER_ID + 1])
+    return db
+
+
+def capture(db: EvioDB, fn, *args, **kwargs) -> list[str]:
+    # Statements run by fn, with parameters expanded
+    statements: list[str] = []
+    db.db.set_trace_callback(statements.append)
+    try:
+        fn(db, *args, **kwargs)
+    finally:
+        db.db.set_trace_callback(None)
+    return [statement for statement in statements if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE'))]
+
+
+def assert_indexed(db: EvioDB, statements: list[str]):
+    assert statements
+    for statement in statements:
+        plan = [row['detail'] for row in db.db.execute(f'EXPLAIN QUERY PLAN {statement}')]
+        for detail in plan:
+            assert not detail.startswith('SCAN'), (statement, plan)
+            assert 'TEMP B-TREE' not in detail, (statement, plan)
+            if detail.startswith('SEARCH'):
+                assert any(using in detail for using in INDEXED), (statement, plan)
+
+
+def test_profile(db: EvioDB):
+    assert_indexed(db, capture(db, EvioDB.get_player_profile, DISCORD_ID))
+
+
+def test_history(db: EvioDB):
+    statements = capture(db, EvioDB.get_player_match_history, USER_ID)
+    # Page query and the players of the page
+    assert len(statements) == 2
+    assert_indexed(db, statements)
+    assert_indexed(db, capture(db, EvioDB.get_player_match_history, USER_ID, after=(0, 'match9')))
+    assert_indexed(db, capture(db, EvioDB.get_player_match_history, USER_ID, before=(0, 'match0')))
+
+
+def test_stats_update(db: EvioDB):
+    change = {'user_id': USER_ID, 'league_id': League.Solo.value, 'won': 1, 'lost': 0, 'draw': 0, 'kills': 10, 'deaths': 2, 'assists': 1, 'mmr': 30}
+    assert_indexed(db, capture(db, EvioDB.update_players_stats, [change]))
+
+
+def test_leaderboard_player(db: EvioDB):
+    # Stats of a single player, loaded into the leaderboards on registration
+    assert_indexed(db, capture(db, EvioDB.get_leaderboard_rows, USER_ID))
+
+
+def test_player(db: EvioDB):
+    assert_indexed(db, capture(db, EvioDB.get_player, USER_ID, 'p.user_id', 'i.discord_id'))
+    assert_indexed(db, capture(db, EvioDB.get_player_by_discord_id, DISCORD_ID, 'p.user_id', 'p.name'))
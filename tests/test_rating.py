@@ -0,0 +1,124 @@
+# The default policy has to give exactly the same MMR changes as the per-player formulas finish() used before ratings
+# were computed in batches. Both the plain and the NumPy paths are checked against a copy of those formulas.
+from random import Random
+
+import pytest
+
+from evio.mm import rating
+from evio.mm.rating import ADDITIONAL_MMR_RATE, BASE_MMR_RATE, DEFAULT_POLICY, MMR_DIFF_THRESHOLD, RatingPolicy
+
+PATHS = [
+    rating._get_rating_changes_py,
+    pytest.param(rating._get_rating_changes_np, marks=pytest.mark.skipif(rating.np is None, reason='NumPy is not installed')),
+]
+# Diffs around the thresholds, where the bonus stops scaling and becomes a penalty
+BOUNDARY_DIFFS = (0, 1, -1, MMR_DIFF_THRESHOLD - 1, MMR_DIFF_THRESHOLD, MMR_DIFF_THRESHOLD + 1, -MMR_DIFF_THRESHOLD + 1, -MMR_DIFF_THRESHOLD, -MMR_DIFF_THRESHOLD - 1)
+
+
+# Legacy formulas, with the constants as defaults so other policies can be checked the same way
+def legacy_map_value(x, in_min, in_max, out_min, out_max):
+    return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
+
+
+def legacy_calc_mmr_bonus(mmr_diff, threshold=MMR_DIFF_THRESHOLD, rate=ADDITIONAL_MMR_RATE):
+    return min(rate, legacy_map_value(mmr_diff, 0, threshold, 0, rate))
+
+
+def legacy_get_mmr_bonus(diff, won, threshold=MMR_DIFF_THRESHOLD, rate=ADDITIONAL_MMR_RATE):
+    if diff < -threshold or diff > threshold:
+        return -rate
+    elif diff < 0 and not won or diff > 0 and won:
+        return -round(legacy_calc_mmr_bonus(abs(diff), threshold, rate))
+    return round(legacy_calc_mmr_bonus(abs(diff), threshold, rate))
+
+
+def legacy_match_changes(teams: list[list[int]], placements: list[int], policy: RatingPolicy = DEFAULT_POLICY) -> list[int]:
+    # Two teams, changes in player order. A draw doesn't change MMR.
+    if placements[0] == placements[1]:
+        return [0] * (len(teams[0]) + len(teams[1]))
+    changes = []
+    for i, team in enumerate(teams):
+        enemy = teams[int(not i)]
+        enemy_avg_mmr = sum(enemy) // len(enemy)
+        won = not placements[i]
+        sign = 1 if won else -1
+        for mmr in team:
+            bonus = legacy_get_mmr_bonus(mmr - enemy_avg_mmr, won, policy['diff_threshold'], policy['additional_rate'])
+            changes.append((policy['base_rate'] + bonus) * sign)
+    return changes
+
+
+def random_matches(seed: int, count: int) -> list[tuple[list[list[int]], list[int]]]:
+    rng = Random(seed)
+    matches = []
+    for _ in range(count):
+        size = rng.randint(1, 5)
+        base = rng.randint(0, 4000)
+        spread = rng.choice((50, 300, 700, 1500))
+        teams = [[base + rng.randint(-spread, spread) for _ in range(size)] for _ in range(2)]
+        placements = rng.choice(((0, 1), (1, 0), (0, 1), (1, 0), (0, 0)))
+        matches.append((teams, list(placements)))
+    return matches
+
+
+def boundary_matches() -> list[tuple[list[list[int]], list[int]]]:
+    # 1v1 so the diff is exact, won and lost on both sides
+    return [([[2000 + diff], [2000]], placements) for diff in BOUNDARY_DIFFS for placements in ([0, 1], [1, 0])]
+
+
+def flatten(matches: list[tuple[list[list[int]], list[int]]]) -> tuple[list[int], list[int], list[int], list[int]]:
+    mmr, teams, placements, match_ids = [], [], [], []
+    for match_id, (match_teams, match_placements) in enumerate(matches):
+        for team, players in enumerate(match_teams):
+            mmr += players
+            teams += [team] * len(players)
+            placements += [match_placements[team]] * len(players)
+            match_ids += [match_id] * len(players)
+    return mmr, teams, placements, match_ids
+
+
+def expected(matches, policy: RatingPolicy = DEFAULT_POLICY) -> list[int]:
+    return [change for teams, placements in matches for change in legacy_match_changes(teams, placements, policy)]
+
+
+@pytest.mark.parametrize('path', PATHS)
+@pytest.mark.parametrize('seed', range(4))
+def test_random_matches(path, seed: int):
+    matches = random_matches(seed, 5000)
+    changes = path(*flatten(matches), DEFAULT_POLICY)
+    assert changes == expected(matches)
+    assert all(type(change) is int for change in changes)
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_single_match(path):
+    # Finishing a match computes one match at a time
+    for teams, placements in random_matches(4, 500) + boundary_matches():
+        assert path(*flatten([(teams, placements)]), DEFAULT_POLICY) == legacy_match_changes(teams, placements)
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_threshold_boundaries(path):
+    matches = boundary_matches()
+    assert path(*flatten(matches), DEFAULT_POLICY) == expected(matches)
+    # Just past the threshold the winner loses the whole additional rate
+    assert legacy_match_changes([[2000 + MMR_DIFF_THRESHOLD + 1], [2000]], [0, 1])[0] == BASE_MMR_RATE - ADDITIONAL_MMR_RATE
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_half_rounding(path):
+    # With the default policy the bonus is diff / 25, which is never exactly .5. A threshold of 400 makes it diff / 20,
+    # so odd multiples of 10 land on .5 and have to round half to even like round().
+    policy = RatingPolicy(base_rate=BASE_MMR_RATE, additional_rate=ADDITIONAL_MMR_RATE, diff_threshold=400)
+    diffs = [10 * k for k in range(-41, 42)]
+    matches = [([[2000 + diff], [2000]], placements) for diff in diffs for placements in ([0, 1], [1, 0])]
+    assert path(*flatten(matches), policy) == expected(matches, policy)
+    assert legacy_get_mmr_bonus(10, False, 400) == 0 and legacy_get_mmr_bonus(30, False, 400) == 2
+
+
+def test_dispatch():
+    # Batches large enough for the NumPy path and small ones give the same results through get_rating_changes
+    for count in (1, 3, rating.NUMPY_MIN_PLAYERS, 1000):
+        matches = random_matches(5, count)
+        mmr, teams, placements, match_ids = flatten(matches)
+        assert rating.get_rating_changes(mmr, teams, placements, match_ids) == expected(matches)